@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+"""
+Track whether the board has been used, and only reset it when it has (see vlabactivity).
+
+Usage:
+	activity.py watch            Run by supervisord. Records JTAG use whenever a connection to hw_server lasts longer
+	                             than one poll, which ignores the readiness checks made by ready.py.
+	activity.py reset [always]   Run by the relay. Resets the board with /vlab/reset.tcl unless it has been reset by
+	                             this container and not used since, or regardless if 'always' is given, then marks
+	                             it clean.
+	                             Prints VLABRESET:done or VLABRESET:skipped, and exits with xsdb's exit status.
+"""
+
+import subprocess
+import sys
+import time
+import vlabactivity
+
+POLL_INTERVAL = 1
+
+if len(sys.argv) < 2 or sys.argv[1] not in ("watch", "reset"):
+	print("Usage: {} watch | reset [always]".format(sys.argv[0]))
+	sys.exit(1)
+
+if sys.argv[1] == "watch":
+	previous = set()
+	while True:
+		current = vlabactivity.connections_to(vlabactivity.JTAG_PORT)
+		if current & previous:
+			vlabactivity.mark_used("jtag")
+		previous = current
+		time.sleep(POLL_INTERVAL)
+
+if vlabactivity.is_clean() and "always" not in sys.argv[2:]:
+	print("VLABRESET:skipped")
+	sys.exit(0)
+# Until the reset succeeds the board is dirty, whatever its state before
+vlabactivity.mark_dirty()
+rc = subprocess.run(["/opt/xsct/bin/xsdb", "/vlab/reset.tcl"]).returncode
+if rc == 0:
+	# The reset's own connection to hw_server may have been recorded, so clear the record afterwards
+	vlabactivity.mark_clean()
+	print("VLABRESET:done")
+sys.exit(rc)
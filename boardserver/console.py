@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+Connect to the board's serial console through the serial broker (serialbroker.py).
+
+Usage:
+	console.py attach <owner>         Connect the terminal to the console as its owner, who may type into it
+	console.py view                   Watch the console without being able to type into it (Ctrl-C to stop)
+	console.py tail <bytes> <owner>   Print the most recent output of the console, if it belongs to <owner>
+
+'attach' is run by the relay's login shell inside screen. The output of the console is kept for its owner until a
+different user attaches to it.
+"""
+
+import os
+import selectors
+import socket
+import sys
+import termios
+import tty
+import vlabserial
+
+if len(sys.argv) < 2 or sys.argv[1] not in vlabserial.REQUESTS:
+	print("Usage: {} attach <owner> | view | tail <bytes> <owner>".format(sys.argv[0]))
+	sys.exit(1)
+
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+try:
+	sock.connect(vlabserial.BROKER_SOCKET)
+	sock.sendall(vlabserial.broker_request(*sys.argv[1:]))
+except (OSError, ValueError) as e:
+	print("Cannot connect to the serial console: {}".format(e))
+	sys.exit(1)
+
+selector = selectors.DefaultSelector()
+selector.register(sock, selectors.EVENT_READ)
+saved_attrs = None
+if sys.argv[1] == "attach":
+	selector.register(sys.stdin.fileno(), selectors.EVENT_READ)
+	if os.isatty(sys.stdin.fileno()):
+		saved_attrs = termios.tcgetattr(sys.stdin.fileno())
+		tty.setraw(sys.stdin.fileno())
+
+try:
+	while True:
+		for key, _ in selector.select():
+			if key.fileobj is sock:
+				data = sock.recv(4096)
+				if not data:
+					sys.exit(0)
+				os.write(sys.stdout.fileno(), data)
+			else:
+				data = os.read(sys.stdin.fileno(), 4096)
+				if not data:
+					# Keep showing the console when there is nothing more to type, as when capturing a batch job
+					selector.unregister(key.fileobj)
+					continue
+				sock.sendall(data)
+except KeyboardInterrupt:
+	pass
+finally:
+	if saved_attrs is not None:
+		termios.tcsetattr(sys.stdin.fileno(), termios.TCSADRAIN, saved_attrs)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+"""
+Wait until this board server's sshd and hw_server are accepting connections. This is run with 'docker exec' by
+boardrestart.py on the board host after restarting the container, so that the relay connects as soon as the board
+server is ready.
+
+Takes an optional timeout in seconds (default 30). Exits with 0 once both are ready, or 1 if they are not ready
+before the timeout.
+"""
+
+import socket
+import sys
+import time
+
+SSH_PORT = 22
+HW_SERVER_PORT = 3121
+POLL_INTERVAL = 0.1
+
+
+def accepting(port, banner=None):
+	"""
+	Return True if a connection to 'port' on this machine succeeds and, if 'banner' is given, the server's first
+	bytes start with it.
+	"""
+	try:
+		with socket.create_connection(("127.0.0.1", port), timeout=1) as s:
+			return banner is None or s.recv(len(banner)) == banner
+	except OSError:
+		return False
+
+
+timeout = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+deadline = time.monotonic() + timeout
+
+# sshd accepts connections before it is able to serve them, so wait for its version banner
+while not (accepting(SSH_PORT, b"SSH-") and accepting(HW_SERVER_PORT)):
+	if time.monotonic() > deadline:
+		print("Board server not ready after {} seconds.".format(timeout))
+		sys.exit(1)
+	time.sleep(POLL_INTERVAL)
+
+sys.exit(0)
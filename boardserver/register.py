@@ -24,13 +24,9 @@ check_in_set(db, "vlab:knownboards", serial,
 boardtype = db.get("vlab:knownboard:{}:type".format(serial))
 boardclass = db.get("vlab:knownboard:{}:class".format(serial))
 
-db.sadd("vlab:boardclasses", boardclass)
-db.sadd("vlab:boardclass:{}:boards".format(boardclass), serial)
 # We do not add the board to "vlab:boardclass:{}:availableboards" or "vlab:boardclass:{}:unlockedboards" to avoid
 # accidentally marking it as available/unlocked. If this is a new board registration, this will be picked up by
 # 'checkboards.py' on the relay (run in a cronjob) and the board will be unlocked and set available then.
 
 # Set up our board with details provided
-db.set("vlab:board:{}:user".format(serial), "vlab")
-db.set("vlab:board:{}:server".format(serial), hostname)
-db.set("vlab:board:{}:port".format(serial), host_port)
+register_board(db, serial, boardclass, {"user": "vlab", "server": hostname, "port": host_port})
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+The serial broker. Run by supervisord in each board server, it is the only process which opens the board's UART
+(/dev/ttyFPGA). Its output is kept in a SerialLog (see vlabserial) and copied to every client connected to the broker's
+unix socket, so that a TA can watch a session with console.py without taking it over, and a user can fetch the
+output of their session after they have disconnected.
+
+Only "attach" clients may write to the UART, which is recorded as use of the board (see vlabactivity). Viewers which
+fall more than a buffer's worth of output behind are disconnected rather than holding up everybody else.
+"""
+
+import os
+import selectors
+import socket
+import sys
+import termios
+import time
+import tty
+import vlabactivity
+import vlabserial
+
+DEVICE = "/dev/ttyFPGA"
+BAUD_RATE = termios.B115200
+READ_SIZE = 4096
+
+
+class Client:
+	def __init__(self, sock):
+		self.sock = sock
+		self.request = None
+		self.incoming = b""
+		self.outgoing = bytearray()
+		self.closing = False
+
+
+def open_device(path):
+	fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+	tty.setraw(fd)
+	attrs = termios.tcgetattr(fd)
+	attrs[4] = attrs[5] = BAUD_RATE
+	attrs[3] &= ~termios.ECHO
+	termios.tcsetattr(fd, termios.TCSANOW, attrs)
+	return fd
+
+
+class Broker:
+	def __init__(self, device, log, path=vlabserial.BROKER_SOCKET):
+		self.device = device
+		self.log = log
+		self.clients = {}
+		self.selector = selectors.DefaultSelector()
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		if os.path.exists(path):
+			os.unlink(path)
+		self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.listener.bind(path)
+		os.chmod(path, 0o600)
+		self.listener.listen()
+		self.listener.setblocking(False)
+		self.selector.register(self.listener, selectors.EVENT_READ)
+		self.selector.register(self.device, selectors.EVENT_READ)
+
+	def run(self):
+		while True:
+			for key, events in self.selector.select():
+				if key.fileobj is self.listener:
+					self.accept()
+				elif key.fileobj == self.device:
+					self.read_device()
+				else:
+					client = self.clients.get(key.fileobj)
+					if client is None:
+						# Closed while handling an earlier event
+						continue
+					if events & selectors.EVENT_READ:
+						self.read_client(client)
+					if events & selectors.EVENT_WRITE and client.sock in self.clients:
+						self.write_client(client)
+
+	def accept(self):
+		sock, _ = self.listener.accept()
+		sock.setblocking(False)
+		self.clients[sock] = Client(sock)
+		self.selector.register(sock, selectors.EVENT_READ)
+
+	def read_device(self):
+		try:
+			data = os.read(self.device, READ_SIZE)
+		except BlockingIOError:
+			return
+		except OSError:
+			data = b""
+		if not data:
+			# The board has gone away, so let supervisord restart us once it is back
+			sys.exit(1)
+		self.log.append(data)
+		for client in list(self.clients.values()):
+			if client.request in ("attach", "view"):
+				self.send(client, data)
+
+	def read_client(self, client):
+		try:
+			data = client.sock.recv(READ_SIZE)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			data = b""
+		if not data:
+			self.close(client)
+			return
+		if client.request is None:
+			client.incoming += data
+			if b"\n" not in client.incoming:
+				if len(client.incoming) > 1024:
+					self.close(client)
+				return
+			line, data = client.incoming.split(b"\n", 1)
+			self.start(client, line)
+		if client.request == "attach" and data:
+			vlabactivity.mark_used("serial")
+			try:
+				os.write(self.device, data)
+			except BlockingIOError:
+				# The UART is not keeping up with the user's typing
+				pass
+
+	def start(self, client, line):
+		try:
+			client.request, args = vlabserial.parse_request(line)
+		except ValueError as e:
+			self.send(client, "{}\n".format(e).encode(), close=True)
+			return
+		if client.request == "attach":
+			self.log.set_owner(args[0])
+		elif client.request == "tail":
+			if args[1] == self.log.owner:
+				self.send(client, self.log.tail(min(int(args[0]), vlabserial.MAX_HISTORY)), close=True)
+			else:
+				self.send(client, b"", close=True)
+
+	def send(self, client, data, close=False):
+		if len(client.outgoing) > self.log.buffer_size:
+			# A viewer which cannot keep up is dropped
+			self.close(client)
+			return
+		client.outgoing += data
+		client.closing = client.closing or close
+		self.write_client(client)
+
+	def write_client(self, client):
+		try:
+			sent = client.sock.send(client.outgoing) if client.outgoing else 0
+		except (BlockingIOError, InterruptedError):
+			sent = 0
+		except OSError:
+			self.close(client)
+			return
+		del client.outgoing[:sent]
+		if not client.outgoing and client.closing:
+			self.close(client)
+			return
+		events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outgoing else 0)
+		self.selector.modify(client.sock, events)
+
+	def close(self, client):
+		if self.clients.pop(client.sock, None) is not None:
+			self.selector.unregister(client.sock)
+			client.sock.close()
+
+
+while True:
+	try:
+		device = open_device(DEVICE)
+		break
+	except OSError as e:
+		print("Cannot open {}: {}. Retrying...".format(DEVICE, e))
+		time.sleep(5)
+
+Broker(device, vlabserial.SerialLog()).run()
@@ -1,40 +1,54 @@
+# Programs a board and runs an application on it, so that its serial output can be captured.
+# With no arguments, programs the hardware test design. Otherwise the arguments are:
+#   xsdb test.tcl <bitstream> <elf or -> <ps7_init.tcl> <time to wait for output in ms>
+if {$argc >= 4} {
+	lassign $argv bitfile elffile ps7init waitms
+} else {
+	set bitfile /vlab/test/test.bit
+	set elffile /vlab/test/test.elf
+	set ps7init /vlab/test/ps7_init.tcl
+	set waitms 5000
+}
+
 connect
 
 # Check if device is a Zynq (has APU)
 if {[targets -filter {name =~ "APU"}] ne ""} {
 	# Zynq: program bitstream + download ELF
-	puts "Programming test bitstream (Zynq)..."
+	puts "Programming bitstream (Zynq)..."
 	targets -set -filter {name =~ "APU"} -index 0
 	rst -system
 	after 500
 
 	# Program the PL
 	targets -set -filter {name =~ "xc7z*"}
-	fpga /vlab/test/test.bit
+	fpga $bitfile
 
-	# Initialise the PS (DDR, clocks, MIO)
-	targets -set -filter {name =~ "ARM*#0"}
-	rst -processor
-	after 500
-	source /vlab/test/ps7_init.tcl
-	ps7_init
-	after 500
-	ps7_post_config
-	after 500
+	if {$elffile ne "-"} {
+		# Initialise the PS (DDR, clocks, MIO)
+		targets -set -filter {name =~ "ARM*#0"}
+		rst -processor
+		after 500
+		source $ps7init
+		ps7_init
+		after 500
+		ps7_post_config
+		after 500
 
-	# Download and run the test ELF
-	dow /vlab/test/test.elf
-	con
+		# Download and run the ELF
+		dow $elffile
+		con
+	}
 
-	puts "Waiting for test application..."
-	after 5000
+	puts "Waiting for application..."
+	after $waitms
 } else {
 	# Non-Zynq: bitstream only
-	puts "Programming test bitstream..."
-	fpga /vlab/test/test.bit
+	puts "Programming bitstream..."
+	fpga $bitfile
 
-	puts "Waiting for test output..."
-	after 5000
+	puts "Waiting for output..."
+	after $waitms
 }
 
 disconnect
@@ -14,6 +14,11 @@ for f in *; do
 	fi
 done
 
+echo "Installing VLAB common Python libraries..."
+cp -v ../vlabcommon/vlabclient.py /opt/VLAB/
+cp -v ../vlabcommon/vlabmetrics.py /opt/VLAB/
+cp -v ../vlabcommon/vlabredis.py /opt/VLAB/
+
 echo "Setting permissions of log directory..."
 chown vlab:vlab /opt/VLAB/log
 
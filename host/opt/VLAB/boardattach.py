@@ -18,6 +18,8 @@ import socket
 import subprocess
 import sys
 import redis
+import vlabclient
+import vlabredis
 
 CONFIG_FILE = '/opt/VLAB/boardhost.conf'
 
@@ -60,9 +62,8 @@ except FileNotFoundError as e:
 	log.info("Cannot find config file `{}`; using default server ({}:{}).".format(CONFIG_FILE, redis_server, redis_port))
 
 try:
-	db = redis.Redis(host=redis_server, port=redis_port, db=0, decode_responses=True)
-	db.ping()
-except redis.exceptions.ConnectionError as e:
+	db = vlabclient.get_client(host=redis_server, port=redis_port)
+except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
 	log.critical("Error whilst connecting to host {}\n{}".format(redis_server, e))
 	sys.exit(4)
 
@@ -135,20 +136,9 @@ if db.get("vlab:knownboard:{}:reset".format(serial)) == "true":
 
 # Finally, we register our new board with the redis server ourselves as well
 
-# Set up our boardclass
-db.sadd("vlab:boardclasses", boardclass)
-db.sadd("vlab:boardclass:{}:boards".format(boardclass), serial)
-db.zadd("vlab:boardclass:{}:availableboards".format(boardclass), {serial: 0})
-db.zadd("vlab:boardclass:{}:unlockedboards".format(boardclass), {serial: 0})
-
-# Set up our board with details provided. Remove any locks and sessions.
-db.set("vlab:board:{}:user".format(serial), "root")
-db.set("vlab:board:{}:server".format(serial), socket.gethostname())
-db.set("vlab:board:{}:port".format(serial), host_port)
-db.delete("vlab:board:{}:lock:username".format(serial))
-db.delete("vlab:board:{}:lock:time".format(serial))
-db.delete("vlab:board:{}:session:username".format(serial))
-db.delete("vlab:board:{}:session:starttime".format(serial))
-db.delete("vlab:board:{}:session:pingtime".format(serial))
+# Set up our boardclass and our board with details provided, removing any locks and sessions.
+# This is a single script, so the board's back link to its boardclass is written along with the boardclass
+# membership, and its entries in the user and host session indexes are removed with its old session.
+vlabredis.attach_board(db, serial, boardclass, {"user": "root", "server": socket.gethostname(), "port": host_port})
 
 log.info("Board serial {} connected and registered.".format(serial))
@@ -12,6 +12,8 @@ import os
 import subprocess
 import sys
 import redis
+import vlabclient
+import vlabredis
 
 CONFIG_FILE = '/opt/VLAB/boardhost.conf'
 
@@ -58,31 +60,18 @@ except FileNotFoundError as e:
 	log.info("Cannot find config file `{}`; using default server ({}:{}).".format(CONFIG_FILE, redis_server, redis_port))
 
 try:
-	db = redis.Redis(host=redis_server, port=redis_port, db=0, decode_responses=True)
-	db.ping()
-except redis.exceptions.ConnectionError as e:
+	db = vlabclient.get_client(host=redis_server, port=redis_port)
+except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
 	log.critical("Error whilst connecting to host {}\n{}".format(redis_server, e))
 	sys.exit(1)
 
 # Check with the redis server to see if the serial number of the board is known
-# From the serial we learn its type (e.g. "a Digilent Zybo") and class (e.g. "EMBS Zybo", vs "research Zybo")
 if not db.sismember("vlab:knownboards", serial):
 	log.critical("Board with serial number {} is not in the VLAB database. Exiting.".format(serial))
 	sys.exit(1)
 
-boardtype = db.get("vlab:knownboard:{}:type".format(serial))
-boardclass = db.get("vlab:knownboard:{}:class".format(serial))
-
-db.srem("vlab:boardclass:{}:boards".format(boardclass), serial)
-db.zrem("vlab:boardclass:{}:availableboards".format(boardclass), serial)
-db.zrem("vlab:boardclass:{}:unlockedboards".format(boardclass), serial)
-db.delete("vlab:board:{}:user".format(serial))
-db.delete("vlab:board:{}:server".format(serial))
-db.delete("vlab:board:{}:port".format(serial))
-db.delete("vlab:board:{}:lock:username".format(serial))
-db.delete("vlab:board:{}:lock:time".format(serial))
-db.delete("vlab:board:{}:session:username".format(serial))
-db.delete("vlab:board:{}:session:starttime".format(serial))
-db.delete("vlab:board:{}:session:pingtime".format(serial))
+# Remove the board, its back link to the boardclass and its entries in the user and host session indexes in one
+# script
+vlabredis.remove_board(db, serial)
 
 log.info("Board serial {} detached and deregistered.".format(serial))
@@ -3,6 +3,9 @@
 """
 This script is invoked by shell.py on the relay to restart a board/container when a user is connecting.
 
+Once the container's sshd and hw_server are accepting connections it prints "VLABREADY:<port>" with the container's
+SSH port, or "VLABNOTREADY" if they are not ready within READY_TIMEOUT seconds. All other output is logged to stderr.
+
 Russell Joyce, 2017
 """
 
@@ -13,8 +16,10 @@ import socket
 import subprocess
 import sys
 import redis
+import vlabclient
 
 CONFIG_FILE = '/opt/VLAB/boardhost.conf'
+READY_TIMEOUT = 30
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s ; %(levelname)s ; %(name)s ; %(message)s')
 log = logging.getLogger(os.path.basename(sys.argv[0]))
@@ -50,9 +55,8 @@ except FileNotFoundError as e:
 	log.info("Cannot find config file `{}`; using default server ({}:{}).".format(CONFIG_FILE, redis_server, redis_port))
 
 try:
-	db = redis.Redis(host=redis_server, port=redis_port, db=0, decode_responses=True)
-	db.ping()
-except redis.exceptions.ConnectionError as e:
+	db = vlabclient.get_client(host=redis_server, port=redis_port)
+except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
 	log.critical("Error whilst connecting to host {}\n{}".format(redis_server, e))
 	sys.exit(1)
 
@@ -82,6 +86,16 @@ cmd = 'echo \\* \\* \\* \\* \\* root /usr/bin/python3 /vlab/register.py {} {} {}
 subprocess.check_output(['docker', 'exec', container_name, '/bin/sh', '-c', cmd])
 
 # Finally, update the port of the board on the redis server
-db.set("vlab:board:{}:port".format(serial), host_port)
+db.hset("vlab:board:{}".format(serial), "port", host_port)
+
+# Wait for the board server to accept connections
+try:
+	subprocess.run(['docker', 'exec', container_name, 'python3', '/vlab/ready.py', str(READY_TIMEOUT)],
+	               check=True, stdout=subprocess.DEVNULL, timeout=READY_TIMEOUT + 10)
+except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+	log.critical("Board serial {} not ready after restart. {}".format(serial, e))
+	print("VLABNOTREADY")
+	sys.exit(19)
 
 log.info("Board serial {} restarted successfully.".format(serial))
+print("VLABREADY:{}".format(host_port))
@@ -2,4 +2,5 @@
 
 LOGFILE=/opt/VLAB/log/boardrestart.log
 
-/opt/VLAB/boardrestart.py $1 >> $LOGFILE 2>&1
+# Only the readiness report on stdout is passed back to the relay
+/opt/VLAB/boardrestart.py $1 2>> $LOGFILE
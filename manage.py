@@ -27,8 +27,18 @@ def build_arg_parsers():
 	subparsers.add_parser('list', help='If the relay is running, list the currently available boards.')
 	subparsers.add_parser('status', help='Displays current status of the VLAB and available boards.')
 	subparsers.add_parser('stats', help='If the relay is running, parse the access log and display usage stats.')
+	traces_parser = subparsers.add_parser('traces', help='If the relay is running, summarise the time taken by each '
+	                                                     'phase of recent logins.')
+	traces_parser.add_argument('-n', '--count', nargs=1, help='Only summarise this many of the most recent logins')
+	traces_parser.add_argument('-u', '--user', nargs=1, help='Only summarise the logins of this user')
+	reservations_parser = subparsers.add_parser('reservations', help='If the relay is running, create, list or cancel '
+	                                                                 'reservations of boards for lab sessions.')
+	reservations_parser.add_argument('args', nargs=argparse.REMAINDER,
+	                                 help='"create", "list" or "cancel" and their arguments. Use "create -h" for help.')
 	subparsers.add_parser('hwtest', help='Trigger a hardware test run on all idle boards.')
 	subparsers.add_parser('hwteststate', help='Report whether a hardware test is queued or running.')
+	subparsers.add_parser('migrate', help='Convert a running relay\'s board keys to the per-board hash layout.')
+	subparsers.add_parser('reindex', help='Rebuild the relay\'s derived board indexes from the boardclass sets.')
 
 	start_parser = subparsers.add_parser('start', help='Restart the VLAB relay')
 	start_parser.add_argument('-p', '--port', nargs=1, default=["2222"],
@@ -156,6 +166,24 @@ def main():
 	elif args.mode == "stats":
 		os.system("docker exec vlab-relay-1 python3 /vlab/logparse.py")
 
+	elif args.mode == "traces":
+		cmd = ['docker', 'exec', 'vlab-relay-1', 'python3', '/vlab/tracestats.py']
+		if args.count is not None:
+			cmd.extend(['-n', args.count[0]])
+		if args.user is not None:
+			cmd.extend(['-u', args.user[0]])
+		subprocess.run(cmd)
+
+	elif args.mode == "reservations":
+		subprocess.run(['docker', 'exec', 'vlab-relay-1', 'python3', '/vlab/reservations.py'] + args.args)
+
+	elif args.mode == "migrate":
+		os.system("docker exec vlab-relay-1 python3 /vlab/migrateboards.py")
+		os.system("docker exec vlab-relay-1 python3 /vlab/reindex.py")
+
+	elif args.mode == "reindex":
+		os.system("docker exec vlab-relay-1 python3 /vlab/reindex.py")
+
 	elif args.mode == "hwtest":
 		result = subprocess.run(
 			['docker', 'exec', 'vlab-relay-1', 'python3', '-c',
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+The VLAB allocator daemon. Listens on a unix socket for board requests from the relay's login shell (shell.py),
+and performs the access checks and allocation for each one using a pooled redis connection and cached user ACLs.
+
+Each request is a single line of JSON, {"boardclass": ..., "serial": ...}, and is answered with a single line of
+JSON as returned by vlaballoc.allocate(), with the time taken by the access checks and the allocation added as
+"timings". The requesting user is taken from the socket's peer credentials rather than from the request.
+"""
+
+import json
+import logging
+import os
+import pwd
+import socket
+import socketserver
+import struct
+import sys
+import time
+import redis
+import vlabclient
+import vlaballoc
+
+logging.basicConfig(
+	filename='/vlab/log/relay.log', level=logging.INFO, format='%(asctime)s ; %(levelname)s ; %(name)s ; %(message)s')
+log = logging.getLogger(os.path.basename(sys.argv[0]))
+
+
+def peer_username(sock):
+	pid, uid, gid = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+	return pwd.getpwuid(uid).pw_name
+
+
+class AllocationHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		try:
+			username = peer_username(self.connection)
+			request = json.loads(self.rfile.readline())
+			boardclass = request["boardclass"]
+			serial = request.get("serial")
+			start = time.perf_counter()
+			access = self.server.access_cache.get(self.server.db, username)
+			checked = time.perf_counter()
+			result = vlaballoc.allocate(self.server.db, username, boardclass, serial, access)
+			# Let the login shell trace where the time went (see vlabtrace)
+			result["timings"] = {"acl": checked - start, "allocation": time.perf_counter() - checked}
+		except (KeyError, ValueError, TypeError) as e:
+			result = vlaballoc._error("Invalid allocation request: {}".format(e))
+		except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+			log.error("Redis error during allocation: {}".format(e))
+			result = vlaballoc._error("The VLAB database is unavailable. Please try again.")
+		self.wfile.write((json.dumps(result) + "\n").encode())
+
+
+class AllocatorServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, path, db):
+		self.db = db
+		self.access_cache = vlaballoc.AccessCache()
+		super().__init__(path, AllocationHandler)
+
+
+os.makedirs(os.path.dirname(vlaballoc.ALLOCATOR_SOCKET), exist_ok=True)
+if os.path.exists(vlaballoc.ALLOCATOR_SOCKET):
+	os.unlink(vlaballoc.ALLOCATOR_SOCKET)
+
+# Like setupusers.py we are started alongside the redis server, so allow extra connection retries
+try:
+	db = vlabclient.get_client(host='localhost', retries=6)
+except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as c:
+	log.critical("Cannot connect to the redis server. Aborting. {}".format(c))
+	sys.exit(6)
+
+server = AllocatorServer(vlaballoc.ALLOCATOR_SOCKET, db)
+# Any local user may connect, as the daemon identifies them from their credentials
+os.chmod(vlaballoc.ALLOCATOR_SOCKET, 0o666)
+log.info("Allocator listening on {}".format(vlaballoc.ALLOCATOR_SOCKET))
+server.serve_forever()
@@ -5,11 +5,25 @@ Iterate over all boards in the VLAB. For any board which exists but isn't availa
 a valid lock. If it does, check that the lock has not expired. In any other case, forcibly
 unlock the board. It is intended this is run periodically on the VLAB relay server.
 
+Expired locks and sessions are found from the per-class "locktimes" and "pingtimes" indexes, so without -v only
+the boards which need attention are read individually. Relay port leases which have not been renewed are then
+returned to the free pool, and reservations which have ended are deleted.
+
 Then ping all boards to ensure that we can make an SSH connection to them. Remove any we cannot.
 
+With -d, the checks are run by a long-lived reconciler, started by supervisord, which recovers sessions and locks
+every LOCK_CHECK_INTERVAL seconds and checks the board servers every SSH_CHECK_INTERVAL seconds (see vlabreconciler).
+It also watches for the web dashboard's hardware test trigger, and finishes its current check and exits on SIGTERM
+or SIGINT. Without -d the checks are run once. Either way only one instance runs at a time: a second one waits (with
+-d) or exits.
+
 Options:
 -v   Verbose: Print out the names of the boards as they are being checked
 -s   Check connections: Attempt to ping each available boardserver to ensure it is still operational
+--ssh-timeout, --ssh-attempts   How long to wait for each connection, and how many times to try boardservers which
+                                cannot be reached, before they are removed
+-d   Daemon: Keep running, repeating each check on its own interval
+--lock-interval, --ssh-interval   The intervals, in seconds, of the two checks when run with -d
 
 Regardless of provided options, if a board is found "half locked" or that has been locked for too long, it
 will be freed.
@@ -21,28 +35,30 @@ Ian Gray, 2016
 
 import argparse
 import os
+import signal
 import socket
+import subprocess
+import threading
+import time
+import redis
+import vlabcleanup
+import vlabreconciler
+import vlabssh
 from vlabredis import *
 
 parser = argparse.ArgumentParser(description="VLAB board test script")
 parser.add_argument('-s', action="store_true", default=False, dest='ssh_to_boards')
 parser.add_argument('-k', action="store_true", default=True, dest='check_locks')
 parser.add_argument('-v', action="store_true", default=False, dest='verbose')
+parser.add_argument('-d', action="store_true", default=False, dest='daemon')
+parser.add_argument('--lock-interval', type=int, default=vlabreconciler.LOCK_CHECK_INTERVAL, dest='lock_interval')
+parser.add_argument('--ssh-interval', type=int, default=vlabreconciler.SSH_CHECK_INTERVAL, dest='ssh_interval')
+parser.add_argument('--ssh-timeout', type=float, default=vlabssh.PROBE_TIMEOUT, dest='ssh_timeout')
+parser.add_argument('--ssh-attempts', type=int, default=vlabssh.PROBE_ATTEMPTS, dest='ssh_attempts')
 parsed = parser.parse_args()
 
-PING_TIMEOUT = 30
-KEYS_DIR = "/vlab/keys/"
-
-
-def check_ssh_connection(hostname, port):
-	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	try:
-		s.connect((hostname, int(port)))
-		rv = True
-	except socket.error:
-		rv = False
-	s.close()
-	return rv
+# How often, in seconds, the reconciler looks for the web dashboard's hardware test trigger
+TRIGGER_POLL_INTERVAL = 5
 
 
 def log(s, v):
@@ -51,14 +67,10 @@ def log(s, v):
 
 
 def reset_board(db, board, server, port):
+	# Boards which have not been used since their last reset are left alone (see vlabactivity)
 	try:
-		if db.get("vlab:knownboard:{}:reset".format(board)) == "true":
-			cmd = "/opt/xsct/bin/xsdb /vlab/reset.tcl"
-			target = "root@{}".format(server)
-			keyfile = "{}{}".format(KEYS_DIR, "id_rsa")
-			ssh_cmd = "ssh -o \"StrictHostKeyChecking no\" -i {} -p {} {} \"{}\"" \
-				.format(keyfile, port, target, cmd)
-			os.system(ssh_cmd)
+		if not vlabcleanup.reset_board(db, board, server, port, attempts=1):
+			log("Could not reset board {}".format(board), False)
 	except Exception as e:
 		log("Exception {} when resetting board {}".format(e, board), False)
 
@@ -71,125 +83,253 @@ def check_sessions(db):
 			log("\tBoardclass currently being locked by a user, waiting for 1 second...", True)
 			time.sleep(1)
 
-		for b in db.smembers("vlab:boardclass:{}:boards".format(bc)):
-			log("\tBoard: {}".format(b), True)
-
-			# Skip boards currently under hardware test
-			if db.get("vlab:board:{}:hwtest:testing".format(b)) is not None:
-				log("\t\tBoard under hardware test, skipping", True)
-				continue
-
-			bd = get_board_details(db, b, ["server", "port"])
-			server = bd["server"]
-			port = bd["port"]
-			log("\t\tServer: {}:{}".format(server, port), True)
-
-			board_available_since = db.zscore("vlab:boardclass:{}:availableboards".format(bc), b)
-
-			if board_available_since is None:
-				# Board is not in available list
-				session_username = db.get("vlab:board:{}:session:username".format(b))
-				session_start_time = db.get("vlab:board:{}:session:starttime".format(b))
-				session_ping_time = db.get("vlab:board:{}:session:pingtime".format(b))
-
-				if session_username is None or session_start_time is None or session_ping_time is None:
-					# Don't recover boards that failed hardware test
-					if db.get("vlab:board:{}:hwtest:status".format(b)) == "fail":
-						log("\t\tBoard {} failed hardware test, not recovering to available pool".format(b), True)
-					else:
-						# Board is not marked as available, but also does not have a valid session
-						log("Board {} marked as in-use but has no session info. Setting as available.".format(b), False)
-						reset_board(db, b, server, port)
-						# Restart the board server container to ensure any sessions are killed
-						target = "vlab@{}".format(server)
-						keyfile = "{}{}".format(KEYS_DIR, "id_rsa")
-						cmd = "/opt/VLAB/boardrestart.sh {}".format(b)
-						ssh_cmd = "ssh -q -o \"StrictHostKeyChecking no\" -e none -i {} {} \"{}\"".format(keyfile, target, cmd)
-						print("Restarting target container...")
-						os.system(ssh_cmd)
-						unlock_board(db, b, bc)
-						end_session(db, b, bc)
-				else:
-					# Check if session is still active
-					log("\t\tIn use by {} since {} (last ping at {})."
-					    .format(session_username, session_start_time, session_ping_time), True)
-					current_time = int(time.time())
-					if current_time - int(session_ping_time) > PING_TIMEOUT:
-						log("Board {} ping timed out. Set as available and unlocked.".format(b), False)
-						reset_board(db, b, server, port)
-						unlock_board(db, b, bc)
-						end_session(db, b, bc)
-
-			board_unlocked_since = db.zscore("vlab:boardclass:{}:unlockedboards".format(bc), b)
-
-			if board_unlocked_since is None:
-				# Board is not in unlocked list
-				lock_username = db.get("vlab:board:{}:lock:username".format(b))
-				lock_time = db.get("vlab:board:{}:lock:time".format(b))
-
-				if lock_username is None or lock_time is None:
-					# Don't recover boards that failed hardware test
-					if db.get("vlab:board:{}:hwtest:status".format(b)) == "fail":
-						log("\t\tBoard {} failed hardware test, not recovering to unlocked pool".format(b), True)
-					else:
-						# Board is not marked as unlocked, but also does not have a valid lock
-						log("Board {} marked as locked but has no lock info. Setting as unlocked.".format(b), False)
-						reset_board(db, b, server, port)
-						unlock_board(db, b, bc)
-				else:
-					# Check if lock is still active
-					log("\t\tLocked by {} at {} until {}.".format(lock_username, lock_time, int(lock_time) + MAX_LOCK_TIME), True)
-					current_time = int(time.time())
-					if current_time - int(lock_time) > MAX_LOCK_TIME:
-						log("Board {} lock timed out. Forced release.".format(b), False)
-						unlock_board(db, b, bc)
-
-			board_available_since = db.zscore("vlab:boardclass:{}:availableboards".format(bc), b)
-			board_unlocked_since = db.zscore("vlab:boardclass:{}:unlockedboards".format(bc), b)
-			if board_available_since is not None:
-				log("\t\tAvailable since {}".format(int(board_available_since)), True)
-			elif board_unlocked_since is not None:
-				log("\t\tIn use, but unlocked since {}".format(int(board_unlocked_since)), True)
+		# Take a consistent snapshot of the class, then only look at the boards which might need recovering:
+		# those with a stale ping or an expired lock, and those which are neither available nor in a session, or
+		# neither unlocked nor locked. Every board is still reported in verbose mode.
+		current_time = int(time.time())
+		with db.pipeline() as pipe:
+			pipe.smembers("vlab:boardclass:{}:boards".format(bc))
+			pipe.zrange("vlab:boardclass:{}:availableboards".format(bc), 0, -1)
+			pipe.zrange("vlab:boardclass:{}:unlockedboards".format(bc), 0, -1)
+			pipe.zrange("vlab:boardclass:{}:pingtimes".format(bc), 0, -1)
+			pipe.zrange("vlab:boardclass:{}:locktimes".format(bc), 0, -1)
+			boards, available, unlocked, in_session, locked = [set(r) for r in pipe.execute()]
+		stale = set(get_stale_sessions(db, bc, PING_TIMEOUT, current_time))
+		expired = set(get_expired_locks(db, bc, current_time))
+		suspect = (boards - available - in_session) | (boards - unlocked - locked) | stale | expired
+
+		for b in sorted(boards):
+			if b in suspect or parsed.verbose:
+				check_board(db, bc, b)
+
+		# Boards which became allocatable without being freed, such as those with expired locks, go to any waiting users
+		served = serve_waiters(db, bc)
+		if served > 0:
+			log("Handed {} board(s) of class {} to waiting users.".format(served, bc), False)
+
+
+def check_board(db, bc, b):
+	log("\tBoard: {}".format(b), True)
+
+	# Skip boards currently under hardware test
+	if db.get("vlab:board:{}:hwtest:testing".format(b)) is not None:
+		log("\t\tBoard under hardware test, skipping", True)
+		return
+
+	record = get_board_record(db, b, ["server", "port"])
+	server = record["server"]
+	port = record["port"]
+	log("\t\tServer: {}:{}".format(server, port), True)
+
+	board_available_since = db.zscore("vlab:boardclass:{}:availableboards".format(bc), b)
+
+	if board_available_since is None:
+		# Board is not in available list
+		session_username = record.get("session:username")
+		session_start_time = record.get("session:starttime")
+		session_ping_time = record.get("session:pingtime")
+
+		if session_username is None or session_start_time is None or session_ping_time is None:
+			# Don't recover boards that failed hardware test
+			if record.get("hwtest:status") == "fail":
+				log("\t\tBoard {} failed hardware test, not recovering to available pool".format(b), True)
+			else:
+				# Board is not marked as available, but also does not have a valid session
+				log("Board {} marked as in-use but has no session info. Setting as available.".format(b), False)
+				reset_board(db, b, server, port)
+				# Restart the board server container to ensure any sessions are killed
+				target = "vlab@{}".format(server)
+				cmd = "/opt/VLAB/boardrestart.sh {}".format(b)
+				print("Restarting target container...")
+				os.system(vlabssh.ssh_command(target, cmd, options=["-e", "none"]))
+				unlock_board(db, b, bc)
+				end_session(db, b, bc)
+		else:
+			# Check if session is still active
+			log("\t\tIn use by {} since {} (last ping at {})."
+			    .format(session_username, session_start_time, session_ping_time), True)
+			current_time = int(time.time())
+			if current_time - int(session_ping_time) > PING_TIMEOUT:
+				log("Board {} ping timed out. Set as available and unlocked.".format(b), False)
+				reset_board(db, b, server, port)
+				unlock_board(db, b, bc)
+				end_session(db, b, bc)
+
+	board_unlocked_since = db.zscore("vlab:boardclass:{}:unlockedboards".format(bc), b)
+
+	if board_unlocked_since is None:
+		# Board is not in unlocked list
+		lock_username = record.get("lock:username")
+		lock_time = record.get("lock:time")
+
+		if lock_username is None or lock_time is None:
+			# Don't recover boards that failed hardware test
+			if record.get("hwtest:status") == "fail":
+				log("\t\tBoard {} failed hardware test, not recovering to unlocked pool".format(b), True)
+			else:
+				# Board is not marked as unlocked, but also does not have a valid lock
+				log("Board {} marked as locked but has no lock info. Setting as unlocked.".format(b), False)
+				reset_board(db, b, server, port)
+				unlock_board(db, b, bc)
+		else:
+			# Check if lock is still active
+			log("\t\tLocked by {} at {} until {}.".format(lock_username, lock_time, int(lock_time) + MAX_LOCK_TIME), True)
+			current_time = int(time.time())
+			if current_time - int(lock_time) > MAX_LOCK_TIME:
+				log("Board {} lock timed out. Forced release.".format(b), False)
+				unlock_board(db, b, bc)
+
+	board_available_since = db.zscore("vlab:boardclass:{}:availableboards".format(bc), b)
+	board_unlocked_since = db.zscore("vlab:boardclass:{}:unlockedboards".format(bc), b)
+	if board_available_since is not None:
+		log("\t\tAvailable since {}".format(int(board_available_since)), True)
+	elif board_unlocked_since is not None:
+		log("\t\tIn use, but unlocked since {}".format(int(board_unlocked_since)), True)
 
 
 def check_ssh_to_boards(db):
+	# Probe every board server at once, so that hosts which are down do not hold up the others
+	boards = {}
 	for bc in db.smembers("vlab:boardclasses"):
 		for board in db.smembers("vlab:boardclass:{}:boards".format(bc)):
 			details = get_board_details(db, board, ['server', 'port'])
-			server = details['server']
-			port = details['port']
-			if not check_ssh_connection(server, port):
-				log("Board {} on {}:{} failed SSH connection. Waiting 3 seconds and checking again..."
-				    .format(board, server, port), False)
-				time.sleep(3.0)
-				details = get_board_details(db, board, ['server', 'port'])
-				server = details['server']
-				port = details['port']
-				if not check_ssh_connection(server, port):
-					log("Board {} on {}:{} failed SSH connection. Removing from database."
-					    .format(board, server, port), False)
-					remove_board(db, board)
-				else:
-					log("Board {} on {}:{} connection OK.".format(board, server, port), True)
+			boards[board] = (details['server'], details['port'])
+	results = vlabssh.probe(boards.values(), timeout=parsed.ssh_timeout, attempts=parsed.ssh_attempts)
+
+	for board, (server, port) in sorted(boards.items()):
+		if results[(server, port)]:
+			log("Board {} on {}:{} connection OK.".format(board, server, port), True)
+			continue
+		# Leave boards which have gone or re-registered elsewhere while they were being probed
+		record = get_board_record(db, board)
+		if not record:
+			continue
+		if (record.get('server'), record.get('port')) != (server, port):
+			log("Board {} failed SSH connection on {}:{} but has moved to {}:{}. Leaving it."
+			    .format(board, server, port, record.get('server'), record.get('port')), False)
+			continue
+		log("Board {} on {}:{} failed SSH connection {} time(s). Removing from database."
+		    .format(board, server, port, parsed.ssh_attempts), False)
+		remove_board(db, board)
+
+
+def check_locks(db):
+	expired = expire_reservations(db)
+	if expired > 0:
+		log("Deleted {} ended reservation(s).".format(expired), False)
+	check_sessions(db)
+	reclaimed = reclaim_stale_ports(db)
+	if reclaimed > 0:
+		log("Reclaimed {} stale relay port lease(s).".format(reclaimed), False)
+
+
+def check_connections(db):
+	log("Checking SSH connections", True)
+	check_ssh_to_boards(db)
+
+
+def check_hwtest_trigger(db):
+	# Check for a dashboard-triggered test run
+	if db.get("vlab:hwtest:trigger"):
+		db.delete("vlab:hwtest:trigger")
+		if db.get("vlab:hwtest:running"):
+			log("HW test trigger received but test already running, ignoring", False)
+		else:
+			log("HW test trigger received, spawning testboards.py", False)
+			subprocess.Popen(["python3", "/vlab/testboards.py"])
+
+
+def run_check(db, name, check):
+	start = time.monotonic()
+	try:
+		check(db)
+	except redis.exceptions.RedisError as e:
+		log("Redis error during the {} check: {}".format(name, e), False)
+	duration = time.monotonic() - start
+	log("The {} check took {:.1f}s".format(name, duration), True)
+	try:
+		vlabreconciler.record_cycle(db, name, duration)
+	except redis.exceptions.RedisError as e:
+		log("Redis error recording the {} check: {}".format(name, e), False)
+
+
+def hold_claim(db, token, claimed, stopping):
+	# Renew the claim often enough that a long check never lets it expire
+	waiting = False
+	while not stopping.is_set():
+		try:
+			if vlabreconciler.claim(db, token):
+				claimed.set()
+				waiting = False
 			else:
-				log("Board {} on {}:{} connection OK.".format(board, server, port), True)
+				claimed.clear()
+				if not waiting:
+					log("Another reconciler ({}) is running, waiting".format(vlabreconciler.holder(db)), False)
+					waiting = True
+		except redis.exceptions.RedisError as e:
+			log("Redis error renewing the reconciler's claim: {}".format(e), False)
+		stopping.wait(vlabreconciler.RECONCILER_TTL / 3)
+
+
+def reconcile(db, checks, token):
+	"""
+	Run each of 'checks', a list of (name, function, interval), every 'interval' seconds until SIGTERM or SIGINT.
+	"""
+	stopping = threading.Event()
+	claimed = threading.Event()
+	signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+	signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+	threading.Thread(target=hold_claim, args=(db, token, claimed, stopping), daemon=True).start()
+
+	log("Reconciler started", False)
+	next_run = {name: 0 for name, _, _ in checks}
+	while not stopping.is_set():
+		if not claimed.wait(vlabreconciler.RECONCILER_TTL / 3):
+			continue
+		for name, check, interval in checks:
+			if stopping.is_set() or not claimed.is_set():
+				break
+			now = time.monotonic()
+			if now >= next_run[name]:
+				# Keep to the schedule, unless a check overran its interval
+				next_run[name] = max(next_run[name] + interval, now)
+				run_check(db, name, check)
+		try:
+			check_hwtest_trigger(db)
+		except redis.exceptions.RedisError as e:
+			log("Redis error checking the HW test trigger: {}".format(e), False)
+		now = time.monotonic()
+		stopping.wait(max(0, min([TRIGGER_POLL_INTERVAL] + [t - now for t in next_run.values()])))
+
+	try:
+		vlabreconciler.release(db, token)
+	except redis.exceptions.RedisError:
+		pass
+	log("Reconciler stopped", False)
 
 
 redis_db = connect_to_redis('localhost')
+claim_token = "{}:{}".format(socket.gethostname(), os.getpid())
 
+check_list = []
 if parsed.check_locks:
-	check_sessions(redis_db)
-
+	check_list.append(("locks", check_locks, parsed.lock_interval))
 if parsed.ssh_to_boards:
-	log("Checking SSH connections", True)
-
-# Check for a dashboard-triggered test run
-if redis_db.get("vlab:hwtest:trigger"):
-	redis_db.delete("vlab:hwtest:trigger")
-	if redis_db.get("vlab:hwtest:running"):
-		log("HW test trigger received but test already running, ignoring", False)
-	else:
-		log("HW test trigger received, spawning testboards.py", False)
-		import subprocess
-		subprocess.Popen(["python3", "/vlab/testboards.py"])
-	check_ssh_to_boards(redis_db)
+	check_list.append(("ssh", check_connections, parsed.ssh_interval))
+
+if parsed.daemon:
+	reconcile(redis_db, check_list, claim_token)
+	sys.exit(0)
+
+if not vlabreconciler.claim(redis_db, claim_token):
+	log("Another reconciler ({}) is running, exiting".format(vlabreconciler.holder(redis_db)), False)
+	sys.exit(0)
+done = threading.Event()
+threading.Thread(target=hold_claim, args=(redis_db, claim_token, threading.Event(), done), daemon=True).start()
+try:
+	for check_name, check_function, _ in check_list:
+		run_check(redis_db, check_name, check_function)
+	check_hwtest_trigger(redis_db)
+finally:
+	done.set()
+	vlabreconciler.release(redis_db, claim_token)
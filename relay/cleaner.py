@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""
+The VLAB cleanup worker daemon. Resets and releases the boards queued by the relay's login shell when their users
+disconnect (see vlabcleanup), up to CLEANUP_THREADS boards at a time, so that users do not wait for their board to be
+reset and boards rejoin the available pool as soon as their reset completes.
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import redis
+import vlabclient
+import vlabcleanup
+
+logging.basicConfig(
+	filename='/vlab/log/relay.log', level=logging.INFO, format='%(asctime)s ; %(levelname)s ; %(name)s ; %(message)s')
+log = logging.getLogger(os.path.basename(sys.argv[0]))
+
+CLEANUP_THREADS = 8
+
+
+def clean(db, raw_task, slots):
+	try:
+		task = json.loads(raw_task)
+		reset, released, ended = vlabcleanup.cleanup_board(db, task)
+		if reset is False:
+			log.error("RESETFAILED: {}:{}".format(task["boardclass"], task["board"]))
+		if not ended:
+			log.warning("NOTENDED: {}, {}:{} was already released".format(task["user"], task["boardclass"], task["board"]))
+		log.info("CLEANED: {}:{} after {:.1f}s".format(task["boardclass"], task["board"], time.time() - task["queued"]))
+		vlabcleanup.finish_cleanup(db, raw_task)
+	except (ValueError, KeyError) as e:
+		log.error("Invalid cleanup task {}: {}".format(raw_task, e))
+		vlabcleanup.finish_cleanup(db, raw_task)
+	except redis.exceptions.RedisError as e:
+		# Left on the processing list, to be retried when the worker restarts
+		log.error("Redis error cleaning up {}: {}".format(raw_task, e))
+	finally:
+		slots.release()
+
+
+def heartbeat(db):
+	while True:
+		try:
+			db.set(vlabcleanup.CLEANUP_WORKER_KEY, os.getpid(), ex=vlabcleanup.CLEANUP_WORKER_TTL)
+		except redis.exceptions.RedisError as e:
+			log.error("Redis error in heartbeat: {}".format(e))
+		time.sleep(vlabcleanup.CLEANUP_WORKER_TTL / 3)
+
+
+try:
+	db = vlabclient.get_client(host='localhost', retries=6)
+except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as c:
+	log.critical("Cannot connect to the redis server. Aborting. {}".format(c))
+	sys.exit(6)
+
+requeued = vlabcleanup.requeue_unfinished(db)
+if requeued > 0:
+	log.info("Requeued {} unfinished cleanups".format(requeued))
+threading.Thread(target=heartbeat, args=(db,), daemon=True).start()
+
+# Only take a board from the queue when there is a thread free to clean it, so that the rest stay queued
+slots = threading.Semaphore(CLEANUP_THREADS)
+with ThreadPoolExecutor(max_workers=CLEANUP_THREADS) as executor:
+	while True:
+		slots.acquire()
+		try:
+			raw_task = vlabcleanup.take_cleanup(db, vlabclient.BLOCK_TIMEOUT)
+		except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+			log.error("Redis error taking a cleanup: {}".format(e))
+			raw_task = None
+			time.sleep(1)
+		if raw_task is None:
+			slots.release()
+			continue
+		executor.submit(clean, db, raw_task, slots)
@@ -29,14 +29,14 @@ if restore:
     now = int(time.time())
     db.zadd("vlab:boardclass:{}:availableboards".format(bc), {serial: now})
     db.zadd("vlab:boardclass:{}:unlockedboards".format(bc), {serial: now})
-    db.delete("vlab:board:{}:hwtest:status".format(serial))
-    db.delete("vlab:board:{}:hwtest:time".format(serial))
-    db.delete("vlab:board:{}:hwtest:message".format(serial))
+    db.hdel("vlab:board:{}".format(serial), "hwtest:status", "hwtest:time", "hwtest:message")
     print("Board {} restored to both pools, hwtest keys cleared".format(serial))
 else:
     db.zrem("vlab:boardclass:{}:availableboards".format(bc), serial)
     db.zrem("vlab:boardclass:{}:unlockedboards".format(bc), serial)
-    db.set("vlab:board:{}:hwtest:status".format(serial), "fail")
-    db.set("vlab:board:{}:hwtest:time".format(serial), int(time.time()))
-    db.set("vlab:board:{}:hwtest:message".format(serial), "Fake failure injected by fakefail.py")
+    db.hset("vlab:board:{}".format(serial), mapping={
+        "hwtest:status": "fail",
+        "hwtest:time": int(time.time()),
+        "hwtest:message": "Fake failure injected by fakefail.py",
+    })
     print("Board {} marked as failed and removed from pools".format(serial))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+The VLAB batch job runner daemon. Runs the jobs submitted through the relay's login shell (see vlabjobs) on idle
+boards, so that short program-and-capture runs do not each need an interactive session on a board of their own.
+
+Every POLL_INTERVAL seconds, each board class with queued jobs is given as many idle boards as it has jobs. Boards
+are only taken from the available pool, and never while interactive users are queued for the class or the boards
+are held back for a reservation, so batch jobs only use boards that nobody else wants. Each board is held in a
+session by "batch:<user>" while its job runs in its own thread, and is reset and released as soon as the job ends.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+import redis
+import vlabclient
+import vlabcleanup
+import vlabjobs
+from vlabredis import *
+
+logging.basicConfig(
+	filename='/vlab/log/relay.log', level=logging.INFO, format='%(asctime)s ; %(levelname)s ; %(name)s ; %(message)s')
+log = logging.getLogger(os.path.basename(sys.argv[0]))
+
+POLL_INTERVAL = 5
+
+
+def heartbeat(db, board, username, start_time, done):
+	while not done.wait(HEARTBEAT_INTERVAL):
+		ping_session_if_user_time(db, board, username, start_time)
+
+
+def run(db, job, board, boardclass, username, start_time):
+	"""
+	Run 'job' on 'board', which has been allocated to 'username' at 'start_time', then reset and release the board.
+	"""
+	done = threading.Event()
+	threading.Thread(target=heartbeat, args=(db, board, username, start_time, done), daemon=True).start()
+	try:
+		server, port = db.hmget("vlab:board:{}".format(board), ["server", "port"])
+		if None in (server, port):
+			raise ValueError("board {} is missing its connection details".format(board))
+		log.info("JOBSTART: {}, {}:{}, {}".format(job["user"], boardclass, board, job["id"]))
+		ok, output, message = vlabjobs.run_job(job, server, port)
+		vlabcleanup.reset_board(db, board, server, port, attempts=1, always=True)
+	except Exception as e:
+		ok, output, message = False, "", "The job could not be run: {}".format(e)
+	finally:
+		done.set()
+		unlock_board_if_user_time(db, board, boardclass, username, start_time)
+		end_session_if_user_time(db, board, boardclass, username, start_time)
+
+	db.hset("vlab:job:{}".format(job["id"]), "board", board)
+	vlabjobs.finish_job(db, job["id"], "done" if ok else "failed", output, message)
+	log.info("JOBEND: {}, {}:{}, {}, {}".format(job["user"], boardclass, board, job["id"], "done" if ok else "failed"))
+
+
+def dispatch(db):
+	"""
+	Start the queued jobs of every board class for which there are idle boards.
+	"""
+	for boardclass in db.smembers("vlab:boardclasses"):
+		queue = "vlab:boardclass:{}:jobs".format(boardclass)
+		while True:
+			job_id = db.lindex(queue, 0)
+			if job_id is None:
+				break
+			user = db.hget("vlab:job:{}".format(job_id), "user")
+			if user is None:
+				# The job has expired
+				db.lrem(queue, 1, job_id)
+				continue
+			username = vlabjobs.BATCH_USER_PREFIX + user
+			start_time = int(time.time())
+			board, pool = allocate_board_and_start_session(db, boardclass, username, start_time, idle_only=True)
+			if board is None:
+				break
+			# We are the only consumer of the queue, so this is the job we looked at
+			job = vlabjobs.take_job(db, boardclass)
+			threading.Thread(target=run, args=(db, job, board, boardclass, username, start_time), daemon=True).start()
+
+
+try:
+	db = vlabclient.get_client(host='localhost', retries=6)
+except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as c:
+	log.critical("Cannot connect to the redis server. Aborting. {}".format(c))
+	sys.exit(6)
+
+log.info("Job runner started")
+while True:
+	try:
+		dispatch(db)
+	except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+		log.error("Redis error while dispatching jobs: {}".format(e))
+	time.sleep(POLL_INTERVAL)
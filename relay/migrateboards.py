@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+"""
+One-shot migration of a live VLAB keyspace from the old per-field board keys
+("vlab:board:<serial>:server", "vlab:board:<serial>:lock:username", ...) to a
+single hash per board ("vlab:board:<serial>").
+
+It is safe to run more than once; keys that have already been converted are skipped.
+
+Options:
+-n   Dry run: report how many keys would be converted without changing anything
+"""
+
+import argparse
+from vlabredis import *
+
+parser = argparse.ArgumentParser(description="VLAB board key migration script")
+parser.add_argument('-n', action="store_true", default=False, dest='dry_run')
+parsed = parser.parse_args()
+
+db = connect_to_redis('localhost')
+
+count = migrate_legacy_board_keys(db, dry_run=parsed.dry_run)
+if parsed.dry_run:
+	print("{} legacy board keys would be converted.".format(count))
+else:
+	print("{} legacy board keys converted to board hashes.".format(count))
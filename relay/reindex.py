@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+"""
+Rebuild the derived indexes in the VLAB redis database from the authoritative boardclass membership sets.
+This rewrites the boardclass back link stored in each board's hash, the per-user index of held boards, and the
+per-class indexes of lock and session ping times, and the per-host index of boards in a session.
+
+It is safe to run at any time, including while the relay is in use.
+"""
+
+from vlabredis import *
+
+db = connect_to_redis('localhost')
+
+count = rebuild_boardclass_index(db)
+print("{} board boardclass links corrected.".format(count))
+count = rebuild_user_index(db)
+print("{} user board index entries corrected.".format(count))
+count = rebuild_time_index(db)
+print("{} lock and session times indexed.".format(count))
+count = rebuild_host_index(db)
+print("{} boards in a session indexed by host.".format(count))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""
+Create, list and cancel reservations of boards for scheduled lab sessions.
+
+A reservation holds back a number of boards of a board class for a list of users, or for a cohort of users named in
+the "cohorts" section of vlab.conf. From its start time until each user has claimed a board by logging in, or until
+its claim deadline, those boards are not allocated to anybody else. Unclaimed boards are then released.
+
+Usage:
+reservations.py create <boardclass> <count> <start> <duration> (-u user [user ...] | -c cohort) [-d minutes]
+    <start> is given as "YYYY-MM-DD HH:MM" in local time and <duration> in minutes. -d sets how many minutes after
+    the start unclaimed boards are released (15 by default).
+reservations.py list [-b boardclass]
+reservations.py cancel <id>
+"""
+
+import argparse
+import datetime
+import logging
+import vlabconfig
+from vlabredis import *
+
+CONFIG_FILE = '/vlab/vlab.conf'
+
+parser = argparse.ArgumentParser(description="VLAB board reservations")
+subparsers = parser.add_subparsers(dest='mode')
+create_parser = subparsers.add_parser('create', help='Reserve boards for a lab session')
+create_parser.add_argument('boardclass')
+create_parser.add_argument('count', type=int)
+create_parser.add_argument('start', help='Start time, as "YYYY-MM-DD HH:MM" in local time')
+create_parser.add_argument('duration', type=int, help='Length of the session in minutes')
+holders = create_parser.add_mutually_exclusive_group(required=True)
+holders.add_argument('-u', '--users', nargs='+', help='The users the boards are reserved for')
+holders.add_argument('-c', '--cohort', help='The cohort in vlab.conf the boards are reserved for')
+create_parser.add_argument('-d', '--deadline', type=int, default=int(RESERVATION_CLAIM_TIME / 60),
+                           help='Release unclaimed boards this many minutes after the start')
+list_parser = subparsers.add_parser('list', help='List reservations')
+list_parser.add_argument('-b', '--boardclass', default=None)
+cancel_parser = subparsers.add_parser('cancel', help='Cancel a reservation')
+cancel_parser.add_argument('id')
+parsed = parser.parse_args()
+
+
+def format_time(t):
+	return time.strftime("%Y-%m-%d %H:%M %Z", time.localtime(t))
+
+
+db = connect_to_redis('localhost')
+
+if parsed.mode == "create":
+	try:
+		start = int(datetime.datetime.strptime(parsed.start, "%Y-%m-%d %H:%M").timestamp())
+	except ValueError:
+		print("Start time should be of the form \"YYYY-MM-DD HH:MM\".")
+		sys.exit(1)
+	if parsed.count < 1 or parsed.duration < 1 or parsed.deadline < 0:
+		print("The count, duration and deadline must be positive.")
+		sys.exit(1)
+
+	if parsed.cohort is not None:
+		config = vlabconfig.open_log(logging.getLogger(), CONFIG_FILE)
+		if config is None:
+			print("Could not read {}.".format(CONFIG_FILE))
+			sys.exit(1)
+		if parsed.cohort not in config.get('cohorts', {}):
+			print("Cohort {} is not defined in {}.".format(parsed.cohort, CONFIG_FILE))
+			sys.exit(1)
+		users = config['cohorts'][parsed.cohort]
+	else:
+		users = parsed.users
+	for user in users:
+		if not db.sismember("vlab:users", user):
+			print("Warning: {} is not a VLAB user.".format(user))
+	if not users:
+		print("No users to reserve boards for.")
+		sys.exit(1)
+
+	if parsed.count > len(set(users)):
+		print("Warning: {} boards reserved for {} users. Only {} boards will be held back."
+		      .format(parsed.count, len(set(users)), len(set(users))))
+
+	check_in_set(db, "vlab:boardclasses", parsed.boardclass, "Board class {} does not exist.".format(parsed.boardclass))
+	size = db.scard("vlab:boardclass:{}:boards".format(parsed.boardclass))
+	if parsed.count > size:
+		print("Warning: only {} boards of class {} are currently attached.".format(size, parsed.boardclass))
+
+	end = start + parsed.duration * 60
+	reservation_id = create_reservation(db, parsed.boardclass, parsed.count, start, end, users,
+	                                    min(start + parsed.deadline * 60, end))
+	print("Reservation {} created: {} boards of class {} for {} users from {} to {}."
+	      .format(reservation_id, parsed.count, parsed.boardclass, len(users), format_time(start), format_time(end)))
+
+elif parsed.mode == "list":
+	reservations = get_reservations(db, parsed.boardclass)
+	if not reservations:
+		print("No reservations.")
+	for r in reservations:
+		print("{}: {} boards of class {} from {} to {}, unclaimed boards released at {}"
+		      .format(r["id"], r["count"], r["boardclass"], format_time(r["start"]), format_time(r["end"]),
+		              format_time(r["deadline"])))
+		print("\tClaimed {} of {}. Users: {}".format(len(r["claims"]), r["count"], ", ".join(r["users"])))
+
+elif parsed.mode == "cancel":
+	if cancel_reservation(db, parsed.id):
+		print("Reservation {} cancelled.".format(parsed.id))
+	else:
+		print("Reservation {} does not exist.".format(parsed.id))
+		sys.exit(1)
+
+else:
+	parser.print_usage()
@@ -10,9 +10,11 @@ import os
 import shutil
 import subprocess
 import sys
-import time
 import redis
+import vlabcleanup
+import vlabclient
 import vlabconfig
+import vlabredis
 
 CONFIG_FILE = '/vlab/vlab.conf'
 
@@ -27,20 +29,13 @@ config = vlabconfig.open_log(log, CONFIG_FILE)
 log.info("{} parsed successfully.".format(CONFIG_FILE))
 users = config['users']
 
-# As we are started at the same time as the redis server it may time some time for it to become available
-connection_attempts = 1
-while True:
-	try:
-		db = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
-		db.ping()
-		break
-	except redis.exceptions.ConnectionError as c:
-		log.info("Connection to redis server failed. Retrying...({}/5)".format(connection_attempts))
-		time.sleep(2)
-	connection_attempts = connection_attempts + 1
-	if connection_attempts > 5:
-		log.critical("Cannot connect to the redis server. Aborting.")
-		sys.exit(6)
+# As we are started at the same time as the redis server it may time some time for it to become available,
+# so allow more connection retries than usual
+try:
+	db = vlabclient.get_client(host='localhost', retries=6)
+except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as c:
+	log.critical("Cannot connect to the redis server. Aborting. {}".format(c))
+	sys.exit(6)
 
 log.info("Config file format accepted. Begin user generation.")
 
@@ -85,8 +80,32 @@ for board in config['boards'].keys():
 	if 'reset' in config['boards'][board]:
 		db.set("vlab:knownboard:{}:reset".format(board), config['boards'][board]['reset'])
 
-# And finally our free port number
-db.set("vlab:port", 30000)
+# Per-boardclass settings
+for key in db.scan_iter(match="vlab:boardclass:*:queue"):
+	db.delete(key)
+for key in db.scan_iter(match="vlab:boardclass:*:policy"):
+	db.delete(key)
+for key in db.scan_iter(match="vlab:boardclass:*:reset"):
+	db.delete(key)
+for bc, settings in config.get('boardclasses', {}).items():
+	if settings.get('queue'):
+		db.set("vlab:boardclass:{}:queue".format(bc), "true")
+	if 'policy' in settings:
+		if settings['policy'] in vlabredis.ALLOCATION_POLICIES:
+			db.set("vlab:boardclass:{}:policy".format(bc), settings['policy'])
+		else:
+			log.warning("Board class {} has unknown allocation policy {}, using {}."
+			            .format(bc, settings['policy'], vlabredis.DEFAULT_ALLOCATION_POLICY))
+	if 'reset' in settings:
+		if settings['reset'] in vlabcleanup.RESET_POLICIES:
+			db.set("vlab:boardclass:{}:reset".format(bc), settings['reset'])
+		else:
+			log.warning("Board class {} has unknown reset policy {}, using {}."
+			            .format(bc, settings['reset'], vlabcleanup.DEFAULT_RESET_POLICY))
+
+# And finally our pool of free relay ports, keeping any that are still leased to connected users
+free_ports = vlabredis.init_port_pool(db)
+log.info("{} relay ports free.".format(free_ports))
 
 log.info("Relay server start up completed successfully.")
 sys.exit(0)
@@ -3,26 +3,43 @@
 """
 The VLAB relay shell. Called from bash when a remote user connects, this script
 is given one argument, which is the board class that the user is requesting.
-
-The script checks whether this user is allowed that board, and if so, locks the
-board and assembles the required ssh command to be executed by the calling shell
-script which will forward the user's ssh connection on the target board server.
+Alternatively the argument is 'batch:<boardclass>:<timeout>' to submit a batch job
+read from stdin, or 'job:<id>' to fetch a job's output (see vlabjobs). The serial
+output of the user's last session on a board class can be fetched with
+'history:<boardclass>:<kb>', and overlords can watch any board's serial console
+with 'watch:<serial>'.
+
+The script asks the allocator daemon (allocator.py) to check whether this user is
+allowed that board, and if so to lock the board, falling back to doing this itself if
+the daemon is not running. It then assembles the required ssh command to be executed
+by the calling shell script which will forward the user's ssh connection on the
+target board server.
 
 Ian Gray, 2016
 """
 
+import atexit
 import getpass
 import logging
 import os
+import re
+import signal
 import subprocess
+import threading
+import vlaballoc
+import vlabcleanup
+import vlabjobs
+import vlabssh
+import vlabtrace
 from vlabredis import *
 
-KEYS_DIR = "/vlab/keys/"
-
 logging.basicConfig(
 	filename='/vlab/log/access.log', level=logging.INFO, format='%(asctime)s ; %(levelname)s ; %(name)s ; %(message)s')
 log = logging.getLogger(os.path.basename(sys.argv[0]))
 
+# Give up timing the final SSH hop if its tunnel is not listening after this many seconds
+CONNECT_TRACE_TIMEOUT = 60
+
 db = connect_to_redis('localhost')
 
 if len(sys.argv) < 3:
@@ -32,15 +49,111 @@ if len(sys.argv) < 3:
 username = getpass.getuser()
 arg = sys.argv[2]
 
+
+def tunnel_listening(port):
+	"""
+	Return True if something on the relay is listening on the IPv4 TCP port 'port'.
+	"""
+	try:
+		with open("/proc/net/tcp") as f:
+			next(f)
+			for line in f:
+				fields = line.split()
+				# Listening sockets are in state 0A, and their local address is <hex address>:<hex port>
+				if fields[3] == "0A" and int(fields[1].split(":")[1], 16) == port:
+					return True
+	except (OSError, ValueError, IndexError):
+		pass
+	return False
+
+
 # Is the user requesting a free ephemeral port?
 if arg == 'getport':
-	port = db.incr("vlab:port")
-	if port > 35000:
-		port = 30000
-		db.set("vlab:port", 30000)
+	port = lease_port(db, username)
+	if port is None:
+		log.critical("NOFREEPORTS: {}".format(username))
+		print("No free relay ports. Please try again later.")
+		sys.exit(1)
 	print("VLABPORT:{}".format(port))
 	sys.exit(0)
 
+# Is the user submitting a batch job, of the form batch:boardclass:timeout with the job's archive on stdin?
+if arg.startswith("batch:"):
+	args = arg.split(":")
+	try:
+		boardclass, job_timeout = args[1], int(args[2])
+	except (IndexError, ValueError):
+		print("Argument should be of the form batch:boardclass:timeout")
+		sys.exit(1)
+	if not 0 < job_timeout <= vlabjobs.MAX_JOB_TIMEOUT:
+		print("Job timeouts must be between 1 and {} seconds.".format(vlabjobs.MAX_JOB_TIMEOUT))
+		sys.exit(1)
+	if not db.sismember("vlab:boardclasses", boardclass):
+		print("Board class '{}' does not exist.".format(boardclass))
+		sys.exit(1)
+	is_user, overlord, allowed = vlaballoc.get_access(db, username)
+	if not is_user or (not overlord and boardclass not in allowed):
+		print("User '{}' cannot access board class '{}'.".format(username, boardclass))
+		sys.exit(1)
+
+	archive = sys.stdin.buffer.read(vlabjobs.MAX_JOB_SIZE + 1)
+	problem = vlabjobs.check_job_archive(archive)
+	if problem is not None:
+		print(problem)
+		sys.exit(1)
+	job_id = vlabjobs.submit_job(db, username, boardclass, job_timeout, archive)
+	log.info("JOB: {}, {}, {}".format(username, boardclass, job_id))
+	print("Submitted job {}. Position {} in the queue for board class '{}'.".format(
+		job_id, vlabjobs.queue_position(db, job_id), boardclass))
+	print("Waiting for the job to run (it will keep running if you disconnect)...", flush=True)
+	# Wait for the job for as long as its queue might take, then leave the user to fetch it with job:<id>
+	job = vlabjobs.wait_for_job(db, job_id, vlabjobs.MAX_JOB_TIMEOUT * 4)
+	sys.exit(vlabjobs.print_job(job))
+
+# Is the user fetching the result of a job, of the form job:id?
+if arg.startswith("job:"):
+	# Job IDs are numbers, and anything else could name another of the job's keys
+	job = vlabjobs.get_job(db, arg[4:]) if arg[4:].isdigit() and arg[4:].isascii() else None
+	if job is None or job["user"] != username:
+		print("Job '{}' does not exist.".format(arg[4:]))
+		sys.exit(1)
+	sys.exit(vlabjobs.print_job(job))
+
+# Is the user fetching the serial output of their last session on a board class, of the form history:boardclass:kb?
+if arg.startswith("history:"):
+	args = arg.split(":")
+	try:
+		boardclass, history_bytes = args[1], int(args[2]) * 1024
+	except (IndexError, ValueError):
+		print("Argument should be of the form history:boardclass:kb")
+		sys.exit(1)
+	board = db.hget("vlab:boardclass:{}:lastboards".format(boardclass), username)
+	if board is None:
+		print("You have not used a board of class '{}'.".format(boardclass))
+		sys.exit(1)
+	board_details = get_board_details(db, board, ["server", "port"])
+	# The board server only gives the output to the user who last attached to the board's console
+	cmd = "python3 /vlab/console.py tail {} {}".format(history_bytes, username)
+	ssh_cmd = vlabssh.ssh_command("root@{}".format(board_details["server"]), cmd, board_details["port"])
+	sys.exit(subprocess.run(ssh_cmd, shell=True).returncode)
+
+# Is an overlord user watching the serial console of a board, of the form watch:serial?
+if arg.startswith("watch:"):
+	board = arg[6:]
+	is_user, overlord, allowed = vlaballoc.get_access(db, username)
+	if not overlord:
+		print("Only overlord users can watch boards.")
+		sys.exit(1)
+	if not db.exists("vlab:board:{}".format(board)):
+		print("Board {} does not exist.".format(board))
+		sys.exit(1)
+	board_details = get_board_details(db, board, ["server", "port"])
+	log.info("WATCH: {}, {}".format(username, board))
+	print("Watching the serial console of board {} (Ctrl-C to stop)...".format(board))
+	ssh_cmd = vlabssh.ssh_command("root@{}".format(board_details["server"]), "python3 /vlab/console.py view",
+	                              board_details["port"], options=["-tt", "-e", "none"])
+	sys.exit(subprocess.run(ssh_cmd, shell=True).returncode)
+
 # Otherwise the arg should be of the form boardclass:port, or boardclass:port:serial to request a specific board
 args = arg.split(":")
 if len(args) < 2:
@@ -60,85 +173,81 @@ except ValueError:
 	print("Argument should be of the form boardclass:port")
 	sys.exit(1)
 
-# Do the specified user and boardclass exist in redis?
-check_in_set(db, 'vlab:boardclasses', boardclass, "Board class '{}' does not exist.".format(boardclass))
-check_in_set(db, 'vlab:users', username, "User '{}' is not a VLAB user.".format(username))
-
-if requested_serial is not None:
-	if not db.get("vlab:user:{}:overlord".format(username)):
-		print("Only overlord users can request specific boards.")
+# The port was leased to us by 'getport'. Renew the lease for as long as we are connected, and give it back however
+# the shell exits. Leases left behind by shells which are killed are reclaimed by checkboards.py.
+if not renew_port_lease(db, tunnel_port, username):
+	log.warning("PORTINUSE: {}, {}".format(username, tunnel_port))
+atexit.register(release_port, db, tunnel_port, username)
+
+# Time each phase of the login (see vlabtrace), starting from when this process was started
+trace = vlabtrace.LoginTrace(username)
+trace.set(boardclass=boardclass)
+process_start = vlabtrace.process_start_time()
+if process_start is not None:
+	trace.add("startup", trace.start - process_start)
+
+# Ask the allocator daemon to check our access and allocate a board
+allocation_start = time.perf_counter()
+try:
+	result = vlaballoc.request_allocation(boardclass, requested_serial)
+except (OSError, ValueError):
+	# The allocator is not running, so do the allocation ourselves
+	with trace.phase("acl"):
+		access = vlaballoc.get_access(db, username)
+	with trace.phase("allocation"):
+		result = vlaballoc.allocate(db, username, boardclass, requested_serial, access)
+else:
+	# The daemon reports its own timings, and the rest is spent talking to it
+	timings = result.get("timings", {})
+	for phase, seconds in timings.items():
+		trace.add(phase, seconds)
+	trace.add("allocator", time.perf_counter() - allocation_start - sum(timings.values()))
+
+for message in result.get("messages", []):
+	print(message)
+
+if result.get("nofreeboards") and vlaballoc.queue_enabled(db, boardclass):
+	def show_queue_position(position, wait):
+		renew_port_lease(db, tunnel_port, username)
+		if wait is None:
+			print("Position {} in the queue for board class '{}'...".format(position, boardclass))
+		else:
+			print("Position {} in the queue for board class '{}', a board is due within {} minutes..."
+			      .format(position, boardclass, int(wait / 60) + 1))
+
+	# Make sure we leave the queue if the user disconnects while waiting
+	signal.signal(signal.SIGHUP, lambda signum, frame: sys.exit(1))
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+	print("All boards of type '{}' are in use. Waiting in the queue for the next free board (Ctrl-C to give up)..."
+	      .format(boardclass))
+	log.info("QUEUE: {}, {}".format(username, boardclass))
+	try:
+		with trace.phase("queue"):
+			result = vlaballoc.wait_for_board(db, username, boardclass, show_queue_position)
+	except KeyboardInterrupt:
+		print("Left the queue.")
+		trace.save(db, "leftqueue")
 		sys.exit(1)
-
-	# Does the requested board exist?
-	check_in_set(db, 'vlab:boardclass:{}:boards'.format(boardclass), requested_serial,
-	             "Board {} does not exist.".format(requested_serial))
-
-# Can the user access the requested boardclass?
-# Either they are an overlord user, or vlab:user:<username>:allowedboards includes the boardclass in question
-if not db.get("vlab:user:{}:overlord".format(username)):
-	check_in_set(db, "vlab:user:{}:allowedboards".format(username),
-	             boardclass,
-	             "User '{}' cannot access board class '{}'.".format(username, boardclass)
-	             )
-
-# Mark in the database that we are attempting to lock a board of this boardclass
-db.set("vlab:boardclass:{}:locking".format(boardclass), 1)
-db.expire("vlab:boardclass:{}:locking".format(boardclass), 2)
-
-board = None
-
-# If a specific board serial is requested, try to take that board (only Overload can request specific boards)
-if requested_serial is not None:
-	if db.get("vlab:board:{}:session:username".format(requested_serial)) == username \
-			or db.get("vlab:board:{}:lock:username".format(requested_serial)) == username:
-		# We already have an active session or lock for the board
-		board = requested_serial
-	elif db.zrem("vlab:boardclass:{}:unlockedboards".format(boardclass), requested_serial) > 0:
-		# The board was removed from the unlocked list, therefore it was unlocked
-		board = requested_serial
+	for message in result.get("messages", []):
+		print(message)
+
+if "error" in result:
+	print(result["error"])
+	if result["nofreeboards"]:
+		log.critical("NOFREEBOARDS: {}, {}".format(username, boardclass))
+		trace.save(db, "nofreeboards")
 	else:
-		# The board is currently locked by someone else
-		lock_username = db.get("vlab:board:{}:lock:username".format(requested_serial))
-		print("Requested board is currently locked by {}.".format(lock_username))
-		db.delete("vlab:boardclass:{}:locking".format(boardclass))
-		sys.exit(1)
-
-# For each board in the board class, check if one is already in use or locked by us
-if board is None:
-	for b in db.smembers("vlab:boardclass:{}:boards".format(boardclass)):
-		if db.get("vlab:board:{}:session:username".format(b)) == username \
-				or db.get("vlab:board:{}:lock:username".format(b)) == username:
-			board = b
-			print("User already has an active session on board '{}', so reusing...".format(board))
-			break
-
-if board is None:
-	# Try to get an available board for the boardclass
-	print("Requesting least-recently-used board of class '{}'...".format(boardclass))
-	board = allocate_available_board_of_class(db, boardclass)
-
-if board is None:
-	# Try to get an unlocked but in-use board for the boardclass
-	print("No available boards of class '{}'. Checking for in-use boards with expired locks...".format(boardclass))
-	print("Requesting least-recently-unlocked board of class '{}'...".format(boardclass))
-	board = allocate_unlocked_board_of_class(db, boardclass)
-
-if board is None:
-	# If we still don't have a board at this point, all potential boards must be locked
-	db.delete("vlab:boardclass:{}:locking".format(boardclass))
-	print("All boards of type '{}' are currently locked by other VLAB users.".format(boardclass))
-	print("Try again in a few minutes (locks expire after {} minutes).".format(int(MAX_LOCK_TIME / 60)))
-	log.critical("NOFREEBOARDS: {}, {}".format(username, boardclass))
+		trace.save(db, "error")
 	sys.exit(1)
 
-session_start_time = int(time.time())
-start_session(db, board, boardclass, username, session_start_time)
+board = result["board"]
+session_start_time = result["start_time"]
+trace.set(board=board, start_time=session_start_time)
 log.info("START: {}, {}:{}".format(username, boardclass, board))
-unlocked_count = db.zcard("vlab:boardclass:{}:unlockedboards".format(boardclass))
-log.info("LOCK: {}, {}:{}, {} remaining in set".format(username, boardclass, board, unlocked_count))
+log.info("LOCK: {}, {}:{}, {} remaining in set".format(username, boardclass, board, result["unlocked_count"]))
 
-# Fetch the details of the locked board
-board_details = get_board_details(db, board, ["user", "server", "port"])
+# Details of the locked board
+board_details = {"user": result["user"], "server": result["server"], "port": result["port"]}
 
 lock_start = time.strftime("%H:%M:%S %Z", time.localtime(session_start_time))
 lock_end = time.strftime("%d/%m/%y at %H:%M:%S %Z", time.localtime(session_start_time + MAX_LOCK_TIME))
@@ -152,44 +261,88 @@ print("*************************************************************************
 
 # All done. First restart the target container
 target = "vlab@{}".format(board_details['server'])
-keyfile = "{}{}".format(KEYS_DIR, "id_rsa")
 cmd = "/opt/VLAB/boardrestart.sh {}".format(board)
-ssh_cmd = "ssh -q -o \"StrictHostKeyChecking no\" -e none -i {} {} \"{}\"".format(keyfile, target, cmd)
+ssh_cmd = vlabssh.ssh_command(target, cmd, options=["-e", "none"])
 print("Restarting target container...")
-subprocess.run(ssh_cmd, shell=True)
+with trace.phase("restart"):
+	restart = subprocess.run(ssh_cmd, shell=True, stdout=subprocess.PIPE, universal_newlines=True)
+
+# The restart reports the container's new SSH port once its sshd and hw_server are accepting connections
+ready = re.search(r"^VLABREADY:(\d+)$", restart.stdout, re.MULTILINE)
+if ready is None:
+	if "VLABNOTREADY" in restart.stdout:
+		print("Board server is slow to start, connecting anyway...")
+	else:
+		# The board host's scripts predate the readiness report, so allow the container time to start
+		with trace.phase("restart"):
+			time.sleep(2)
+	# Port details might have changed
+	board_details = get_board_details(db, board, ["user", "server", "port"])
+else:
+	board_details['port'] = ready.group(1)
 
 # Execute the bounce command
 print("Connecting to board server...")
-time.sleep(2)
-
-# Port details might have changed
-board_details = get_board_details(db, board, ["user", "server", "port"])
 server = board_details['server']
 port = board_details['port']
-tunnel = "-L {}:localhost:3121".format(tunnel_port)
-keyfile = "{}{}".format(KEYS_DIR, "id_rsa")
+tunnel = "{}:localhost:3121".format(tunnel_port)
 target = "root@{}".format(server)
 
-if db.get("vlab:knownboard:{}:reset".format(board)) == "true":
-	cmd = "/opt/xsct/bin/xsdb /vlab/reset.tcl"
-	ssh_cmd = "ssh -q -o \"StrictHostKeyChecking no\" -i {} -p {} {} \"{}\""\
-		.format(keyfile, port, target, cmd)
-	print("Resetting board...")
-	subprocess.run(ssh_cmd, shell=True)
+# Boards which have not been used since their last reset are left alone (see vlabactivity)
+cmd = vlabcleanup.reset_command(db, board)
+if cmd is not None:
+	ssh_cmd = vlabssh.ssh_command(target, cmd, port)
+	print("Resetting board if required...")
+	with trace.phase("reset"):
+		subprocess.run(ssh_cmd, shell=True, stdout=subprocess.DEVNULL)
 
 screenrc = "defhstatus \\\"{} (VLAB Shell)\\\"\\ncaption always\\ncaption string \\\" VLAB Shell [ User: {} | Lock " \
            "expires: {} | Board class: {} | Board serial: {} | Server: {} ]\\\""\
 	.format(boardclass, username, lock_end, boardclass, board, server)
 cmd = "echo -e '{}' > /vlab/vlabscreenrc;" \
-      "screen -c /vlab/vlabscreenrc -qdRR - /dev/ttyFPGA 115200;" \
+      "screen -c /vlab/vlabscreenrc -qdRR python3 /vlab/console.py attach {};" \
       "killall -q screen;" \
       "pkill -SIGINT -nx sshd"\
-	.format(screenrc)
-ssh_cmd = "ssh -q -4 {} -o \"StrictHostKeyChecking no\" -e none -i {} -p {} -tt {} \"{}\""\
-	.format(tunnel, keyfile, port, target, cmd)
+	.format(screenrc, username)
+# The session ends by killing its own sshd process, so it must not share a multiplexed connection
+ssh_cmd = vlabssh.ssh_command(target, cmd, port, options=["-4", "-L", tunnel, "-e", "none", "-tt"], multiplex=False)
+connect_start = time.perf_counter()
 proc = subprocess.Popen(ssh_cmd, shell=True)
 
-# Wait for the process to end, while pinging session and checking locks every 10 seconds
+
+def trace_connection():
+	# The final hop is complete once the session's SSH connection is listening for the user's tunnel
+	deadline = time.time() + CONNECT_TRACE_TIMEOUT
+	while proc.poll() is None and not tunnel_listening(tunnel_port) and time.time() < deadline:
+		time.sleep(0.05)
+	trace.add("connect", time.perf_counter() - connect_start)
+	if proc.poll() is not None:
+		outcome = "disconnected"
+	elif time.time() < deadline:
+		outcome = "connected"
+	else:
+		outcome = "timeout"
+	try:
+		trace.save(db, outcome)
+	except redis.exceptions.RedisError as e:
+		log.warning("Could not save login trace {}: {}".format(trace.session_id, e))
+
+
+threading.Thread(target=trace_connection, daemon=True).start()
+
+# Disconnect as soon as the session is ended or the board is allocated to another user
+revoked = threading.Event()
+
+
+def revoke():
+	revoked.set()
+	proc.terminate()
+
+
+watcher = watch_for_revocation(db, board, username, session_start_time, revoke)
+
+# Wait for the process to end, sending a heartbeat every HEARTBEAT_INTERVAL seconds and releasing the lock when it
+# expires. The heartbeat also catches any revocation that was published before we subscribed.
 locked = True
 while True:
 	try:
@@ -198,32 +351,46 @@ while True:
 			if unlock_board_if_user_time(db, board, boardclass, username, session_start_time):
 				locked = False
 				log.info("RELEASE: {}, {}:{}".format(username, boardclass, board))
-		if ping_session_if_user_time(db, board, username, session_start_time):
-			log.debug("PING: {}, {}:{} at {}".format(username, boardclass, board, current_time))
-		else:
-			proc.terminate()
-			print("Your lock has expired and board '{}' has been allocated to another user.\r".format(board))
+		if revoked.is_set() or not ping_session_if_user_time(db, board, username, session_start_time):
+			revoke()
 			break
-		proc.wait(10)
+		renew_port_lease(db, tunnel_port, username)
+		log.debug("PING: {}, {}:{} at {}".format(username, boardclass, board, current_time))
+		timeout = HEARTBEAT_INTERVAL
+		if locked:
+			timeout = max(1, min(timeout, int(session_start_time) + MAX_LOCK_TIME + 1 - current_time))
+		proc.wait(timeout)
 		break
 	except subprocess.TimeoutExpired:
 		continue
 
+watcher.stop()
+if revoked.is_set():
+	log.info("REVOKED: {}, {}:{}".format(username, boardclass, board))
+	print("Your lock has expired and board '{}' has been allocated to another user.\r".format(board))
+
 # Fix terminal in case screen has left it in a bad state
 subprocess.run("stty sane", shell=True)
 
 print("User disconnected. Cleaning up...")
 
-if db.get("vlab:knownboard:{}:reset".format(board)) == "true":
-	cmd = "/opt/xsct/bin/xsdb /vlab/reset.tcl"
-	ssh_cmd = "ssh -q -o \"StrictHostKeyChecking no\" -i {} -p {} {} \"{}\""\
-		.format(keyfile, port, target, cmd)
-	print("Resetting board...")
-	subprocess.run(ssh_cmd, shell=True)
-
-print("Releasing lock and ending session...")
-if unlock_board_if_user_time(db, board, boardclass, username, session_start_time):
-	log.info("RELEASE: {}, {}:{}".format(username, boardclass, board))
-if end_session_if_user_time(db, board, boardclass, username, session_start_time):
+# The container is restarted for its next user, so there is no point keeping the connection to it
+vlabssh.close_master(target, port)
+
+if revoked.is_set():
+	# The board belongs to somebody else now, so there is nothing to clean up
+	pass
+elif vlabcleanup.worker_alive(db):
+	# Leave the board locked until the cleanup worker has reset it, rather than making the user wait
+	vlabcleanup.queue_cleanup(db, board, boardclass, username, session_start_time)
+	# The user's session is over as far as the usage statistics are concerned (see web/logparser.py)
 	log.info("END: {}, {}:{}".format(username, boardclass, board))
+else:
+	print("Resetting board and releasing lock...")
+	reset, released, ended = vlabcleanup.cleanup_board(db, {
+		"board": board, "boardclass": boardclass, "user": username, "start_time": session_start_time})
+	if released:
+		log.info("RELEASE: {}, {}:{}".format(username, boardclass, board))
+	if ended:
+		log.info("END: {}, {}:{}".format(username, boardclass, board))
 print("Disconnected successfully.")
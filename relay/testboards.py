@@ -13,17 +13,16 @@ Ian Gray, 2025
 
 import argparse
 import os
-import subprocess
 import time
 
+import vlabcleanup
+from vlabjobs import program_and_read_serial
 from vlabredis import *
 
 parser = argparse.ArgumentParser(description="VLAB hardware test script")
 parser.add_argument('-v', action="store_true", default=False, dest='verbose')
 parsed = parser.parse_args()
 
-KEYS_DIR = "/vlab/keys/"
-KEYFILE = KEYS_DIR + "id_rsa"
 TEST_MAGIC = "VLAB_TEST_OK"
 SERIAL_TIMEOUT = 15  # seconds to wait for serial output
 SSH_TIMEOUT = 30     # seconds for SSH commands
@@ -37,25 +36,9 @@ def log(msg, verbose_only=False):
     print("{} testboards.py: {}".format(time.strftime("%Y-%m-%d-%H:%M:%S"), msg))
 
 
-def ssh_to_board(server, port, cmd, timeout=SSH_TIMEOUT):
-    """Run a command on a board container via SSH. Returns (returncode, stdout, stderr)."""
-    ssh_cmd = [
-        "ssh", "-q", "-o", "StrictHostKeyChecking=no", "-i", KEYFILE,
-        "-p", str(port), "root@{}".format(server), cmd
-    ]
-    try:
-        result = subprocess.run(ssh_cmd, capture_output=True, text=True, timeout=timeout)
-        return result.returncode, result.stdout, result.stderr
-    except subprocess.TimeoutExpired:
-        return -1, "", "SSH command timed out after {}s".format(timeout)
-    except Exception as e:
-        return -1, "", str(e)
-
-
 def board_is_idle(db, board):
     """Return True only if board has no active session and no lock."""
-    session_user = db.get("vlab:board:{}:session:username".format(board))
-    lock_user = db.get("vlab:board:{}:lock:username".format(board))
+    session_user, lock_user = db.hmget("vlab:board:{}".format(board), ["session:username", "lock:username"])
     return session_user is None and lock_user is None
 
 
@@ -74,44 +57,22 @@ def return_board(db, board, bc):
     db.zadd("vlab:boardclass:{}:unlockedboards".format(bc), {board: now})
 
 
-def program_and_read_serial(server, port):
-    """Program the test bitstream and capture serial output in one SSH session.
-
-    Starts reading /dev/ttyFPGA in the background before launching xsdb, so
-    that any output from the ELF is captured even if it arrives early.
-    Returns (success, serial_output, error_message).
-    """
-    cmd = (
-        "killall -q screen; "
-        "stty -F /dev/ttyFPGA 115200 raw -echo; "
-        "cat /dev/ttyFPGA > /tmp/vlab_serial_test & CAT_PID=$!; "
-        "/opt/xsct/bin/xsdb /vlab/test.tcl; XSDB_RC=$?; "
-        "sleep 1; "
-        "kill $CAT_PID 2>/dev/null; "
-        "cat /tmp/vlab_serial_test; "
-        "exit $XSDB_RC"
-    )
-    rc, stdout, stderr = ssh_to_board(server, port, cmd, timeout=90)
-    if rc != 0:
-        return False, "", "xsdb failed (rc={}): {} {}".format(rc, stdout.strip(), stderr.strip())
-    return True, stdout, ""
-
-
 def reset_board(db, board, server, port):
     """Reset the board after testing."""
     try:
-        if db.get("vlab:knownboard:{}:reset".format(board)) == "true":
-            cmd = "/opt/xsct/bin/xsdb /vlab/reset.tcl"
-            ssh_to_board(server, port, cmd, timeout=30)
+        # The test has used the board, so it is reset whether or not it looks used
+        vlabcleanup.reset_board(db, board, server, port, attempts=1, always=True)
     except Exception as e:
         log("Exception resetting board {}: {}".format(board, e))
 
 
 def record_result(db, board, status, message):
     """Record hardware test result in Redis."""
-    db.set("vlab:board:{}:hwtest:status".format(board), status)
-    db.set("vlab:board:{}:hwtest:time".format(board), int(time.time()))
-    db.set("vlab:board:{}:hwtest:message".format(board), message)
+    db.hset("vlab:board:{}".format(board), mapping={
+        "hwtest:status": status,
+        "hwtest:time": int(time.time()),
+        "hwtest:message": message,
+    })
 
 
 def test_board(db, board, bc):
@@ -130,7 +91,7 @@ def test_board(db, board, bc):
 
     # For previously-failed boards: they won't be in either pool but we still
     # want to re-test them. Check if this was a known-failed board.
-    prev_status = db.get("vlab:board:{}:hwtest:status".format(board))
+    prev_status = db.hget("vlab:board:{}".format(board), "hwtest:status")
     if not was_in_pool and prev_status != "fail":
         # Board wasn't in any pool and didn't previously fail — someone else
         # grabbed it between our idle check and withdrawal. Skip.
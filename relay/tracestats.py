@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+"""
+Summarise the login traces recorded by shell.py, printing the median and 95th percentile time of each phase of a
+login. See vlabtrace for the phases that are recorded.
+
+Options:
+-n   Only summarise the given number of most recent logins
+-u   Only summarise logins by the given user
+"""
+
+import argparse
+import vlabtrace
+from vlabredis import *
+
+parser = argparse.ArgumentParser(description="VLAB login trace summary")
+parser.add_argument('-n', '--count', type=int, default=None, help='Summarise only the most recent logins')
+parser.add_argument('-u', '--user', default=None, help='Summarise only the logins of this user')
+parsed = parser.parse_args()
+
+db = connect_to_redis('localhost')
+
+# The user filter is applied before the count, so that -n counts the user's own logins
+traces = vlabtrace.read_traces(db, parsed.count, parsed.user)
+if not traces:
+	print("No login traces recorded.")
+	sys.exit(0)
+
+outcomes = {}
+for t in traces:
+	outcome = t.get("outcome", "unknown")
+	outcomes[outcome] = outcomes.get(outcome, 0) + 1
+print("{} logins since {} ({})".format(
+	len(traces), time.strftime("%Y-%m-%d %H:%M:%S %Z", time.localtime(traces[0]["time"])),
+	", ".join("{} {}".format(count, outcome) for outcome, count in sorted(outcomes.items()))))
+print()
+print("{:<12}{:>8}{:>12}{:>12}".format("Phase", "Count", "p50 (ms)", "p95 (ms)"))
+for phase, stats in vlabtrace.summarise(traces).items():
+	print("{:<12}{:>8}{:>12.1f}{:>12.1f}".format(phase, stats["count"], stats["p50"], stats["p95"]))
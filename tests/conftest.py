@@ -88,10 +88,17 @@ def web_base_url(pegasus_host, web_port):
 # ---------------------------------------------------------------------------
 
 @pytest.fixture
-def mock_redis():
+def fake_server():
+    """Function-scoped fakeredis server."""
+    import fakeredis
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def mock_redis(fake_server):
     """Function-scoped fakeredis instance."""
     import fakeredis
-    return fakeredis.FakeRedis(decode_responses=True)
+    return fakeredis.FakeRedis(server=fake_server, decode_responses=True)
 
 
 @pytest.fixture
@@ -123,10 +130,8 @@ def populated_redis(mock_redis):
     db.sadd("vlab:boardclass:vlab_test:boards", "BOARD001", "BOARD002")
 
     # Board metadata
-    db.set("vlab:board:BOARD001:server", "boardserver1")
-    db.set("vlab:board:BOARD001:port", "30001")
-    db.set("vlab:board:BOARD002:server", "boardserver2")
-    db.set("vlab:board:BOARD002:port", "30002")
+    db.hset("vlab:board:BOARD001", mapping={"boardclass": "vlab_test", "server": "boardserver1", "port": "30001"})
+    db.hset("vlab:board:BOARD002", mapping={"boardclass": "vlab_test", "server": "boardserver2", "port": "30002"})
 
     # Known board metadata
     db.set("vlab:knownboard:BOARD001:class", "vlab_test")
@@ -143,11 +148,16 @@ def populated_redis(mock_redis):
 
     # BOARD002: in session, locked by testuser
     session_start = now - 600
-    db.set("vlab:board:BOARD002:lock:username", "testuser")
-    db.set("vlab:board:BOARD002:lock:time", str(session_start))
-    db.set("vlab:board:BOARD002:session:username", "testuser")
-    db.set("vlab:board:BOARD002:session:starttime", str(session_start))
-    db.set("vlab:board:BOARD002:session:pingtime", str(now - 30))
+    db.hset("vlab:board:BOARD002", mapping={
+        "lock:username": "testuser",
+        "lock:time": str(session_start),
+        "session:username": "testuser",
+        "session:starttime": str(session_start),
+        "session:pingtime": str(now - 30),
+    })
+    db.sadd("vlab:user:testuser:boards", "BOARD002")
+    db.zadd("vlab:boardclass:vlab_test:locktimes", {"BOARD002": session_start})
+    db.zadd("vlab:boardclass:vlab_test:pingtimes", {"BOARD002": now - 30})
 
     return db
 
@@ -19,8 +19,8 @@ class TestBoardConnectivity:
         failures = []
         for bc in live_redis.smembers("vlab:boardclasses"):
             for board in live_redis.smembers(f"vlab:boardclass:{bc}:boards"):
-                server = live_redis.get(f"vlab:board:{board}:server")
-                port = live_redis.get(f"vlab:board:{board}:port")
+                server = live_redis.hget(f"vlab:board:{board}", "server")
+                port = live_redis.hget(f"vlab:board:{board}", "port")
                 if server is None or port is None:
                     failures.append(f"{board}: missing server/port metadata")
                     continue
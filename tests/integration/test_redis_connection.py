@@ -18,10 +18,13 @@ class TestRedisConnection:
         overlord = live_redis.get("vlab:user:ian:overlord")
         assert overlord == "true", f"ian overlord flag is {overlord!r}, expected 'true'"
 
-    def test_port_counter_in_range(self, live_redis):
-        port = live_redis.get("vlab:port")
-        assert port is not None, "vlab:port key missing"
-        assert 30000 <= int(port) <= 35000, f"Port counter {port} out of expected range"
+    def test_port_pool_in_range(self, live_redis):
+        free = live_redis.smembers("vlab:ports:free")
+        leased = live_redis.zrange("vlab:ports:leases", 0, -1)
+        assert free or leased, "relay port pool is empty"
+        for port in free | set(leased):
+            assert 30000 <= int(port) <= 35000, f"Relay port {port} out of expected range"
+        assert not free & set(leased), "relay ports both free and leased"
 
     def test_boardclasses_type(self, live_redis):
         key_type = live_redis.type("vlab:boardclasses")
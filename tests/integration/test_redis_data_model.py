@@ -13,8 +13,8 @@ class TestBoardMetadata:
     def test_registered_boards_have_server_and_port(self, live_redis):
         for bc in live_redis.smembers("vlab:boardclasses"):
             for board in live_redis.smembers(f"vlab:boardclass:{bc}:boards"):
-                server = live_redis.get(f"vlab:board:{board}:server")
-                port = live_redis.get(f"vlab:board:{board}:port")
+                server = live_redis.hget(f"vlab:board:{board}", "server")
+                port = live_redis.hget(f"vlab:board:{board}", "port")
                 assert server is not None, f"{board} missing server key"
                 assert port is not None, f"{board} missing port key"
 
@@ -36,6 +36,15 @@ class TestBoardMetadata:
                         f"{board} in boardclass {bc} but knownboard class is {known_class}"
                     )
 
+    def test_board_boardclass_backlink(self, live_redis):
+        """A board's hash should link back to the boardclass set it's in."""
+        for bc in live_redis.smembers("vlab:boardclasses"):
+            for board in live_redis.smembers(f"vlab:boardclass:{bc}:boards"):
+                linked_class = live_redis.hget(f"vlab:board:{board}", "boardclass")
+                assert linked_class == bc, (
+                    f"{board} in boardclass {bc} but its hash links to {linked_class}"
+                )
+
 
 @pytest.mark.integration
 @pytest.mark.live
@@ -44,7 +53,7 @@ class TestSessionInvariants:
         for bc in live_redis.smembers("vlab:boardclasses"):
             available = live_redis.zrange(f"vlab:boardclass:{bc}:availableboards", 0, -1)
             for board in available:
-                session_user = live_redis.get(f"vlab:board:{board}:session:username")
+                session_user = live_redis.hget(f"vlab:board:{board}", "session:username")
                 assert session_user is None, (
                     f"{board} is available but has session:username={session_user}"
                 )
@@ -53,8 +62,8 @@ class TestSessionInvariants:
         """Lock username and time should both be present or both absent."""
         for bc in live_redis.smembers("vlab:boardclasses"):
             for board in live_redis.smembers(f"vlab:boardclass:{bc}:boards"):
-                lock_user = live_redis.get(f"vlab:board:{board}:lock:username")
-                lock_time = live_redis.get(f"vlab:board:{board}:lock:time")
+                lock_user = live_redis.hget(f"vlab:board:{board}", "lock:username")
+                lock_time = live_redis.hget(f"vlab:board:{board}", "lock:time")
                 if lock_user is not None:
                     assert lock_time is not None, (
                         f"{board} has lock:username but no lock:time"
@@ -68,9 +77,9 @@ class TestSessionInvariants:
         """Session username, starttime, and pingtime should all be present together."""
         for bc in live_redis.smembers("vlab:boardclasses"):
             for board in live_redis.smembers(f"vlab:boardclass:{bc}:boards"):
-                sess_user = live_redis.get(f"vlab:board:{board}:session:username")
-                sess_start = live_redis.get(f"vlab:board:{board}:session:starttime")
-                sess_ping = live_redis.get(f"vlab:board:{board}:session:pingtime")
+                sess_user = live_redis.hget(f"vlab:board:{board}", "session:username")
+                sess_start = live_redis.hget(f"vlab:board:{board}", "session:starttime")
+                sess_ping = live_redis.hget(f"vlab:board:{board}", "session:pingtime")
                 vals = [sess_user, sess_start, sess_ping]
                 present = [v for v in vals if v is not None]
                 assert len(present) == 0 or len(present) == 3, (
@@ -78,13 +87,34 @@ class TestSessionInvariants:
                     f"start={sess_start}, ping={sess_ping}"
                 )
 
+    def test_held_boards_are_indexed(self, live_redis):
+        """Every board with a lock or session should be in its holder's board index."""
+        for bc in live_redis.smembers("vlab:boardclasses"):
+            for board in live_redis.smembers(f"vlab:boardclass:{bc}:boards"):
+                for field in ("lock:username", "session:username"):
+                    user = live_redis.hget(f"vlab:board:{board}", field)
+                    if user is not None:
+                        assert live_redis.sismember(f"vlab:user:{user}:boards", board), (
+                            f"{board} has {field}={user} but is not in that user's board index"
+                        )
+
+    def test_lock_and_ping_times_are_indexed(self, live_redis):
+        """Every lock and session should be in its boardclass's time index, with a matching score."""
+        for bc in live_redis.smembers("vlab:boardclasses"):
+            for board in live_redis.smembers(f"vlab:boardclass:{bc}:boards"):
+                lock_time, ping_time = live_redis.hmget(f"vlab:board:{board}", ["lock:time", "session:pingtime"])
+                lock_score = live_redis.zscore(f"vlab:boardclass:{bc}:locktimes", board)
+                ping_score = live_redis.zscore(f"vlab:boardclass:{bc}:pingtimes", board)
+                assert (lock_score is None) == (lock_time is None), f"{board} lock time index mismatch"
+                assert (ping_score is None) == (ping_time is None), f"{board} ping time index mismatch"
+
     def test_no_stale_locks(self, live_redis):
         """No lock should exceed MAX_LOCK_TIME + 2 min grace."""
         now = int(time.time())
         grace = MAX_LOCK_TIME + 120
         for bc in live_redis.smembers("vlab:boardclasses"):
             for board in live_redis.smembers(f"vlab:boardclass:{bc}:boards"):
-                lock_time = live_redis.get(f"vlab:board:{board}:lock:time")
+                lock_time = live_redis.hget(f"vlab:board:{board}", "lock:time")
                 if lock_time is not None:
                     age = now - int(lock_time)
                     assert age <= grace, (
@@ -96,7 +126,7 @@ class TestSessionInvariants:
         now = int(time.time())
         for bc in live_redis.smembers("vlab:boardclasses"):
             for board in live_redis.smembers(f"vlab:boardclass:{bc}:boards"):
-                ping_time = live_redis.get(f"vlab:board:{board}:session:pingtime")
+                ping_time = live_redis.hget(f"vlab:board:{board}", "session:pingtime")
                 if ping_time is not None:
                     age = now - int(ping_time)
                     assert age <= 90, (
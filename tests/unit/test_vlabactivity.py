@@ -0,0 +1,54 @@
+"""Tests for vlabcommon/vlabactivity.py."""
+
+import pytest
+
+import vlabactivity
+
+TCP_HEADER = "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+
+
+def tcp_line(local_port, remote_port, state):
+    return "   0: 0100007F:{:04X} 0100007F:{:04X} {} 00000000:00000000 00:00000000 00000000     0        0 1\n" \
+        .format(local_port, remote_port, state)
+
+
+@pytest.mark.unit
+class TestActivity:
+    def test_mark_and_clear(self, tmp_path):
+        path = str(tmp_path / "state" / "activity")
+        clean_path = str(tmp_path / "state" / "clean")
+        assert vlabactivity.used_by(path) == set()
+        vlabactivity.mark_used("jtag", path, clean_path)
+        vlabactivity.mark_used("jtag", path, clean_path)
+        vlabactivity.mark_used("serial", path, clean_path)
+        assert vlabactivity.used_by(path) == {"jtag", "serial"}
+        with open(path) as f:
+            assert f.read() == "jtag\nserial\n"
+        vlabactivity.clear(path)
+        assert vlabactivity.used_by(path) == set()
+        vlabactivity.clear(path)
+
+    def test_dirty_until_reset(self, tmp_path):
+        path = str(tmp_path / "state" / "activity")
+        clean_path = str(tmp_path / "state" / "clean")
+        # A new board server has no record of its board's last reset, so the board must be reset
+        assert not vlabactivity.is_clean(path, clean_path)
+        vlabactivity.mark_clean(path, clean_path)
+        assert vlabactivity.is_clean(path, clean_path)
+        vlabactivity.mark_used("jtag", path, clean_path)
+        assert not vlabactivity.is_clean(path, clean_path)
+        vlabactivity.mark_clean(path, clean_path)
+        assert vlabactivity.is_clean(path, clean_path)
+        assert vlabactivity.used_by(path) == set()
+        vlabactivity.mark_dirty(clean_path)
+        assert not vlabactivity.is_clean(path, clean_path)
+
+    def test_connections_to(self, tmp_path):
+        table = tmp_path / "tcp"
+        table.write_text(TCP_HEADER
+                         + tcp_line(3121, 0, "0A")        # hw_server listening
+                         + tcp_line(3121, 40000, "01")    # a client's connection
+                         + tcp_line(40000, 3121, "01")    # the client's end of it
+                         + tcp_line(3121, 40001, "06"))   # a closed connection
+        assert vlabactivity.connections_to(3121, [str(table), str(tmp_path / "missing")]) == {("0100007F", "9C40")}
+        assert vlabactivity.connections_to(22, [str(table)]) == set()
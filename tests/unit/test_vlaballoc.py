@@ -0,0 +1,220 @@
+"""Tests for vlabcommon/vlaballoc.py using fakeredis."""
+
+import json
+import socketserver
+import threading
+
+import pytest
+
+import vlaballoc
+import vlabclient
+import vlabredis
+
+
+@pytest.fixture
+def alloc_redis(populated_redis):
+    """populated_redis with board login details and a student allowed the vlab_test class."""
+    db = populated_redis
+    db.hset("vlab:board:BOARD001", "user", "root")
+    db.hset("vlab:board:BOARD002", "user", "root")
+    db.sadd("vlab:users", "student")
+    db.sadd("vlab:user:student:allowedboards", "vlab_test")
+    return db
+
+
+@pytest.mark.unit
+class TestAllocate:
+    def test_allocates_available_board(self, alloc_redis):
+        result = vlaballoc.allocate(alloc_redis, "testoverlord", "vlab_test")
+        assert "error" not in result
+        assert result["board"] == "BOARD001"
+        assert result["server"] == "boardserver1"
+        assert result["port"] == "30001"
+        assert alloc_redis.hget("vlab:board:BOARD001", "session:username") == "testoverlord"
+
+    def test_reuses_held_board(self, alloc_redis):
+        result = vlaballoc.allocate(alloc_redis, "testuser", "vlab_test")
+        assert result["board"] == "BOARD002"
+        assert "so reusing" in result["messages"][0]
+
+    def test_unknown_boardclass(self, alloc_redis):
+        result = vlaballoc.allocate(alloc_redis, "testuser", "nonexistent")
+        assert "does not exist" in result["error"]
+
+    def test_unknown_user(self, alloc_redis):
+        result = vlaballoc.allocate(alloc_redis, "nobody", "vlab_test")
+        assert "is not a VLAB user" in result["error"]
+
+    def test_boardclass_not_allowed(self, alloc_redis):
+        alloc_redis.sadd("vlab:users", "guest")
+        result = vlaballoc.allocate(alloc_redis, "guest", "vlab_test")
+        assert "cannot access" in result["error"]
+
+    def test_only_overlords_request_serials(self, alloc_redis):
+        result = vlaballoc.allocate(alloc_redis, "student", "vlab_test", "BOARD001")
+        assert "Only overlord" in result["error"]
+
+    def test_requested_board_locked(self, alloc_redis):
+        result = vlaballoc.allocate(alloc_redis, "testoverlord", "vlab_test", "BOARD002")
+        assert result["error"] == "Requested board is currently locked by testuser."
+
+    def test_no_free_boards(self, alloc_redis):
+        vlaballoc.allocate(alloc_redis, "testoverlord", "vlab_test")
+        result = vlaballoc.allocate(alloc_redis, "student", "vlab_test")
+        assert result["nofreeboards"]
+        assert result["messages"]
+        assert alloc_redis.get("vlab:boardclass:vlab_test:locking") is None
+
+
+@pytest.mark.unit
+class TestAccessCache:
+    def test_caches_known_users(self, alloc_redis):
+        cache = vlaballoc.AccessCache()
+        assert cache.get(alloc_redis, "student") == (True, False, {"vlab_test"})
+        alloc_redis.srem("vlab:user:student:allowedboards", "vlab_test")
+        assert cache.get(alloc_redis, "student") == (True, False, {"vlab_test"})
+
+    def test_does_not_cache_unknown_users(self, alloc_redis):
+        cache = vlaballoc.AccessCache()
+        assert cache.get(alloc_redis, "guest")[0] is False
+        alloc_redis.sadd("vlab:users", "guest")
+        assert cache.get(alloc_redis, "guest")[0] is True
+
+    def test_expiry(self, alloc_redis):
+        cache = vlaballoc.AccessCache(ttl=0)
+        cache.get(alloc_redis, "student")
+        alloc_redis.srem("vlab:user:student:allowedboards", "vlab_test")
+        assert cache.get(alloc_redis, "student") == (True, False, set())
+
+    def test_shared_between_threads(self, alloc_redis):
+        cache = vlaballoc.AccessCache(ttl=0)
+        errors = []
+
+        def lookups():
+            try:
+                for _ in range(100):
+                    assert cache.get(alloc_redis, "student") == (True, False, {"vlab_test"})
+                    assert cache.get(alloc_redis, "guest")[0] is False
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=lookups) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert set(cache.entries) == {"student"}
+
+
+@pytest.mark.unit
+class TestRequestAllocation:
+    def test_round_trip(self, tmp_path):
+        path = str(tmp_path / "allocator.sock")
+        requests = []
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                requests.append(json.loads(self.rfile.readline()))
+                self.wfile.write(b'{"board": "BOARD001", "messages": []}\n')
+
+        server = socketserver.UnixStreamServer(path, Handler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        try:
+            result = vlaballoc.request_allocation("vlab_test", "BOARD001", path=path, timeout=5)
+        finally:
+            thread.join()
+            server.server_close()
+        assert requests == [{"boardclass": "vlab_test", "serial": "BOARD001"}]
+        assert result["board"] == "BOARD001"
+
+    def test_daemon_not_running(self, tmp_path):
+        with pytest.raises(OSError):
+            vlaballoc.request_allocation("vlab_test", path=str(tmp_path / "missing.sock"))
+
+
+@pytest.fixture
+def full_redis(alloc_redis):
+    """alloc_redis with both boards in session, so a new user must queue."""
+    vlaballoc.allocate(alloc_redis, "testoverlord", "vlab_test")
+    alloc_redis.set("vlab:boardclass:vlab_test:queue", "true")
+    return alloc_redis
+
+
+def join(db, ticket, score):
+    db.set("vlab:waiter:{}:alive".format(ticket), 1)
+    db.zadd("vlab:boardclass:vlab_test:waiting", {ticket: score})
+
+
+@pytest.mark.unit
+class TestWaitQueue:
+    def test_queue_enabled(self, full_redis):
+        assert vlaballoc.queue_enabled(full_redis, "vlab_test")
+        assert not vlaballoc.queue_enabled(full_redis, "other_class")
+
+    def test_freed_board_is_handed_to_head_of_queue(self, full_redis):
+        db = full_redis
+        join(db, "student:a", 1)
+        join(db, "guest:b", 2)
+        board = vlaballoc.allocate(db, "testoverlord", "vlab_test")["board"]
+        start_time = db.hget("vlab:board:{}".format(board), "session:starttime")
+        vlabredis.unlock_board_if_user_time(db, board, "vlab_test", "testoverlord", start_time)
+        assert db.llen("vlab:waiter:student:a:board") == 0
+        vlabredis.end_session_if_user_time(db, board, "vlab_test", "testoverlord", start_time)
+        assert db.lrange("vlab:waiter:student:a:board", 0, -1) == [board]
+        assert db.hget("vlab:board:{}".format(board), "session:username") == "student"
+        assert db.hget("vlab:board:{}".format(board), "lock:username") == "student"
+        assert db.zrange("vlab:boardclass:vlab_test:waiting", 0, -1) == ["guest:b"]
+
+    def test_stale_waiters_are_skipped(self, full_redis):
+        db = full_redis
+        join(db, "student:a", 1)
+        join(db, "guest:b", 2)
+        db.delete("vlab:waiter:student:a:alive")
+        db.zadd("vlab:boardclass:vlab_test:availableboards", {"BOARD003": 0})
+        db.hset("vlab:board:BOARD003", "boardclass", "vlab_test")
+        assert vlabredis.serve_waiters(db, "vlab_test") == 1
+        assert db.lrange("vlab:waiter:guest:b:board", 0, -1) == ["BOARD003"]
+        assert db.zcard("vlab:boardclass:vlab_test:waiting") == 0
+
+    def test_no_queue_jumping(self, full_redis):
+        db = full_redis
+        join(db, "guest:b", 1)
+        db.zadd("vlab:boardclass:vlab_test:unlockedboards", {"BOARD002": 0})
+        result = vlaballoc.allocate(db, "student", "vlab_test")
+        assert result["nofreeboards"]
+
+    def test_poll_shorter_than_read_timeout(self):
+        # Waiters block in BLPOP for WAITER_POLL seconds, which must return before the socket times out
+        assert vlaballoc.WAITER_POLL < vlabclient.READ_TIMEOUT
+        assert vlabclient.get_pool().connection_kwargs["socket_timeout"] > vlaballoc.WAITER_POLL
+
+    def test_wait_for_board(self, full_redis, monkeypatch):
+        db = full_redis
+        monkeypatch.setattr(vlaballoc, "WAITER_POLL", 1)
+        positions = []
+
+        def notify(position, wait):
+            positions.append((position, wait))
+            # Free a board while we wait
+            vlabredis.end_session(db, "BOARD002", "vlab_test")
+            vlabredis.unlock_board(db, "BOARD002", "vlab_test")
+
+        result = vlaballoc.wait_for_board(db, "student", "vlab_test", notify)
+        assert positions[0][0] == 1
+        assert positions[0][1] is not None
+        assert result["board"] == "BOARD002"
+        assert db.hget("vlab:board:BOARD002", "session:username") == "student"
+        assert db.zcard("vlab:boardclass:vlab_test:waiting") == 0
+
+    def test_interrupted_wait_leaves_queue(self, full_redis, monkeypatch):
+        db = full_redis
+        monkeypatch.setattr(vlaballoc, "WAITER_POLL", 1)
+
+        def notify(position, wait):
+            raise KeyboardInterrupt
+
+        with pytest.raises(KeyboardInterrupt):
+            vlaballoc.wait_for_board(db, "student", "vlab_test", notify)
+        assert db.zcard("vlab:boardclass:vlab_test:waiting") == 0
+        assert not db.keys("vlab:waiter:*")
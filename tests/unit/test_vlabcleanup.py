@@ -0,0 +1,127 @@
+"""Tests for vlabcommon/vlabcleanup.py using fakeredis."""
+
+import json
+
+import pytest
+
+import vlabcleanup
+import vlabclient
+import vlabjobs
+import vlabredis
+
+
+@pytest.fixture
+def session(populated_redis):
+    """BOARD002's session by testuser, as a cleanup task."""
+    start_time = int(populated_redis.hget("vlab:board:BOARD002", "session:starttime"))
+    return {"board": "BOARD002", "boardclass": "vlab_test", "user": "testuser", "start_time": start_time}
+
+
+@pytest.fixture
+def resets(monkeypatch):
+    """Records the resets run, which succeed unless the next return code in 'results' says otherwise."""
+    calls = []
+    results = []
+
+    def fake_run_on_board(server, port, cmd, timeout=30, input=None):
+        calls.append((server, port, cmd))
+        return (results.pop(0) if results else 0), "", ""
+    monkeypatch.setattr(vlabjobs, "run_on_board", fake_run_on_board)
+    return calls, results
+
+
+@pytest.mark.unit
+class TestCleanupQueue:
+    def test_queue_and_take(self, mock_redis):
+        db = mock_redis
+        vlabcleanup.queue_cleanup(db, "BOARD002", "vlab_test", "testuser", 1234)
+        raw_task = vlabcleanup.take_cleanup(db, 1)
+        task = json.loads(raw_task)
+        assert (task["board"], task["boardclass"], task["user"], task["start_time"]) == \
+            ("BOARD002", "vlab_test", "testuser", 1234)
+        assert db.llen(vlabcleanup.CLEANUP_QUEUE) == 0
+        assert db.lrange(vlabcleanup.CLEANUP_PROCESSING, 0, -1) == [raw_task]
+        vlabcleanup.finish_cleanup(db, raw_task)
+        assert db.llen(vlabcleanup.CLEANUP_PROCESSING) == 0
+
+    def test_requeue_unfinished(self, mock_redis):
+        db = mock_redis
+        vlabcleanup.queue_cleanup(db, "BOARD001", "vlab_test", "testuser", 1234)
+        vlabcleanup.queue_cleanup(db, "BOARD002", "vlab_test", "testuser", 1234)
+        vlabcleanup.take_cleanup(db, 1)
+        assert vlabcleanup.requeue_unfinished(db) == 1
+        assert db.llen(vlabcleanup.CLEANUP_PROCESSING) == 0
+        boards = [json.loads(vlabcleanup.take_cleanup(db, 1))["board"] for _ in range(2)]
+        assert boards == ["BOARD001", "BOARD002"]
+        assert vlabcleanup.requeue_unfinished(db) == 2
+
+    def test_block_shorter_than_read_timeout(self):
+        assert vlabclient.BLOCK_TIMEOUT < vlabclient.READ_TIMEOUT
+
+    def test_worker_alive(self, mock_redis):
+        assert not vlabcleanup.worker_alive(mock_redis)
+        mock_redis.set(vlabcleanup.CLEANUP_WORKER_KEY, 1, ex=vlabcleanup.CLEANUP_WORKER_TTL)
+        assert vlabcleanup.worker_alive(mock_redis)
+
+
+@pytest.mark.unit
+class TestResetCommand:
+    def test_never_reset(self, populated_redis):
+        assert vlabcleanup.reset_command(populated_redis, "BOARD001") is None
+        assert vlabcleanup.reset_command(populated_redis, "BOARD001", always=True) is None
+
+    def test_reset_if_used(self, populated_redis):
+        db = populated_redis
+        db.set("vlab:knownboard:BOARD001:reset", "true")
+        assert vlabcleanup.reset_command(db, "BOARD001") == "python3 /vlab/activity.py reset"
+        assert vlabcleanup.reset_command(db, "BOARD001", always=True) == "python3 /vlab/activity.py reset always"
+
+    def test_class_policy(self, populated_redis):
+        db = populated_redis
+        db.set("vlab:knownboard:BOARD001:reset", "true")
+        db.set("vlab:boardclass:vlab_test:reset", "always")
+        assert vlabcleanup.reset_command(db, "BOARD001") == "python3 /vlab/activity.py reset always"
+
+
+@pytest.mark.unit
+class TestCleanupBoard:
+    def test_reset_then_release(self, populated_redis, session, resets):
+        db = populated_redis
+        calls, _ = resets
+        db.set("vlab:knownboard:BOARD002:reset", "true")
+        assert vlabcleanup.cleanup_board(db, session, delay=0) == (True, True, True)
+        assert calls == [("boardserver2", "30002", "python3 /vlab/activity.py reset")]
+        assert db.zscore("vlab:boardclass:vlab_test:availableboards", "BOARD002") is not None
+        assert db.hget("vlab:board:BOARD002", "session:username") is None
+
+    def test_no_reset_needed(self, populated_redis, session, resets):
+        calls, _ = resets
+        assert vlabcleanup.cleanup_board(populated_redis, session, delay=0) == (True, True, True)
+        assert calls == []
+
+    def test_reset_is_retried(self, populated_redis, session, resets):
+        db = populated_redis
+        calls, results = resets
+        db.set("vlab:knownboard:BOARD002:reset", "true")
+        results.extend([1, 255])
+        assert vlabcleanup.cleanup_board(db, session, delay=0) == (True, True, True)
+        assert len(calls) == 3
+
+    def test_released_after_failed_resets(self, populated_redis, session, resets):
+        db = populated_redis
+        calls, results = resets
+        db.set("vlab:knownboard:BOARD002:reset", "true")
+        results.extend([1] * vlabcleanup.RESET_ATTEMPTS)
+        assert vlabcleanup.cleanup_board(db, session, delay=0) == (False, True, True)
+        assert len(calls) == vlabcleanup.RESET_ATTEMPTS
+        assert db.zscore("vlab:boardclass:vlab_test:availableboards", "BOARD002") is not None
+
+    def test_board_taken_by_another_user(self, populated_redis, session, resets):
+        db = populated_redis
+        calls, _ = resets
+        db.set("vlab:knownboard:BOARD002:reset", "true")
+        vlabredis.start_session(db, "BOARD002", "vlab_test", "testoverlord", session["start_time"] + 1)
+        assert vlabcleanup.cleanup_board(db, session, delay=0) == (None, False, False)
+        # The new user's board is left alone
+        assert calls == []
+        assert db.hget("vlab:board:BOARD002", "session:username") == "testoverlord"
@@ -0,0 +1,76 @@
+"""Tests for vlabcommon/vlabclient.py."""
+
+import pytest
+import redis as redis_lib
+
+import vlabclient
+
+
+@pytest.fixture(autouse=True)
+def clean_pools(monkeypatch):
+    for var in ("VLAB_REDIS_HOST", "VLAB_REDIS_PORT", "VLAB_REDIS_SOCKET",
+                "VLAB_REDIS_CONNECT_TIMEOUT", "VLAB_REDIS_TIMEOUT", "VLAB_REDIS_RETRIES"):
+        monkeypatch.delenv(var, raising=False)
+    vlabclient.reset_pools()
+    yield
+    vlabclient.reset_pools()
+
+
+@pytest.mark.unit
+class TestPools:
+    def test_pool_is_reused(self):
+        a = vlabclient.get_pool(host="relay", port=6379)
+        b = vlabclient.get_pool(host="relay", port=6379)
+        assert a is b
+
+    def test_distinct_servers_get_distinct_pools(self):
+        a = vlabclient.get_pool(host="relay")
+        b = vlabclient.get_pool(host="other")
+        assert a is not b
+
+    def test_timeouts_applied(self):
+        pool = vlabclient.get_pool(host="relay", connect_timeout=1.5, timeout=2.5)
+        assert pool.connection_kwargs["socket_connect_timeout"] == 1.5
+        assert pool.connection_kwargs["socket_timeout"] == 2.5
+        assert pool.connection_kwargs["decode_responses"] is True
+
+    def test_environment_overrides_defaults(self, monkeypatch):
+        monkeypatch.setenv("VLAB_REDIS_PORT", "6380")
+        monkeypatch.setenv("VLAB_REDIS_TIMEOUT", "3")
+        pool = vlabclient.get_pool(host="relay")
+        assert pool.connection_kwargs["port"] == 6380
+        assert pool.connection_kwargs["socket_timeout"] == 3.0
+
+    def test_explicit_arguments_override_environment(self, monkeypatch):
+        monkeypatch.setenv("VLAB_REDIS_HOST", "envhost")
+        pool = vlabclient.get_pool(host="relay")
+        assert pool.connection_kwargs["host"] == "relay"
+
+    def test_unix_socket(self):
+        pool = vlabclient.get_pool(unix_socket="/tmp/redis.sock")
+        assert pool.connection_class is redis_lib.UnixDomainSocketConnection
+        assert pool.connection_kwargs["path"] == "/tmp/redis.sock"
+
+
+@pytest.mark.unit
+class TestRetry:
+    def test_backoff_is_exponential_and_bounded(self):
+        assert vlabclient.backoff_delays(5, base=0.5, cap=3) == [0.5, 1, 2, 3, 3]
+        assert vlabclient.backoff_delays(0) == []
+
+    def test_timeouts_are_not_retried(self):
+        # A command which timed out may have been run, and most VLAB commands are not safe to run twice
+        if vlabclient.Retry is None:
+            pytest.skip("redis-py without per-command retry support")
+        connection = vlabclient.get_pool(host="relay").make_connection()
+        assert redis_lib.exceptions.ConnectionError in connection.retry._supported_errors
+        assert redis_lib.exceptions.TimeoutError not in connection.retry._supported_errors
+        assert not connection.retry_on_timeout
+
+    def test_unreachable_server_raises(self):
+        with pytest.raises((redis_lib.exceptions.ConnectionError, redis_lib.exceptions.TimeoutError)):
+            vlabclient.get_client(host="127.0.0.1", port=1, connect_timeout=0.5, retries=0)
+
+    def test_no_ping(self):
+        db = vlabclient.get_client(host="127.0.0.1", port=1, retries=0, ping=False)
+        assert isinstance(db, redis_lib.Redis)
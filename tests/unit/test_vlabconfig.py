@@ -96,6 +96,51 @@ class TestOpenLogValid:
         assert result is not None
 
 
+    def test_boardclass_queue_setting(self, tmp_path):
+        conf = tmp_path / "vlab.conf"
+        conf.write_text(json.dumps({
+            "users": {"u1": {}},
+            "boards": {"B1": {"class": "c", "type": "t"}},
+            "boardclasses": {"c": {"queue": True}},
+        }))
+        log = logging.getLogger("test")
+        result = vlabconfig.open_log(log, str(conf))
+        assert result["boardclasses"]["c"]["queue"] is True
+
+    def test_cohorts(self, tmp_path):
+        conf = tmp_path / "vlab.conf"
+        conf.write_text(json.dumps({
+            "users": {"u1": {}, "u2": {}},
+            "boards": {"B1": {"class": "c", "type": "t"}},
+            "cohorts": {"lab1": ["u1", "u2"]},
+        }))
+        log = logging.getLogger("test")
+        result = vlabconfig.open_log(log, str(conf))
+        assert result["cohorts"]["lab1"] == ["u1", "u2"]
+
+    def test_boardclass_policy_setting(self, tmp_path):
+        conf = tmp_path / "vlab.conf"
+        conf.write_text(json.dumps({
+            "users": {"u1": {}},
+            "boards": {"B1": {"class": "c", "type": "t"}},
+            "boardclasses": {"c": {"policy": "leastloaded"}},
+        }))
+        log = logging.getLogger("test")
+        result = vlabconfig.open_log(log, str(conf))
+        assert result["boardclasses"]["c"]["policy"] == "leastloaded"
+
+    def test_boardclass_reset_setting(self, tmp_path):
+        conf = tmp_path / "vlab.conf"
+        conf.write_text(json.dumps({
+            "users": {"u1": {}},
+            "boards": {"B1": {"class": "c", "type": "t", "reset": "true"}},
+            "boardclasses": {"c": {"reset": "always"}},
+        }))
+        log = logging.getLogger("test")
+        result = vlabconfig.open_log(log, str(conf))
+        assert result["boardclasses"]["c"]["reset"] == "always"
+
+
 @pytest.mark.unit
 class TestOpenLogInvalid:
     """Invalid configs should return None."""
@@ -108,6 +153,16 @@ class TestOpenLogInvalid:
         log = logging.getLogger("test")
         assert vlabconfig.open_log(log, str(conf)) is None
 
+    def test_cohort_unknown_user(self, tmp_path):
+        conf = tmp_path / "vlab.conf"
+        conf.write_text(json.dumps({
+            "users": {"u1": {}},
+            "boards": {"B1": {"class": "c", "type": "t"}},
+            "cohorts": {"lab1": ["u1", "nobody"]},
+        }))
+        log = logging.getLogger("test")
+        assert vlabconfig.open_log(log, str(conf)) is None
+
     def test_missing_boards(self, tmp_path):
         conf = tmp_path / "vlab.conf"
         conf.write_text(json.dumps({
@@ -125,6 +180,16 @@ class TestOpenLogInvalid:
         log = logging.getLogger("test")
         assert vlabconfig.open_log(log, str(conf)) is None
 
+    def test_unknown_boardclass_property(self, tmp_path):
+        conf = tmp_path / "vlab.conf"
+        conf.write_text(json.dumps({
+            "users": {"u1": {}},
+            "boards": {"B1": {"class": "c", "type": "t"}},
+            "boardclasses": {"c": {"badprop": True}},
+        }))
+        log = logging.getLogger("test")
+        assert vlabconfig.open_log(log, str(conf)) is None
+
     def test_missing_board_class(self, tmp_path):
         conf = tmp_path / "vlab.conf"
         conf.write_text(json.dumps({
@@ -0,0 +1,190 @@
+"""Tests for vlabcommon/vlabjobs.py using fakeredis."""
+
+import io
+import os
+import subprocess
+import tarfile
+
+import pytest
+
+import vlabclient
+import vlabjobs
+
+
+def make_archive(files):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+@pytest.fixture
+def jobs_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(vlabjobs, "JOBS_DIR", str(tmp_path))
+    return tmp_path
+
+
+@pytest.mark.unit
+class TestCheckJobArchive:
+    def test_valid(self):
+        assert vlabjobs.check_job_archive(make_archive({"design.bit": b"bits"})) is None
+        assert vlabjobs.check_job_archive(make_archive({"design.bit": b"bits", "app.elf": b"elf"})) is None
+
+    def test_not_a_tar(self):
+        assert "not a valid tar" in vlabjobs.check_job_archive(b"not a tar archive")
+
+    def test_missing_bitstream(self):
+        assert "bitstream" in vlabjobs.check_job_archive(make_archive({"app.elf": b"elf"}))
+
+    def test_unexpected_files(self):
+        assert "Unexpected file" in vlabjobs.check_job_archive(make_archive({"design.bit": b"", "../x": b""}))
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode="w") as tar:
+            info = tarfile.TarInfo("design.bit")
+            info.type = tarfile.SYMTYPE
+            info.linkname = "/etc/shadow"
+            tar.addfile(info)
+        assert "Unexpected file" in vlabjobs.check_job_archive(data.getvalue())
+
+    def test_too_large(self, monkeypatch):
+        monkeypatch.setattr(vlabjobs, "MAX_JOB_SIZE", 10)
+        assert "at most" in vlabjobs.check_job_archive(make_archive({"design.bit": b"bits"}))
+
+
+@pytest.mark.unit
+class TestJobQueue:
+    def test_submit_and_take(self, mock_redis, jobs_dir):
+        db = mock_redis
+        first = vlabjobs.submit_job(db, "testuser", "vlab_test", 10, make_archive({"design.bit": b"1"}))
+        second = vlabjobs.submit_job(db, "testoverlord", "vlab_test", 20, make_archive({"design.bit": b"2"}))
+        with open(vlabjobs.job_archive(vlabjobs.get_job(db, first)), "rb") as f:
+            assert f.read() == make_archive({"design.bit": b"1"})
+        assert vlabjobs.queue_position(db, first) == 1
+        assert vlabjobs.queue_position(db, second) == 2
+        job = vlabjobs.get_job(db, first)
+        assert job["user"] == "testuser"
+        assert job["status"] == "queued"
+        assert job["timeout"] == "10"
+
+        job = vlabjobs.take_job(db, "vlab_test")
+        assert job["id"] == str(first)
+        assert job["status"] == "running"
+        assert vlabjobs.queue_position(db, first) is None
+        assert vlabjobs.queue_position(db, second) == 1
+
+    def test_planted_archive(self, mock_redis, jobs_dir):
+        # Another user creating a file where the next job's archive might go cannot block or replace it
+        (jobs_dir / "1.tar").write_bytes(b"planted")
+        (jobs_dir / "1.tar").chmod(0o400)
+        job_id = vlabjobs.submit_job(mock_redis, "testuser", "vlab_test", 10, make_archive({"design.bit": b"1"}))
+        assert job_id == 1
+        archive = vlabjobs.job_archive(vlabjobs.get_job(mock_redis, job_id))
+        assert os.path.basename(archive) != "1.tar"
+        with open(archive, "rb") as f:
+            assert f.read() == make_archive({"design.bit": b"1"})
+
+    def test_take_from_empty_queue(self, mock_redis):
+        assert vlabjobs.take_job(mock_redis, "vlab_test") is None
+
+    def test_get_unknown_job(self, mock_redis):
+        assert vlabjobs.get_job(mock_redis, 42) is None
+        assert vlabjobs.queue_position(mock_redis, 42) is None
+
+    def test_finish_and_wait(self, mock_redis, jobs_dir):
+        db = mock_redis
+        job_id = vlabjobs.submit_job(db, "testuser", "vlab_test", 10, make_archive({"design.bit": b"1"}))
+        archive = vlabjobs.job_archive(vlabjobs.take_job(db, "vlab_test"))
+        vlabjobs.finish_job(db, job_id, "done", "Hello from the board\n")
+        assert not os.path.exists(archive)
+        job = vlabjobs.wait_for_job(db, job_id, 1)
+        assert job["status"] == "done"
+        assert job["output"] == "Hello from the board\n"
+        assert 0 < db.ttl("vlab:job:{}".format(job_id)) <= vlabjobs.JOB_TTL
+
+    def test_wait_blocks_in_slices(self, mock_redis, monkeypatch):
+        # Each blocking pop must return before the client's read timeout, however long the wait
+        clock = [1000.0]
+        blocks = []
+
+        def fake_blpop(key, timeout):
+            blocks.append(timeout)
+            clock[0] += timeout
+            return None
+        monkeypatch.setattr(vlabjobs.time, "time", lambda: clock[0])
+        monkeypatch.setattr(mock_redis, "blpop", fake_blpop)
+        assert vlabjobs.wait_for_job(mock_redis, 42, 12) is None
+        assert sum(blocks) == 12
+        assert max(blocks) < vlabclient.READ_TIMEOUT
+
+    def test_output_is_truncated(self, mock_redis, jobs_dir, monkeypatch):
+        monkeypatch.setattr(vlabjobs, "MAX_JOB_OUTPUT", 4)
+        job_id = vlabjobs.submit_job(mock_redis, "testuser", "vlab_test", 10, make_archive({"design.bit": b"1"}))
+        vlabjobs.finish_job(mock_redis, job_id, "done", "0123456789")
+        output = vlabjobs.get_job(mock_redis, job_id)["output"]
+        assert output.startswith("0123\n")
+        assert "truncated" in output
+
+    def test_jobs_of_user(self, mock_redis, jobs_dir):
+        db = mock_redis
+        first = vlabjobs.submit_job(db, "testuser", "vlab_test", 10, make_archive({"design.bit": b"1"}))
+        second = vlabjobs.submit_job(db, "testuser", "vlab_test", 10, make_archive({"design.bit": b"2"}))
+        vlabjobs.submit_job(db, "testoverlord", "vlab_test", 10, make_archive({"design.bit": b"3"}))
+        db.delete("vlab:job:{}".format(first))
+        assert [job["id"] for job in vlabjobs.get_jobs_of(db, "testuser")] == [str(second)]
+        assert db.zcard("vlab:user:testuser:jobs") == 1
+
+    def test_print_job(self, capsys):
+        assert vlabjobs.print_job({"id": "1", "status": "queued"}) == 2
+        assert vlabjobs.print_job({"id": "1", "status": "done", "board": "BOARD001", "output": "OK\n"}) == 0
+        assert "OK\n" in capsys.readouterr().out
+        assert vlabjobs.print_job({"id": "1", "status": "failed", "message": "xsdb failed", "output": ""}) == 1
+        assert "xsdb failed" in capsys.readouterr().out
+
+
+@pytest.mark.unit
+class TestRunJob:
+    def test_arguments(self, mock_redis, jobs_dir, monkeypatch):
+        calls = []
+
+        def fake_program(server, port, args, setup, input, timeout, owner):
+            calls.append((server, port, args, setup, input, timeout, owner))
+            return True, "output", ""
+        monkeypatch.setattr(vlabjobs, "program_and_read_serial", fake_program)
+
+        archive = make_archive({"design.bit": b"bits", "app.elf": b"elf"})
+        job_id = vlabjobs.submit_job(mock_redis, "testuser", "vlab_test", 10, archive)
+        job = vlabjobs.take_job(mock_redis, "vlab_test")
+        assert job["id"] == str(job_id)
+        assert vlabjobs.run_job(job, "boardserver1", "30001") == (True, "output", "")
+        server, port, args, setup, data, timeout, owner = calls[0]
+        assert (server, port) == ("boardserver1", "30001")
+        assert args == ["/tmp/vlab_job/design.bit", "/tmp/vlab_job/app.elf", "/vlab/test/ps7_init.tcl", 10000]
+        assert "tar -x" in setup
+        assert data == archive
+        assert timeout > 10
+        assert owner == "batch:testuser"
+
+    def test_bitstream_only(self, mock_redis, jobs_dir, monkeypatch):
+        calls = []
+        monkeypatch.setattr(vlabjobs, "program_and_read_serial", lambda *args, **kwargs: calls.append(args[2]))
+        vlabjobs.submit_job(mock_redis, "testuser", "vlab_test", 5, make_archive({"design.bit": b"bits"}))
+        vlabjobs.run_job(vlabjobs.take_job(mock_redis, "vlab_test"), "boardserver1", "30001")
+        assert calls[0][1] == "-"
+
+    def test_missing_archive(self, mock_redis, jobs_dir):
+        job_id = vlabjobs.submit_job(mock_redis, "testuser", "vlab_test", 5, make_archive({"design.bit": b"bits"}))
+        os.remove(vlabjobs.job_archive(vlabjobs.get_job(mock_redis, job_id)))
+        ok, output, message = vlabjobs.run_job(vlabjobs.take_job(mock_redis, "vlab_test"), "boardserver1", "30001")
+        assert not ok
+        assert "Could not read" in message
+
+    def test_ssh_timeout(self, monkeypatch):
+        def fake_run(args, **kwargs):
+            raise subprocess.TimeoutExpired(args, kwargs["timeout"])
+        monkeypatch.setattr(subprocess, "run", fake_run)
+        ok, output, message = vlabjobs.program_and_read_serial("boardserver1", "30001", timeout=5)
+        assert not ok
+        assert "timed out after 5s" in message
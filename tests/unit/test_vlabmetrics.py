@@ -0,0 +1,95 @@
+"""Tests for vlabcommon/vlabmetrics.py using fakeredis."""
+
+import json
+import types
+
+import pytest
+
+import vlabmetrics
+import vlabredis
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    vlabmetrics.reset()
+    yield
+    vlabmetrics.reset()
+
+
+@pytest.fixture
+def instrumented(populated_redis):
+    return vlabmetrics.InstrumentedRedis(connection_pool=populated_redis.connection_pool)
+
+
+@pytest.mark.unit
+class TestInstrumentedRedis:
+    def test_counts_commands(self, instrumented):
+        instrumented.smembers("vlab:boardclasses")
+        instrumented.hgetall("vlab:board:BOARD001")
+        totals = vlabmetrics.snapshot()["totals"]
+        assert totals["round_trips"] == 2
+        assert totals["commands"] == 2
+        commands = vlabmetrics.snapshot()["commands"]
+        assert commands["SMEMBERS"]["count"] == 1
+        assert sum(commands["HGETALL"]["histogram"]) == 1
+
+    def test_pipeline_is_one_round_trip(self, instrumented):
+        with instrumented.pipeline() as pipe:
+            pipe.smembers("vlab:boardclasses")
+            pipe.scard("vlab:users")
+            pipe.execute()
+        snapshot = vlabmetrics.snapshot()
+        assert snapshot["totals"] == dict(snapshot["totals"], round_trips=1, commands=2)
+        assert snapshot["commands"]["PIPELINE"]["count"] == 1
+
+    def test_scripts_are_counted(self, instrumented):
+        vlabredis.lock_board(instrumented, "BOARD001", "vlab_test", "testuser", 1234)
+        assert vlabmetrics.snapshot()["totals"]["round_trips"] >= 1
+
+
+@pytest.mark.unit
+class TestFunctions:
+    def test_round_trips_attributed_to_innermost_function(self, instrumented):
+        inner = vlabmetrics.instrument("inner", lambda db: db.get("vlab:port"))
+
+        def outer_fn(db):
+            db.smembers("vlab:users")
+            return inner(db)
+
+        outer = vlabmetrics.instrument("outer", outer_fn)
+        outer(instrumented)
+        outer(instrumented)
+        functions = vlabmetrics.snapshot()["functions"]
+        assert functions["outer"]["calls"] == 2
+        assert functions["outer"]["round_trips"] == 2
+        assert functions["inner"]["calls"] == 2
+        assert functions["inner"]["commands"] == 2
+
+    def test_instrument_module(self):
+        module = types.ModuleType("fakemodule")
+        exec("def public():\n\treturn 1\n\ndef _private():\n\treturn 2\n", module.__dict__)
+        vlabmetrics.instrument_module(module)
+        assert module.public() == 1
+        assert module._private() == 2
+        assert vlabmetrics.snapshot()["functions"] == {
+            "fakemodule.public": {"calls": 1, "round_trips": 0, "commands": 0, "time_ms": 0.0}}
+
+
+@pytest.mark.unit
+class TestOutput:
+    def test_enabled(self, monkeypatch):
+        monkeypatch.delenv("VLAB_METRICS", raising=False)
+        assert not vlabmetrics.enabled()
+        monkeypatch.setenv("VLAB_METRICS", "0")
+        assert not vlabmetrics.enabled()
+        monkeypatch.setenv("VLAB_METRICS", "/tmp/metrics.log")
+        assert vlabmetrics.enabled()
+
+    def test_dump_appends_json(self, instrumented, tmp_path):
+        path = tmp_path / "metrics.log"
+        instrumented.get("vlab:port")
+        vlabmetrics.dump(str(path))
+        vlabmetrics.dump(str(path))
+        lines = path.read_text().splitlines()
+        assert len(lines) == 2
+        assert json.loads(lines[0])["commands"]["GET"]["count"] == 1
@@ -0,0 +1,41 @@
+"""Tests for vlabcommon/vlabreconciler.py using fakeredis."""
+
+import pytest
+
+import vlabreconciler
+
+
+@pytest.mark.unit
+class TestClaim:
+    def test_single_instance(self, mock_redis):
+        db = mock_redis
+        assert vlabreconciler.claim(db, "relay:100")
+        assert not vlabreconciler.claim(db, "relay:200")
+        assert vlabreconciler.holder(db) == "relay:100"
+        # Renewing an instance's own claim extends it
+        db.expire(vlabreconciler.RECONCILER_KEY, 1)
+        assert vlabreconciler.claim(db, "relay:100")
+        assert db.ttl(vlabreconciler.RECONCILER_KEY) == vlabreconciler.RECONCILER_TTL
+
+    def test_release(self, mock_redis):
+        db = mock_redis
+        vlabreconciler.claim(db, "relay:100")
+        assert not vlabreconciler.release(db, "relay:200")
+        assert vlabreconciler.release(db, "relay:100")
+        assert vlabreconciler.holder(db) is None
+        assert vlabreconciler.claim(db, "relay:200")
+
+
+@pytest.mark.unit
+class TestMetrics:
+    def test_record_cycle(self, mock_redis):
+        db = mock_redis
+        assert vlabreconciler.get_metrics(db) == {}
+        vlabreconciler.record_cycle(db, "locks", 0.5, 1000)
+        vlabreconciler.record_cycle(db, "locks", 2.0, 1060)
+        vlabreconciler.record_cycle(db, "locks", 0.25, 1120)
+        vlabreconciler.record_cycle(db, "ssh", 3.0, 1000)
+        assert vlabreconciler.get_metrics(db) == {
+            "locks": {"duration": 0.25, "max": 2.0, "cycles": 3, "last": 1120},
+            "ssh": {"duration": 3.0, "max": 3.0, "cycles": 1, "last": 1000},
+        }
@@ -1,5 +1,6 @@
 """Tests for vlabcommon/vlabredis.py functions using fakeredis."""
 
+import threading
 import time
 
 import pytest
@@ -16,8 +17,8 @@ class TestLockUnlock:
         # BOARD001 is currently unlocked; lock it
         vlabredis.lock_board(db, "BOARD001", "vlab_test", "testuser", now)
 
-        assert db.get("vlab:board:BOARD001:lock:username") == "testuser"
-        assert db.get("vlab:board:BOARD001:lock:time") == str(now)
+        assert db.hget("vlab:board:BOARD001", "lock:username") == "testuser"
+        assert db.hget("vlab:board:BOARD001", "lock:time") == str(now)
         # Should have been removed from unlocked set
         assert db.zscore("vlab:boardclass:vlab_test:unlockedboards", "BOARD001") is None
 
@@ -26,8 +27,8 @@ class TestLockUnlock:
         # BOARD002 is locked; unlock it
         result = vlabredis.unlock_board(db, "BOARD002", "vlab_test")
         assert result is True
-        assert db.get("vlab:board:BOARD002:lock:username") is None
-        assert db.get("vlab:board:BOARD002:lock:time") is None
+        assert db.hget("vlab:board:BOARD002", "lock:username") is None
+        assert db.hget("vlab:board:BOARD002", "lock:time") is None
         assert db.zscore("vlab:boardclass:vlab_test:unlockedboards", "BOARD002") is not None
 
     def test_unlock_board_if_user_correct(self, populated_redis):
@@ -43,7 +44,7 @@ class TestLockUnlock:
 
     def test_unlock_board_if_user_time_correct(self, populated_redis):
         db = populated_redis
-        lock_time = db.get("vlab:board:BOARD002:lock:time")
+        lock_time = db.hget("vlab:board:BOARD002", "lock:time")
         result = vlabredis.unlock_board_if_user_time(
             db, "BOARD002", "vlab_test", "testuser", int(lock_time)
         )
@@ -60,7 +61,7 @@ class TestLockUnlock:
         db = populated_redis
         # BOARD002 is locked by testuser
         vlabredis.unlock_boards_held_by(db, "testuser")
-        assert db.get("vlab:board:BOARD002:lock:username") is None
+        assert db.hget("vlab:board:BOARD002", "lock:username") is None
 
 
 @pytest.mark.unit
@@ -71,22 +72,22 @@ class TestSessions:
         # Start a session on BOARD001 (currently available)
         vlabredis.start_session(db, "BOARD001", "vlab_test", "testoverlord", now)
 
-        assert db.get("vlab:board:BOARD001:session:username") == "testoverlord"
-        assert db.get("vlab:board:BOARD001:session:starttime") == str(now)
-        assert db.get("vlab:board:BOARD001:session:pingtime") == str(now)
+        assert db.hget("vlab:board:BOARD001", "session:username") == "testoverlord"
+        assert db.hget("vlab:board:BOARD001", "session:starttime") == str(now)
+        assert db.hget("vlab:board:BOARD001", "session:pingtime") == str(now)
         # Should be removed from available
         assert db.zscore("vlab:boardclass:vlab_test:availableboards", "BOARD001") is None
         # Should be locked
-        assert db.get("vlab:board:BOARD001:lock:username") == "testoverlord"
+        assert db.hget("vlab:board:BOARD001", "lock:username") == "testoverlord"
 
     def test_end_session(self, populated_redis):
         db = populated_redis
         # BOARD002 has an active session
         result = vlabredis.end_session(db, "BOARD002", "vlab_test")
         assert result is True
-        assert db.get("vlab:board:BOARD002:session:username") is None
-        assert db.get("vlab:board:BOARD002:session:starttime") is None
-        assert db.get("vlab:board:BOARD002:session:pingtime") is None
+        assert db.hget("vlab:board:BOARD002", "session:username") is None
+        assert db.hget("vlab:board:BOARD002", "session:starttime") is None
+        assert db.hget("vlab:board:BOARD002", "session:pingtime") is None
         assert db.zscore("vlab:boardclass:vlab_test:availableboards", "BOARD002") is not None
 
     def test_end_session_if_user_correct(self, populated_redis):
@@ -101,7 +102,7 @@ class TestSessions:
 
     def test_end_session_if_user_time_correct(self, populated_redis):
         db = populated_redis
-        start_time = db.get("vlab:board:BOARD002:session:starttime")
+        start_time = db.hget("vlab:board:BOARD002", "session:starttime")
         result = vlabredis.end_session_if_user_time(
             db, "BOARD002", "vlab_test", "testuser", int(start_time)
         )
@@ -119,11 +120,11 @@ class TestSessions:
 class TestPingSession:
     def test_ping_session(self, populated_redis):
         db = populated_redis
-        before = db.get("vlab:board:BOARD002:session:pingtime")
+        before = db.hget("vlab:board:BOARD002", "session:pingtime")
         time.sleep(0.01)  # ensure time advances
         result = vlabredis.ping_session(db, "BOARD002")
         assert result is True
-        after = db.get("vlab:board:BOARD002:session:pingtime")
+        after = db.hget("vlab:board:BOARD002", "session:pingtime")
         assert int(after) >= int(before)
 
     def test_ping_session_if_user_correct(self, populated_redis):
@@ -138,7 +139,7 @@ class TestPingSession:
 
     def test_ping_session_if_user_time_correct(self, populated_redis):
         db = populated_redis
-        start_time = db.get("vlab:board:BOARD002:session:starttime")
+        start_time = db.hget("vlab:board:BOARD002", "session:starttime")
         result = vlabredis.ping_session_if_user_time(
             db, "BOARD002", "testuser", int(start_time)
         )
@@ -153,38 +154,233 @@ class TestPingSession:
 
 
 @pytest.mark.unit
-class TestAllocation:
-    def test_allocate_available_board(self, populated_redis):
+class TestAllocateAndStartSession:
+    def test_allocates_available_board(self, populated_redis):
         db = populated_redis
-        board = vlabredis.allocate_available_board_of_class(db, "vlab_test")
+        now = int(time.time())
+        board, pool = vlabredis.allocate_board_and_start_session(db, "vlab_test", "testoverlord", now)
         assert board == "BOARD001"
-        # Second call: no more available — _zpopmin sends ZREM None which
-        # works on real Redis but fakeredis raises DataError
-        try:
-            board2 = vlabredis.allocate_available_board_of_class(db, "vlab_test")
-            assert board2 is None
-        except redis_lib.exceptions.DataError:
-            pass  # expected with fakeredis when set is empty
+        assert pool == "available"
+        record = db.hgetall("vlab:board:BOARD001")
+        assert record["lock:username"] == "testoverlord"
+        assert record["lock:time"] == str(now)
+        assert record["session:username"] == "testoverlord"
+        assert record["session:starttime"] == str(now)
+        assert record["session:pingtime"] == str(now)
+        assert db.zscore("vlab:boardclass:vlab_test:availableboards", "BOARD001") is None
+        assert db.zscore("vlab:boardclass:vlab_test:unlockedboards", "BOARD001") is None
 
-    def test_allocate_unlocked_board(self, populated_redis):
+    def test_falls_back_to_unlocked_board(self, populated_redis):
         db = populated_redis
-        board = vlabredis.allocate_unlocked_board_of_class(db, "vlab_test")
-        assert board == "BOARD001"
-        # Second call: same _zpopmin edge case as above
-        try:
-            board2 = vlabredis.allocate_unlocked_board_of_class(db, "vlab_test")
-            assert board2 is None
-        except redis_lib.exceptions.DataError:
-            pass
+        db.zrem("vlab:boardclass:vlab_test:availableboards", "BOARD001")
+        db.zrem("vlab:boardclass:vlab_test:unlockedboards", "BOARD001")
+        vlabredis.unlock_board(db, "BOARD002", "vlab_test")
+        board, pool = vlabredis.allocate_board_and_start_session(db, "vlab_test", "testoverlord", 1234)
+        assert board == "BOARD002"
+        assert pool == "unlocked"
+        assert db.hget("vlab:board:BOARD002", "session:username") == "testoverlord"
+
+    def test_no_free_boards(self, populated_redis):
+        db = populated_redis
+        vlabredis.allocate_board_and_start_session(db, "vlab_test", "testoverlord", 1234)
+        assert vlabredis.allocate_board_and_start_session(db, "vlab_test", "testuser", 1235) == (None, None)
+
+    def test_without_scripting(self, populated_redis, monkeypatch):
+        db = populated_redis
+
+        def no_scripting(*args):
+            raise redis_lib.exceptions.ResponseError("unknown command 'EVALSHA'")
+        monkeypatch.setattr(db, "evalsha", no_scripting)
+
+        board, pool = vlabredis.allocate_board_and_start_session(db, "vlab_test", "testoverlord", 1234)
+        assert (board, pool) == ("BOARD001", "available")
+        assert db.hget("vlab:board:BOARD001", "lock:username") == "testoverlord"
+        assert db.zscore("vlab:boardclass:vlab_test:availableboards", "BOARD001") is None
+        assert vlabredis.allocate_board_and_start_session(db, "vlab_test", "testuser", 1235) == (None, None)
 
-    def test_allocate_from_empty_class(self, mock_redis):
+    @pytest.mark.parametrize("scripting", [True, False])
+    def test_idle_only(self, populated_redis, monkeypatch, scripting):
+        db = populated_redis
+        # BOARD002's lock has expired, but it is still in use so is not idle
+        vlabredis.unlock_board(db, "BOARD002", "vlab_test")
+        if not scripting:
+            def no_scripting(*args):
+                raise redis_lib.exceptions.ResponseError("unknown command 'EVALSHA'")
+            monkeypatch.setattr(db, "evalsha", no_scripting)
+        board, pool = vlabredis.allocate_board_and_start_session(db, "vlab_test", "batch:testuser", 1234, True)
+        assert (board, pool) == ("BOARD001", "available")
+        assert vlabredis.allocate_board_and_start_session(db, "vlab_test", "batch:testuser", 1235, True) == \
+            (None, None)
+        assert db.hget("vlab:board:BOARD002", "session:username") == "testuser"
+
+
+@pytest.mark.unit
+class TestAllocationPolicies:
+    def _add_boards(self, db, boards):
+        # boards is a list of (serial, server), in least-recently-used order
+        for i, (board, server) in enumerate(boards):
+            vlabredis.register_board(db, board, "vlab_test", {"user": "root", "server": server, "port": "3000"})
+            db.zadd("vlab:boardclass:vlab_test:availableboards", {board: i})
+            db.zadd("vlab:boardclass:vlab_test:unlockedboards", {board: i})
+
+    def test_lru_by_default(self, mock_redis):
         db = mock_redis
-        # _zpopmin sends ZREM None on empty sets — fakeredis raises DataError
-        try:
-            board = vlabredis.allocate_available_board_of_class(db, "nonexistent")
-            assert board is None
-        except redis_lib.exceptions.DataError:
-            pass
+        self._add_boards(db, [("B1", "host1"), ("B2", "host2")])
+        assert vlabredis.allocate_board_and_start_session(db, "vlab_test", "testuser", 1234)[0] == "B1"
+        assert db.hget("vlab:board:B1", "session:policy") == "lru"
+
+    def test_affinity(self, mock_redis):
+        db = mock_redis
+        self._add_boards(db, [("B1", "host1"), ("B2", "host2"), ("B3", "host3")])
+        db.set("vlab:boardclass:vlab_test:policy", "affinity")
+        vlabredis.start_session(db, "B2", "vlab_test", "testuser", 1000)
+        vlabredis.unlock_board(db, "B2", "vlab_test")
+        vlabredis.end_session(db, "B2", "vlab_test")
+        # B2 is now the most recently used board, but testuser gets it back
+        assert vlabredis.allocate_board_and_start_session(db, "vlab_test", "testuser", 1234)[0] == "B2"
+        assert db.hget("vlab:board:B2", "session:policy") == "affinity"
+        # Other users, and users whose last board is taken, get the least-recently-used board
+        assert vlabredis.allocate_board_and_start_session(db, "vlab_test", "testoverlord", 1234)[0] == "B1"
+
+    def test_least_loaded(self, mock_redis):
+        db = mock_redis
+        self._add_boards(db, [("B1", "host1"), ("B2", "host1"), ("B3", "host2"), ("B4", "host2")])
+        db.set("vlab:boardclass:vlab_test:policy", "leastloaded")
+        picked = [vlabredis.allocate_board_and_start_session(db, "vlab_test", user, 1234)[0]
+                  for user in ["u1", "u2", "u3"]]
+        assert picked == ["B1", "B3", "B2"]
+        assert db.smembers("vlab:host:host1:sessions") == {"B1", "B2"}
+        vlabredis.end_session(db, "B1", "vlab_test")
+        assert db.smembers("vlab:host:host1:sessions") == {"B2"}
+
+    def test_unknown_policy_is_lru(self, mock_redis):
+        db = mock_redis
+        self._add_boards(db, [("B1", "host1"), ("B2", "host2")])
+        db.set("vlab:boardclass:vlab_test:policy", "nosuchpolicy")
+        assert vlabredis.allocate_board_and_start_session(db, "vlab_test", "testuser", 1234)[0] == "B1"
+        assert db.hget("vlab:board:B1", "session:policy") == "lru"
+
+    def test_added_policy(self, mock_redis, monkeypatch):
+        db = mock_redis
+        self._add_boards(db, [("B1", "host1"), ("B2", "host2")])
+        monkeypatch.setitem(vlabredis.ALLOCATION_POLICIES, "mru", "return redis.call('ZRANGE', pool, -1, -1)[1]")
+        db.set("vlab:boardclass:vlab_test:policy", "mru")
+        assert vlabredis.allocate_board_and_start_session(db, "vlab_test", "testuser", 1234)[0] == "B2"
+
+    def test_allocation_script_rebuilt_only_when_policies_change(self, monkeypatch):
+        lua = vlabredis._allocate_and_start_session_lua()
+        assert vlabredis._allocate_and_start_session_lua() is lua
+        monkeypatch.setitem(vlabredis.ALLOCATION_POLICIES, "mru", "return redis.call('ZRANGE', pool, -1, -1)[1]")
+        assert '["mru"]' in vlabredis._allocate_and_start_session_lua()
+
+    def test_policy_cleared_when_session_ends_or_is_taken_over(self, mock_redis):
+        db = mock_redis
+        self._add_boards(db, [("B1", "host1")])
+        vlabredis.allocate_board_and_start_session(db, "vlab_test", "testuser", 1234)
+        vlabredis.start_session(db, "B1", "vlab_test", "testoverlord", 1235)
+        assert db.hget("vlab:board:B1", "session:policy") is None
+        vlabredis.end_session(db, "B1", "vlab_test")
+        assert db.smembers("vlab:host:host1:sessions") == set()
+
+    def test_rebuild_host_index(self, populated_redis):
+        db = populated_redis
+        db.sadd("vlab:host:boardserver1:sessions", "BOARD001")
+        assert vlabredis.rebuild_host_index(db) == 1
+        assert db.smembers("vlab:host:boardserver2:sessions") == {"BOARD002"}
+        assert not db.exists("vlab:host:boardserver1:sessions")
+
+
+@pytest.mark.unit
+class TestReservations:
+    def _add_boards(self, db, count):
+        for i in range(count):
+            board = "B{}".format(i)
+            vlabredis.register_board(db, board, "vlab_test", {"user": "root", "server": "host", "port": "3000"})
+            db.zadd("vlab:boardclass:vlab_test:availableboards", {board: i})
+            db.zadd("vlab:boardclass:vlab_test:unlockedboards", {board: i})
+
+    def _allocate(self, db, user, now):
+        return vlabredis.allocate_board_and_start_session(db, "vlab_test", user, now)[0]
+
+    def test_boards_held_back_for_holders(self, mock_redis):
+        db = mock_redis
+        self._add_boards(db, 3)
+        vlabredis.create_reservation(db, "vlab_test", 2, 1000, 4600, ["alice", "bob"])
+        # Before the reservation starts nothing is held back
+        assert self._allocate(db, "outsider1", 999) is not None
+        # Then the two remaining boards are kept for the holders
+        assert self._allocate(db, "outsider2", 1000) is None
+        assert self._allocate(db, "alice", 1000) is not None
+        assert self._allocate(db, "outsider2", 1001) is None
+        assert self._allocate(db, "bob", 1001) is not None
+        (reservation,) = vlabredis.get_reservations(db)
+        assert reservation["claims"] == ["alice", "bob"]
+
+    def test_unclaimed_boards_released_at_deadline(self, mock_redis):
+        db = mock_redis
+        self._add_boards(db, 1)
+        vlabredis.create_reservation(db, "vlab_test", 1, 1000, 4600, ["alice"])
+        assert self._allocate(db, "outsider", 1000 + vlabredis.RESERVATION_CLAIM_TIME - 1) is None
+        assert self._allocate(db, "outsider", 1000 + vlabredis.RESERVATION_CLAIM_TIME) == "B0"
+
+    def test_holder_claims_once(self, mock_redis):
+        db = mock_redis
+        self._add_boards(db, 2)
+        vlabredis.create_reservation(db, "vlab_test", 1, 1000, 4600, ["alice", "bob"])
+        assert self._allocate(db, "alice", 1000) is not None
+        # The single place is taken, so nothing is held back any more
+        assert self._allocate(db, "bob", 1001) is not None
+
+    def test_no_more_held_back_than_users(self, mock_redis):
+        db = mock_redis
+        self._add_boards(db, 3)
+        vlabredis.create_reservation(db, "vlab_test", 3, 1000, 4600, ["alice"])
+        # Only alice can claim a board, so the other two are not held back from anybody
+        assert self._allocate(db, "outsider", 1000) is not None
+        assert self._allocate(db, "outsider2", 1000) is not None
+        assert self._allocate(db, "outsider3", 1000) is None
+        assert self._allocate(db, "alice", 1000) is not None
+
+    def test_holder_jumps_queue(self, mock_redis):
+        db = mock_redis
+        self._add_boards(db, 1)
+        vlabredis.create_reservation(db, "vlab_test", 1, 1000, 4600, ["alice"])
+        db.set("vlab:waiter:outsider:1:alive", 1)
+        db.zadd("vlab:boardclass:vlab_test:waiting", {"outsider:1": 1000})
+        assert self._allocate(db, "alice", 1000) == "B0"
+
+    def test_expired_locks_not_held_back(self, mock_redis):
+        db = mock_redis
+        self._add_boards(db, 2)
+        vlabredis.start_session(db, "B0", "vlab_test", "carol", 900)
+        vlabredis.unlock_board(db, "B0", "vlab_test")
+        vlabredis.create_reservation(db, "vlab_test", 1, 1000, 4600, ["alice"])
+        assert self._allocate(db, "outsider", 1000) == "B0"
+
+    def test_queue_skips_to_holder(self, mock_redis):
+        db = mock_redis
+        self._add_boards(db, 1)
+        vlabredis.start_session(db, "B0", "vlab_test", "carol", 900)
+        now = int(time.time())
+        vlabredis.create_reservation(db, "vlab_test", 1, now - 10, now + 3600, ["bob"])
+        for ticket in ["outsider:1", "bob:2"]:
+            db.set("vlab:waiter:{}:alive".format(ticket), 1)
+            db.zadd("vlab:boardclass:vlab_test:waiting", {ticket: now})
+        vlabredis.unlock_board(db, "B0", "vlab_test")
+        vlabredis.end_session(db, "B0", "vlab_test")
+        assert db.lpop("vlab:waiter:bob:2:board") == "B0"
+        assert db.zrange("vlab:boardclass:vlab_test:waiting", 0, -1) == ["outsider:1"]
+
+    def test_cancel_and_expire(self, mock_redis):
+        db = mock_redis
+        first = vlabredis.create_reservation(db, "vlab_test", 1, 1000, 2000, ["alice"])
+        second = vlabredis.create_reservation(db, "vlab_test", 1, 3000, 4000, ["bob"])
+        assert [r["id"] for r in vlabredis.get_reservations(db, "vlab_test")] == [first, second]
+        assert vlabredis.expire_reservations(db, 2500) == 1
+        assert vlabredis.cancel_reservation(db, second) is True
+        assert vlabredis.cancel_reservation(db, second) is False
+        assert vlabredis.get_reservations(db) == []
+        assert not db.exists("vlab:reservation:{}".format(first), "vlab:reservation:{}:users".format(second))
 
 
 @pytest.mark.unit
@@ -201,8 +397,8 @@ class TestHelpers:
 
     def test_get_or_fail_exists(self, populated_redis):
         db = populated_redis
-        val = vlabredis.get_or_fail(db, "vlab:board:BOARD001:server", "missing")
-        assert val == "boardserver1"
+        val = vlabredis.get_or_fail(db, "vlab:knownboard:BOARD001:class", "missing")
+        assert val == "vlab_test"
 
     def test_get_or_fail_missing(self, populated_redis):
         db = populated_redis
@@ -229,4 +425,420 @@ class TestHelpers:
         vlabredis.remove_board(db, "BOARD001")
         assert not db.sismember("vlab:boardclass:vlab_test:boards", "BOARD001")
         assert db.zscore("vlab:boardclass:vlab_test:availableboards", "BOARD001") is None
-        assert db.get("vlab:board:BOARD001:server") is None
+        assert db.hget("vlab:board:BOARD001", "server") is None
+        assert vlabredis.get_boardclass_of_board(db, "BOARD001") is None
+
+    def test_register_board(self, mock_redis):
+        db = mock_redis
+        vlabredis.register_board(db, "BOARD003", "vlab_new", {"user": "vlab", "server": "bs3", "port": 30003})
+        assert db.sismember("vlab:boardclasses", "vlab_new")
+        assert db.sismember("vlab:boardclass:vlab_new:boards", "BOARD003")
+        assert vlabredis.get_boardclass_of_board(db, "BOARD003") == "vlab_new"
+        assert vlabredis.get_board_details(db, "BOARD003", ["server", "port"]) == {"server": "bs3", "port": "30003"}
+        # Not made available or unlocked by registration
+        assert db.zscore("vlab:boardclass:vlab_new:availableboards", "BOARD003") is None
+
+    def test_attach_board(self, populated_redis):
+        db = populated_redis
+        vlabredis.start_session(db, "BOARD002", "vlab_test", "testuser", 1000)
+        assert db.smembers("vlab:host:boardserver2:sessions") == {"BOARD002"}
+        # The board is re-attached on another host
+        vlabredis.attach_board(db, "BOARD002", "vlab_test", {"user": "root", "server": "boardserver3", "port": 30003})
+        assert db.smembers("vlab:host:boardserver2:sessions") == set()
+        assert db.smembers("vlab:host:boardserver3:sessions") == set()
+        assert vlabredis.get_boards_held_by(db, "testuser") == set()
+        assert db.hget("vlab:board:BOARD002", "session:username") is None
+        assert db.hget("vlab:board:BOARD002", "lock:username") is None
+        assert vlabredis.get_board_details(db, "BOARD002", ["server", "port"]) == \
+            {"server": "boardserver3", "port": "30003"}
+        assert db.zscore("vlab:boardclass:vlab_test:availableboards", "BOARD002") == 0
+        assert db.zscore("vlab:boardclass:vlab_test:unlockedboards", "BOARD002") == 0
+        assert db.zscore("vlab:boardclass:vlab_test:pingtimes", "BOARD002") is None
+        assert db.zscore("vlab:boardclass:vlab_test:locktimes", "BOARD002") is None
+
+    def test_detach_clears_host_index(self, populated_redis):
+        db = populated_redis
+        vlabredis.start_session(db, "BOARD002", "vlab_test", "testuser", 1000)
+        vlabredis.remove_board(db, "BOARD002")
+        assert db.smembers("vlab:host:boardserver2:sessions") == set()
+
+    def test_rebuild_boardclass_index(self, populated_redis):
+        db = populated_redis
+        db.hdel("vlab:board:BOARD001", "boardclass")
+        db.hset("vlab:board:BOARD002", "boardclass", "wrong_class")
+        db.hset("vlab:board:STALE", mapping={"boardclass": "vlab_test", "server": "old"})
+
+        assert vlabredis.rebuild_boardclass_index(db) == 3
+        assert vlabredis.get_boardclass_of_board(db, "BOARD001") == "vlab_test"
+        assert vlabredis.get_boardclass_of_board(db, "BOARD002") == "vlab_test"
+        assert vlabredis.get_boardclass_of_board(db, "STALE") is None
+        assert vlabredis.rebuild_boardclass_index(db) == 0
+
+    def test_get_board_details_missing(self, populated_redis):
+        db = populated_redis
+        with pytest.raises(SystemExit):
+            vlabredis.get_board_details(db, "BOARD001", ["server", "user"])
+
+    def test_get_board_record(self, populated_redis):
+        db = populated_redis
+        record = vlabredis.get_board_record(db, "BOARD002", ["server", "port"])
+        assert record["server"] == "boardserver2"
+        assert record["session:username"] == "testuser"
+
+    def test_get_board_record_missing(self, populated_redis):
+        db = populated_redis
+        with pytest.raises(SystemExit):
+            vlabredis.get_board_record(db, "BOARD001", ["user"])
+
+
+@pytest.mark.unit
+class TestMigration:
+    def test_migrate_legacy_board_keys(self, mock_redis):
+        db = mock_redis
+        db.set("vlab:board:OLD001:server", "boardserver1")
+        db.set("vlab:board:OLD001:port", "30001")
+        db.set("vlab:board:OLD001:lock:username", "testuser")
+        db.set("vlab:board:OLD001:session:starttime", "1000")
+        db.set("vlab:board:OLD001:hwtest:testing", "1")
+
+        assert vlabredis.migrate_legacy_board_keys(db) == 4
+        assert db.hgetall("vlab:board:OLD001") == {
+            "server": "boardserver1",
+            "port": "30001",
+            "lock:username": "testuser",
+            "session:starttime": "1000",
+        }
+        assert db.get("vlab:board:OLD001:server") is None
+        # The TTL'd testing flag is not part of the hash
+        assert db.get("vlab:board:OLD001:hwtest:testing") == "1"
+
+    def test_migrate_does_not_overwrite(self, mock_redis):
+        db = mock_redis
+        db.hset("vlab:board:OLD001", "port", "30005")
+        db.set("vlab:board:OLD001:port", "30001")
+        vlabredis.migrate_legacy_board_keys(db)
+        assert db.hget("vlab:board:OLD001", "port") == "30005"
+
+    def test_migrate_dry_run(self, mock_redis):
+        db = mock_redis
+        db.set("vlab:board:OLD001:server", "boardserver1")
+        assert vlabredis.migrate_legacy_board_keys(db, dry_run=True) == 1
+        assert db.get("vlab:board:OLD001:server") == "boardserver1"
+        assert not db.exists("vlab:board:OLD001")
+
+
+@pytest.mark.unit
+class TestCompareAndSetRaces:
+    def test_stale_unlock_does_not_release_new_lock(self, populated_redis):
+        db = populated_redis
+        old_start = int(db.hget("vlab:board:BOARD002", "session:starttime"))
+        # testuser's lock expires and the board is handed to testoverlord
+        vlabredis.unlock_board(db, "BOARD002", "vlab_test")
+        vlabredis.start_session(db, "BOARD002", "vlab_test", "testoverlord", old_start + 1)
+
+        assert vlabredis.unlock_board_if_user_time(db, "BOARD002", "vlab_test", "testuser", old_start) is False
+        assert vlabredis.end_session_if_user_time(db, "BOARD002", "vlab_test", "testuser", old_start) is False
+        assert vlabredis.ping_session_if_user_time(db, "BOARD002", "testuser", old_start) is False
+        assert db.hget("vlab:board:BOARD002", "lock:username") == "testoverlord"
+        assert db.hget("vlab:board:BOARD002", "session:username") == "testoverlord"
+
+    def test_same_time_different_user(self, populated_redis):
+        db = populated_redis
+        start = int(db.hget("vlab:board:BOARD002", "session:starttime"))
+        assert vlabredis.unlock_board_if_user_time(db, "BOARD002", "vlab_test", "testoverlord", start) is False
+        assert vlabredis.ping_session_if_user_time(db, "BOARD002", "testoverlord", start) is False
+        assert db.hget("vlab:board:BOARD002", "lock:username") == "testuser"
+
+    def test_concurrent_allocate_and_unlock_never_double_assigns(self):
+        import itertools
+        import threading
+
+        import fakeredis
+
+        server = fakeredis.FakeServer()
+        setup = fakeredis.FakeRedis(server=server, decode_responses=True)
+        boards = ["RACE{:02d}".format(i) for i in range(4)]
+        for i, b in enumerate(boards):
+            vlabredis.register_board(setup, b, "vlab_race", {"server": "bs", "port": 30000 + i})
+            setup.zadd("vlab:boardclass:vlab_race:availableboards", {b: 0})
+            setup.zadd("vlab:boardclass:vlab_race:unlockedboards", {b: 0})
+
+        start_times = itertools.count(1)
+        holders = {}
+        holders_lock = threading.Lock()
+        errors = []
+
+        def student(name):
+            db = fakeredis.FakeRedis(server=server, decode_responses=True)
+            for _ in range(50):
+                with holders_lock:
+                    start = next(start_times)
+                board, _ = vlabredis.allocate_board_and_start_session(db, "vlab_race", name, start)
+                if board is None:
+                    continue
+                with holders_lock:
+                    if board in holders:
+                        errors.append("{} given to {} while held by {}".format(board, name, holders[board]))
+                    holders[board] = name
+                # A stale unlock from a previous holder must never release the current lock
+                if vlabredis.unlock_board_if_user_time(db, board, "vlab_race", "ghost", start):
+                    errors.append("stale unlock released {}".format(board))
+                # The board stays held until it has actually been released; the lock keeps the next holder from
+                # recording itself before this one is removed
+                with holders_lock:
+                    vlabredis.unlock_board_if_user_time(db, board, "vlab_race", name, start)
+                    vlabredis.end_session_if_user_time(db, board, "vlab_race", name, start)
+                    del holders[board]
+
+        threads = [threading.Thread(target=student, args=("user{}".format(i),)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert errors == []
+        assert setup.zcard("vlab:boardclass:vlab_race:availableboards") == len(boards)
+        assert setup.zcard("vlab:boardclass:vlab_race:unlockedboards") == len(boards)
+
+
+@pytest.mark.unit
+class TestUserIndex:
+    def test_start_and_end_session_maintain_index(self, populated_redis):
+        db = populated_redis
+        vlabredis.start_session(db, "BOARD001", "vlab_test", "testoverlord", 1234)
+        assert vlabredis.get_boards_held_by(db, "testoverlord") == {"BOARD001"}
+        # Still held while either the lock or the session remains
+        vlabredis.unlock_board(db, "BOARD001", "vlab_test")
+        assert vlabredis.get_boards_held_by(db, "testoverlord") == {"BOARD001"}
+        vlabredis.end_session(db, "BOARD001", "vlab_test")
+        assert vlabredis.get_boards_held_by(db, "testoverlord") == set()
+
+    def test_end_session_then_unlock(self, populated_redis):
+        db = populated_redis
+        vlabredis.end_session(db, "BOARD002", "vlab_test")
+        assert vlabredis.get_boards_held_by(db, "testuser") == {"BOARD002"}
+        vlabredis.unlock_board(db, "BOARD002", "vlab_test")
+        assert vlabredis.get_boards_held_by(db, "testuser") == set()
+
+    def test_reallocation_moves_board_between_users(self, populated_redis):
+        db = populated_redis
+        vlabredis.unlock_board(db, "BOARD002", "vlab_test")
+        db.zrem("vlab:boardclass:vlab_test:availableboards", "BOARD001")
+        db.zrem("vlab:boardclass:vlab_test:unlockedboards", "BOARD001")
+        board, pool = vlabredis.allocate_board_and_start_session(db, "vlab_test", "testoverlord", 1234)
+        assert (board, pool) == ("BOARD002", "unlocked")
+        assert vlabredis.get_boards_held_by(db, "testuser") == set()
+        assert vlabredis.get_boards_held_by(db, "testoverlord") == {"BOARD002"}
+
+    def test_held_by_boardclass(self, populated_redis):
+        db = populated_redis
+        assert vlabredis.get_boards_held_by(db, "testuser", "vlab_test") == {"BOARD002"}
+        assert vlabredis.get_boards_held_by(db, "testuser", "other_class") == set()
+
+    def test_remove_board_clears_index(self, populated_redis):
+        db = populated_redis
+        vlabredis.remove_board(db, "BOARD002")
+        assert vlabredis.get_boards_held_by(db, "testuser") == set()
+
+    def test_rebuild_user_index(self, populated_redis):
+        db = populated_redis
+        db.delete("vlab:user:testuser:boards")
+        db.sadd("vlab:user:ghost:boards", "BOARD001")
+        assert vlabredis.rebuild_user_index(db) == 2
+        assert vlabredis.get_boards_held_by(db, "testuser") == {"BOARD002"}
+        assert vlabredis.get_boards_held_by(db, "ghost") == set()
+        assert vlabredis.rebuild_user_index(db) == 0
+
+
+@pytest.mark.unit
+class TestTimeIndex:
+    def test_lock_and_unlock(self, populated_redis):
+        db = populated_redis
+        vlabredis.lock_board(db, "BOARD001", "vlab_test", "testuser", 1234)
+        assert db.zscore("vlab:boardclass:vlab_test:locktimes", "BOARD001") == 1234
+        vlabredis.unlock_board(db, "BOARD001", "vlab_test")
+        assert db.zscore("vlab:boardclass:vlab_test:locktimes", "BOARD001") is None
+
+    def test_session_pings(self, populated_redis):
+        db = populated_redis
+        vlabredis.start_session(db, "BOARD001", "vlab_test", "testoverlord", 1234)
+        assert db.zscore("vlab:boardclass:vlab_test:pingtimes", "BOARD001") == 1234
+        assert vlabredis.ping_session_if_user_time(db, "BOARD001", "testoverlord", 1234)
+        assert db.zscore("vlab:boardclass:vlab_test:pingtimes", "BOARD001") > 1234
+        vlabredis.end_session(db, "BOARD001", "vlab_test")
+        assert db.zscore("vlab:boardclass:vlab_test:pingtimes", "BOARD001") is None
+
+    def test_ping_without_session_is_not_indexed(self, populated_redis):
+        db = populated_redis
+        vlabredis.ping_session(db, "BOARD001")
+        assert db.zscore("vlab:boardclass:vlab_test:pingtimes", "BOARD001") is None
+
+    def test_expired_locks_and_stale_sessions(self, populated_redis):
+        db = populated_redis
+        now = int(time.time())
+        assert vlabredis.get_expired_locks(db, "vlab_test", now) == []
+        assert vlabredis.get_expired_locks(db, "vlab_test", now + vlabredis.MAX_LOCK_TIME) == ["BOARD002"]
+        assert vlabredis.get_stale_sessions(db, "vlab_test", 60, now) == []
+        assert vlabredis.get_stale_sessions(db, "vlab_test", 10, now) == ["BOARD002"]
+
+    def test_allocation_indexes_times(self, populated_redis):
+        db = populated_redis
+        board, pool = vlabredis.allocate_board_and_start_session(db, "vlab_test", "testoverlord", 1234)
+        assert db.zscore("vlab:boardclass:vlab_test:locktimes", board) == 1234
+        assert db.zscore("vlab:boardclass:vlab_test:pingtimes", board) == 1234
+
+    def test_remove_board_clears_times(self, populated_redis):
+        db = populated_redis
+        vlabredis.remove_board(db, "BOARD002")
+        assert db.zcard("vlab:boardclass:vlab_test:locktimes") == 0
+        assert db.zcard("vlab:boardclass:vlab_test:pingtimes") == 0
+
+    def test_rebuild_time_index(self, populated_redis):
+        db = populated_redis
+        db.delete("vlab:boardclass:vlab_test:pingtimes")
+        db.zadd("vlab:boardclass:vlab_test:locktimes", {"BOARD001": 1})
+        assert vlabredis.rebuild_time_index(db) == 2
+        assert db.zrange("vlab:boardclass:vlab_test:locktimes", 0, -1) == ["BOARD002"]
+        assert db.zrange("vlab:boardclass:vlab_test:pingtimes", 0, -1) == ["BOARD002"]
+
+
+@pytest.mark.unit
+class TestEvents:
+    def test_session_lifecycle_is_journalled(self, populated_redis):
+        db = populated_redis
+        board, pool = vlabredis.allocate_board_and_start_session(db, "vlab_test", "testoverlord", 1234)
+        vlabredis.ping_session_if_user_time(db, board, "testoverlord", 1234)
+        vlabredis.unlock_board_if_user_time(db, board, "vlab_test", "testoverlord", 1234)
+        vlabredis.end_session_if_user_time(db, board, "vlab_test", "testoverlord", 1234)
+        events = [fields for _, fields in vlabredis.read_events(db)]
+        assert [e["event"] for e in events] == ["LOCK", "START", "RELEASE", "END"]
+        assert all(e["board"] == board and e["user"] == "testoverlord" for e in events)
+
+    def test_no_free_boards(self, populated_redis):
+        db = populated_redis
+        db.delete("vlab:boardclass:vlab_test:availableboards", "vlab:boardclass:vlab_test:unlockedboards")
+        assert vlabredis.allocate_board_and_start_session(db, "vlab_test", "testuser", 1234) == (None, None)
+        (_, fields), = vlabredis.read_events(db)
+        assert fields == {"event": "NOFREEBOARDS", "boardclass": "vlab_test", "user": "testuser"}
+
+    def test_read_from_last_id(self, populated_redis):
+        db = populated_redis
+        vlabredis.lock_board(db, "BOARD001", "vlab_test", "testuser", 1234)
+        (last_id, _), = vlabredis.read_events(db)
+        assert vlabredis.read_events(db, last_id) == []
+        vlabredis.remove_board(db, "BOARD001")
+        (event_id, fields), = vlabredis.read_events(db, last_id)
+        assert fields == {"event": "REMOVE", "board": "BOARD001", "boardclass": "vlab_test"}
+        assert abs(vlabredis.event_time(event_id) - time.time()) < 60
+
+
+@pytest.mark.unit
+class TestRevocation:
+    def _subscribe(self, db, board):
+        pubsub = db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe("vlab:board:{}:revoked".format(board))
+        return pubsub
+
+    def _messages(self, pubsub):
+        # Subscription confirmations are read as None, so drain for a fixed time
+        messages = []
+        deadline = time.time() + 0.3
+        while time.time() < deadline:
+            message = pubsub.get_message(timeout=0.05)
+            if message is not None:
+                messages.append(message["data"])
+        return messages
+
+    def test_takeover_revokes_old_session(self, populated_redis):
+        db = populated_redis
+        start = db.hget("vlab:board:BOARD002", "session:starttime")
+        pubsub = self._subscribe(db, "BOARD002")
+        vlabredis.start_session(db, "BOARD002", "vlab_test", "testoverlord", 1234)
+        assert self._messages(pubsub) == ["testuser:{}".format(start)]
+
+    def test_watch_fallback_revokes_old_session(self, populated_redis):
+        db = populated_redis
+        start = db.hget("vlab:board:BOARD002", "session:starttime")
+        db.delete("vlab:boardclass:vlab_test:availableboards")
+        db.zadd("vlab:boardclass:vlab_test:unlockedboards", {"BOARD002": 0})
+        pubsub = self._subscribe(db, "BOARD002")
+        assert vlabredis._allocate_and_start_session_watch(db, "vlab_test", "testoverlord", 1234)[0] == "BOARD002"
+        assert self._messages(pubsub) == ["testuser:{}".format(start)]
+
+    def test_end_and_remove_revoke(self, populated_redis):
+        db = populated_redis
+        start = db.hget("vlab:board:BOARD002", "session:starttime")
+        pubsub = self._subscribe(db, "BOARD002")
+        vlabredis.end_session(db, "BOARD002", "vlab_test")
+        vlabredis.ping_session(db, "BOARD002")
+        vlabredis.remove_board(db, "BOARD002")
+        assert self._messages(pubsub) == ["testuser:{}".format(start)]
+
+    def test_new_session_is_not_revoked(self, populated_redis):
+        db = populated_redis
+        pubsub = self._subscribe(db, "BOARD001")
+        vlabredis.allocate_board_and_start_session(db, "vlab_test", "testuser", 1234)
+        assert self._messages(pubsub) == []
+
+    def test_watch_for_revocation(self, populated_redis):
+        db = populated_redis
+        start = db.hget("vlab:board:BOARD002", "session:starttime")
+        revoked = threading.Event()
+        watcher = vlabredis.watch_for_revocation(db, "BOARD002", "testuser", start, revoked.set)
+        try:
+            time.sleep(0.2)
+            db.publish("vlab:board:BOARD002:revoked", "testuser:1")
+            assert not revoked.wait(0.5)
+            vlabredis.end_session_if_user_time(db, "BOARD002", "vlab_test", "testuser", start)
+            assert revoked.wait(5)
+        finally:
+            watcher.stop()
+
+
+@pytest.mark.unit
+class TestPortLeases:
+    def test_lease_and_release(self, mock_redis):
+        db = mock_redis
+        assert vlabredis.init_port_pool(db) == 35000 - 30000 + 1
+        port = vlabredis.lease_port(db, "testuser")
+        assert 30000 <= port <= 35000
+        assert not db.sismember("vlab:ports:free", port)
+        assert vlabredis.release_port(db, port, "wronguser") is False
+        assert vlabredis.release_port(db, port, "testuser") is True
+        assert db.sismember("vlab:ports:free", port)
+        assert db.zscore("vlab:ports:leases", port) is None
+
+    def test_never_leases_a_port_in_use(self, mock_redis):
+        db = mock_redis
+        db.sadd("vlab:ports:free", 30000, 30001)
+        ports = {vlabredis.lease_port(db, "testuser"), vlabredis.lease_port(db, "testoverlord")}
+        assert ports == {30000, 30001}
+        assert vlabredis.lease_port(db, "testuser") is None
+
+    def test_init_keeps_leases(self, mock_redis):
+        db = mock_redis
+        vlabredis.init_port_pool(db)
+        port = vlabredis.lease_port(db, "testuser")
+        db.sadd("vlab:ports:free", 40000)
+        vlabredis.init_port_pool(db)
+        assert not db.sismember("vlab:ports:free", port)
+        assert not db.sismember("vlab:ports:free", 40000)
+
+    def test_reclaim_stale_leases(self, mock_redis):
+        db = mock_redis
+        db.sadd("vlab:ports:free", 30000, 30001)
+        stale = vlabredis.lease_port(db, "testuser")
+        live = vlabredis.lease_port(db, "testoverlord")
+        db.zadd("vlab:ports:leases", {stale: int(time.time()) - vlabredis.PORT_LEASE_TIMEOUT - 1})
+        assert vlabredis.reclaim_stale_ports(db) == 1
+        assert db.smembers("vlab:ports:free") == {str(stale)}
+        assert vlabredis.renew_port_lease(db, live, "testoverlord") is True
+
+    def test_renew_takes_back_reclaimed_port(self, mock_redis):
+        db = mock_redis
+        db.sadd("vlab:ports:free", 30000)
+        port = vlabredis.lease_port(db, "testuser")
+        vlabredis.reclaim_stale_ports(db, int(time.time()) + vlabredis.PORT_LEASE_TIMEOUT + 1)
+        assert vlabredis.renew_port_lease(db, port, "testuser") is True
+        assert vlabredis.lease_port(db, "testoverlord") is None
+        assert vlabredis.renew_port_lease(db, port, "testoverlord") is False
@@ -0,0 +1,71 @@
+"""Tests for vlabcommon/vlabserial.py."""
+
+import pytest
+
+import vlabserial
+
+
+@pytest.fixture
+def spill(tmp_path):
+    return str(tmp_path / "serial" / "serial.log")
+
+
+@pytest.mark.unit
+class TestRequests:
+    def test_round_trip(self):
+        assert vlabserial.broker_request("tail", 1024, "testuser") == b"tail 1024 testuser\n"
+        assert vlabserial.parse_request(b"tail 1024 testuser") == ("tail", ["1024", "testuser"])
+        assert vlabserial.parse_request(b"attach batch:testuser") == ("attach", ["batch:testuser"])
+        assert vlabserial.parse_request(b"view") == ("view", [])
+
+    @pytest.mark.parametrize("line", [b"", b"write stuff", b"attach", b"tail many testuser", b"tail 10"])
+    def test_invalid(self, line):
+        with pytest.raises(ValueError):
+            vlabserial.parse_request(line)
+
+    def test_unknown_request(self):
+        with pytest.raises(ValueError):
+            vlabserial.broker_request("clear")
+
+
+@pytest.mark.unit
+class TestSerialLog:
+    def test_ring_buffer(self, spill):
+        log = vlabserial.SerialLog(spill, buffer_size=8, spill_size=1024)
+        log.append(b"0123456789")
+        assert bytes(log.buffer) == b"23456789"
+        assert log.tail(4) == b"6789"
+        # Older output comes from the spill file
+        assert log.tail(10) == b"0123456789"
+        assert log.tail(100) == b"0123456789"
+
+    def test_spill_rotation(self, spill):
+        log = vlabserial.SerialLog(spill, buffer_size=4, spill_size=10)
+        for chunk in [b"aaaaaa", b"bbbbbb", b"cccccc"]:
+            log.append(chunk)
+        assert log.tail(100) == b"aaaaaabbbbbbcccccc"
+        # Only the current spill file and its rotated copy are kept
+        log.append(b"dddddd")
+        assert log.tail(100) == b"ccccccdddddd"
+        assert log.tail(8) == b"ccdddddd"
+
+    def test_owner_change_clears(self, spill):
+        log = vlabserial.SerialLog(spill, buffer_size=8, spill_size=1024)
+        log.set_owner("testuser")
+        log.append(b"secret output")
+        log.set_owner("testuser")
+        assert log.tail(6) == b"output"
+        log.set_owner("testoverlord")
+        assert log.tail(100) == b""
+        log.append(b"new")
+        assert log.tail(100) == b"new"
+
+    def test_survives_restart(self, spill):
+        log = vlabserial.SerialLog(spill, buffer_size=8, spill_size=1024)
+        log.set_owner("testuser")
+        log.append(b"before restart")
+        log.close()
+        log = vlabserial.SerialLog(spill, buffer_size=8, spill_size=1024)
+        assert log.owner == "testuser"
+        assert bytes(log.buffer) == b" restart"
+        assert log.tail(100) == b"before restart"
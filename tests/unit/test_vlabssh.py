@@ -0,0 +1,99 @@
+"""Tests for vlabcommon/vlabssh.py."""
+
+import os
+import socket
+import subprocess
+import time
+
+import pytest
+
+import vlabssh
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    return tmp_path
+
+
+@pytest.mark.unit
+class TestCommands:
+    def test_multiplexed_args(self, home):
+        args = vlabssh.ssh_args("root@boardserver1", "uptime", 30001)
+        assert args[:2] == ["ssh", "-q"]
+        assert args[-3:] == ["30001", "root@boardserver1", "uptime"]
+        assert "ControlMaster=auto" in args
+        assert "ControlPath={}".format(os.path.join(str(home), ".vlab-ssh", "%C")) in args
+        assert "ControlPersist={}".format(vlabssh.CONTROL_PERSIST) in args
+        assert oct(os.stat(home / ".vlab-ssh").st_mode & 0o777) == "0o700"
+
+    def test_without_multiplexing(self):
+        args = vlabssh.ssh_args("root@boardserver1", "uptime", 30001, multiplex=False)
+        assert not any(a.startswith("Control") for a in args)
+        assert vlabssh.KEYFILE in args
+
+    def test_command_line(self):
+        line = vlabssh.ssh_command("vlab@host1", "/opt/VLAB/boardrestart.sh B1", options=["-e", "none"])
+        assert line.startswith("ssh -q ")
+        assert line.endswith(" -e none vlab@host1 \"/opt/VLAB/boardrestart.sh B1\"")
+        assert "-p" not in line.split()
+
+    def test_close_master(self, monkeypatch):
+        calls = []
+
+        def fake_run(args, **kwargs):
+            calls.append(args)
+            return subprocess.CompletedProcess(args, 255)
+
+        monkeypatch.setattr(subprocess, "run", fake_run)
+        assert vlabssh.close_master("root@boardserver1", 30001) is False
+        assert calls[0][-5:] == ["-O", "exit", "-p", "30001", "root@boardserver1"]
+
+
+@pytest.fixture
+def listener():
+    """A (host, port) which accepts connections."""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(8)
+    yield server.getsockname()
+    server.close()
+
+
+@pytest.fixture
+def closed_port():
+    """A (host, port) which refuses connections."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    address = s.getsockname()
+    s.close()
+    return address
+
+
+@pytest.mark.unit
+class TestProbe:
+    def test_reachable(self, listener, closed_port):
+        assert vlabssh.reachable(*listener, timeout=1)
+        assert not vlabssh.reachable(*closed_port, timeout=1)
+        assert not vlabssh.reachable("127.0.0.1", "notaport", timeout=1)
+
+    def test_probe(self, listener, closed_port):
+        results = vlabssh.probe([listener, closed_port, listener], timeout=1, attempts=2, retry_delay=0)
+        assert results == {listener: True, closed_port: False}
+        assert vlabssh.probe([]) == {}
+
+    def test_probes_run_concurrently(self, monkeypatch):
+        attempts = []
+
+        def slow_reachable(host, port, timeout):
+            attempts.append((host, port))
+            time.sleep(0.2)
+            return port % 2 == 0
+        monkeypatch.setattr(vlabssh, "reachable", slow_reachable)
+        targets = [("boardserver", port) for port in range(30000, 30020)]
+        start = time.monotonic()
+        results = vlabssh.probe(targets, attempts=3, retry_delay=0)
+        # Twenty hosts, the unreachable ones tried three times, take about as long as a single host
+        assert time.monotonic() - start < 1.5
+        assert results == {t: t[1] % 2 == 0 for t in targets}
+        assert len(attempts) == 10 + 10 * 3
@@ -0,0 +1,72 @@
+"""Tests for vlabcommon/vlabtrace.py using fakeredis."""
+
+import time
+
+import pytest
+
+import vlabtrace
+
+
+@pytest.mark.unit
+class TestLoginTrace:
+    def test_phases_are_timed(self):
+        trace = vlabtrace.LoginTrace("testuser")
+        with trace.phase("restart"):
+            time.sleep(0.01)
+        trace.add("acl", 0.002)
+        trace.add("acl", 0.001)
+        record = trace.to_dict()
+        assert list(record["phases"]) == ["restart", "acl"]
+        assert record["phases"]["restart"] >= 10
+        assert record["phases"]["acl"] == pytest.approx(3)
+        assert record["total_ms"] == pytest.approx(sum(record["phases"].values()))
+
+    def test_save_and_read(self, mock_redis):
+        db = mock_redis
+        first = vlabtrace.LoginTrace("testuser")
+        first.set(boardclass="vlab_test", board="BOARD001", start_time=1234)
+        first.add("allocation", 0.005)
+        assert first.save(db, "connected") is not None
+        # A trace is only saved once
+        assert first.save(db, "disconnected") is None
+        vlabtrace.LoginTrace("testoverlord").save(db, "error")
+
+        traces = vlabtrace.read_traces(db)
+        assert [t["user"] for t in traces] == ["testuser", "testoverlord"]
+        assert traces[0]["session"] == first.session_id
+        assert traces[0]["outcome"] == "connected"
+        assert traces[0]["board"] == "BOARD001"
+        assert traces[0]["phases"] == {"allocation": pytest.approx(5)}
+        assert [t["user"] for t in vlabtrace.read_traces(db, 1)] == ["testoverlord"]
+        # The count applies to the user's own traces, not the most recent ones of anybody
+        assert [t["session"] for t in vlabtrace.read_traces(db, 1, "testuser")] == [first.session_id]
+        assert vlabtrace.read_traces(db, None, "nobody") == []
+
+    def test_process_start_time(self):
+        started = vlabtrace.process_start_time()
+        if started is None:
+            pytest.skip("no /proc on this system")
+        assert started <= time.time()
+        assert vlabtrace.process_start_time(0) is None
+
+
+@pytest.mark.unit
+class TestSummarise:
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert vlabtrace.percentile(values, 50) == 50
+        assert vlabtrace.percentile(values, 95) == 95
+        assert vlabtrace.percentile([7], 95) == 7
+        assert vlabtrace.percentile([], 50) is None
+
+    def test_summarise(self):
+        traces = [
+            {"phases": {"allocation": 10.0, "restart": 1000.0}, "total_ms": 1010.0},
+            {"phases": {"allocation": 20.0}, "total_ms": 20.0},
+            {"phases": {"allocation": 30.0, "restart": 3000.0}, "total_ms": 3030.0},
+        ]
+        summary = vlabtrace.summarise(traces)
+        assert list(summary) == ["allocation", "restart", "total"]
+        assert summary["allocation"] == {"count": 3, "p50": 20.0, "p95": 30.0}
+        assert summary["restart"] == {"count": 2, "p50": 1000.0, "p95": 3000.0}
+        assert summary["total"]["count"] == 3
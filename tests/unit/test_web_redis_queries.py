@@ -27,6 +27,12 @@ class TestGetBoardStatus:
         assert b002["status"] == "in_use_locked"
         assert b002["user"] == "testuser"
 
+    def test_allocation_policy(self, populated_redis):
+        populated_redis.hset("vlab:board:BOARD002", "session:policy", "affinity")
+        boards = redis_queries.get_board_status(populated_redis)
+        policies = {b["serial"]: b["policy"] for b in boards}
+        assert policies == {"BOARD001": "", "BOARD002": "affinity"}
+
     def test_duration_calculated(self, populated_redis):
         boards = redis_queries.get_board_status(populated_redis)
         b002 = next(b for b in boards if b["serial"] == "BOARD002")
@@ -59,3 +65,42 @@ class TestGetSummary:
 
     def test_none_db_returns_empty(self):
         assert redis_queries.get_summary(None) == {}
+
+
+@pytest.mark.unit
+class TestGetEvents:
+    def test_recent_events(self, populated_redis):
+        for i in range(3):
+            populated_redis.xadd("vlab:events", {"event": "LOCK", "board": "BOARD00{}".format(i)})
+        events = redis_queries.get_events(populated_redis, count=2)
+        assert [e["board"] for e in events] == ["BOARD001", "BOARD002"]
+        assert events[0]["time"] > 0
+
+    def test_events_after(self, populated_redis):
+        first = populated_redis.xadd("vlab:events", {"event": "START"})
+        populated_redis.xadd("vlab:events", {"event": "END"})
+        events = redis_queries.get_events(populated_redis, after=first)
+        assert [e["event"] for e in events] == ["END"]
+        assert redis_queries.get_events(populated_redis, after=events[0]["id"]) == []
+
+    def test_none_db_returns_empty(self):
+        assert redis_queries.get_events(None) == []
+
+    def test_valid_stream_id(self):
+        assert redis_queries.valid_stream_id("1700000000000-0")
+        assert redis_queries.valid_stream_id("1700000000000")
+        assert not redis_queries.valid_stream_id("latest")
+        assert not redis_queries.valid_stream_id("1-2-3")
+        assert not redis_queries.valid_stream_id("1-")
+
+
+@pytest.mark.unit
+class TestGetReconcilerMetrics:
+    def test_metrics(self, mock_redis):
+        mock_redis.hset("vlab:reconciler:metrics", mapping={
+            "locks:duration": "0.25", "locks:max": "1.5", "locks:cycles": "4", "locks:last": "1700000000"})
+        assert redis_queries.get_reconciler_metrics(mock_redis) == {
+            "locks": {"duration": 0.25, "max": 1.5, "cycles": 4, "last": 1700000000}}
+
+    def test_none_db_returns_empty(self):
+        assert redis_queries.get_reconciler_metrics(None) == {}
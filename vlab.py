@@ -6,6 +6,10 @@ The VLAB client script.
 Example usage:
 	./vlab.py -k keyfile.vlabkey -b an_fpga_board
 
+To run a bitstream (and optionally an ELF) on the next idle board without an interactive session, and print what
+it writes to the serial port in the given number of seconds:
+	./vlab.py -k keyfile.vlabkey -b an_fpga_board --job design.bit --elf app.elf --timeout 10
+
 The script will assume your username is the same as the system user. To specify a different username
 use the -u option.
 
@@ -17,8 +21,10 @@ Ian Gray, 2017-2026
 
 import argparse
 import os
+import io
 import socket
 import sys
+import tarfile
 import urllib.request
 import urllib.error
 from subprocess import Popen, PIPE
@@ -26,7 +32,7 @@ from subprocess import Popen, PIPE
 ############################
 # Update version string here and in 'current_version' file when updating this script
 # Version number must be in 'x.y.z' format
-current_version = '1.2.4'
+current_version = '1.4.0'
 current_branch = 'master'
 ############################
 
@@ -53,6 +59,20 @@ parser.add_argument('-s', '--serial', nargs=1,
                     help="Requested board serial number.")
 parser.add_argument('-v', '--verbose', default=False, action='store_true',
                     help="Enable verbose logging.")
+parser.add_argument('-j', '--job', nargs=1,
+                    help="Run this bitstream as a batch job instead of connecting to a board.")
+parser.add_argument('--elf', nargs=1,
+                    help="ELF file to run in a batch job.")
+parser.add_argument('--ps7init', nargs=1,
+                    help="ps7_init.tcl file for a batch job's ELF, if the board's default is not suitable.")
+parser.add_argument('-t', '--timeout', nargs=1, default=["10"],
+                    help="Seconds to capture a batch job's serial output for.")
+parser.add_argument('--fetch', nargs=1,
+                    help="Print the output of the batch job with this ID.")
+parser.add_argument('--history', nargs=1,
+                    help="Print this many KB of the serial output of your last session on the board class.")
+parser.add_argument('--watch', nargs=1,
+                    help="Watch the serial console of the board with this serial number (overlord users only).")
 parsed = parser.parse_args()
 
 error_info = "Read the instructions at\n" \
@@ -91,6 +111,35 @@ if not parsed.key:
 if not os.path.isfile(parsed.key[0]):
 	err("Keyfile {} does not exist. Specify a keyfile with --key.".format(parsed.key[0]))
 
+ssh_base = ['ssh', '-oPasswordAuthentication=no', '-i', parsed.key[0], '-p', parsed.port[0]]
+if parsed.user is not None:
+	ssh_base += ['-l', parsed.user[0]]
+
+# Serial console history and watching do not need a tunnel either
+if parsed.history is not None:
+	sys.exit(Popen(ssh_base + [parsed.relay[0], 'history:{}:{}'.format(parsed.board[0], parsed.history[0])]).wait())
+if parsed.watch is not None:
+	sys.exit(Popen(ssh_base + ['-tt', parsed.relay[0], 'watch:{}'.format(parsed.watch[0])]).wait())
+
+# Batch jobs are sent to the relay shell on stdin and do not need a tunnel
+if parsed.job is not None or parsed.fetch is not None:
+	if parsed.fetch is not None:
+		sys.exit(Popen(ssh_base + [parsed.relay[0], 'job:{}'.format(parsed.fetch[0])]).wait())
+	archive = io.BytesIO()
+	with tarfile.open(fileobj=archive, mode="w") as tar:
+		for filename, member in [(parsed.job, "design.bit"), (parsed.elf, "app.elf"), (parsed.ps7init, "ps7_init.tcl")]:
+			if filename is None:
+				continue
+			if not os.path.isfile(filename[0]):
+				err("File {} does not exist.".format(filename[0]))
+			tar.add(filename[0], arcname=member)
+	ssh_cmd = ssh_base + [parsed.relay[0], 'batch:{}:{}'.format(parsed.board[0], parsed.timeout[0])]
+	if parsed.verbose:
+		print("Batch job ssh command: {}".format(ssh_cmd))
+	proc = Popen(ssh_cmd, stdin=PIPE)
+	proc.communicate(archive.getvalue())
+	sys.exit(proc.returncode)
+
 # Check that the requested ports are free to use
 local_port = int(parsed.localport[0])
 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
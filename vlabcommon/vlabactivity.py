@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+Tracking whether a board has been used since it was last reset, so that clean boards need not be reset again.
+
+Each board server records in ACTIVITY_FILE how its board has been used: "jtag" when a client holds a connection to
+hw_server (JTAG_PORT), which is spotted by activity.py, and "serial" when a user types into the serial console, which
+is spotted by the serial broker. When activity.py has reset the board it clears the record and creates CLEAN_FILE.
+
+Boards are assumed to be dirty unless shown otherwise: a new board server container (for example after the board is
+re-attached or its host rebooted) has no CLEAN_FILE, although its FPGA may still hold the last user's design, so its
+first reset is never skipped. A reset is only skipped when CLEAN_FILE exists and no use has been recorded since.
+"""
+
+import os
+
+ACTIVITY_FILE = "/vlab/state/activity"
+CLEAN_FILE = "/vlab/state/clean"
+JTAG_PORT = 3121
+TCP_TABLES = ["/proc/net/tcp", "/proc/net/tcp6"]
+# The state of established sockets in TCP_TABLES
+TCP_ESTABLISHED = "01"
+
+
+def mark_used(reason, path=ACTIVITY_FILE, clean_path=CLEAN_FILE):
+	"""
+	Record that the board has been used in the way 'reason' (e.g. "jtag" or "serial").
+	"""
+	if reason not in used_by(path):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "a") as f:
+			f.write(reason + "\n")
+	mark_dirty(clean_path)
+
+
+def used_by(path=ACTIVITY_FILE):
+	"""
+	Return the set of ways in which the board has been used since the record was last cleared.
+	"""
+	try:
+		with open(path) as f:
+			return set(line.strip() for line in f if line.strip())
+	except OSError:
+		return set()
+
+
+def is_clean(path=ACTIVITY_FILE, clean_path=CLEAN_FILE):
+	"""
+	Return True only if the board has been reset by this board server and not used since.
+	"""
+	return os.path.exists(clean_path) and not used_by(path)
+
+
+def mark_clean(path=ACTIVITY_FILE, clean_path=CLEAN_FILE):
+	"""
+	Record that the board has just been reset successfully.
+	"""
+	clear(path)
+	os.makedirs(os.path.dirname(clean_path), exist_ok=True)
+	with open(clean_path, "w"):
+		pass
+
+
+def mark_dirty(clean_path=CLEAN_FILE):
+	try:
+		os.remove(clean_path)
+	except OSError:
+		pass
+
+
+def clear(path=ACTIVITY_FILE):
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+
+def connections_to(port, tables=TCP_TABLES):
+	"""
+	Return the set of (remote address, remote port) of the established TCP connections to the local 'port'. Addresses
+	are left in the kernel's hex format.
+	"""
+	connections = set()
+	for table in tables:
+		try:
+			with open(table) as f:
+				next(f)
+				for line in f:
+					fields = line.split()
+					local, remote, state = fields[1], fields[2], fields[3]
+					if state == TCP_ESTABLISHED and int(local.rsplit(":", 1)[1], 16) == port:
+						connections.add(tuple(remote.rsplit(":", 1)))
+		except (OSError, ValueError, IndexError, StopIteration):
+			pass
+	return connections
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+"""
+Board allocation for a VLAB login, shared by the relay's allocator daemon and the fallback path in its login shell.
+
+allocate() performs the access checks and allocation that a login needs and returns a dict describing the result,
+rather than printing messages and exiting, so that it can run inside a long-lived service.
+"""
+
+import json
+import socket
+import threading
+import time
+import uuid
+import vlabclient
+from vlabredis import MAX_LOCK_TIME, get_boards_held_by, allocate_board_and_start_session, start_session, \
+	serve_waiters, unlock_board_if_user_time, end_session_if_user_time
+
+ALLOCATOR_SOCKET = "/run/vlab/allocator.sock"
+ALLOCATOR_TIMEOUT = 30
+ACL_CACHE_TIME = 30
+# Waiters refresh their liveness key every WAITER_POLL seconds, and are skipped once it has been stale for WAITER_TTL.
+# Waiters block for WAITER_POLL seconds at a time, so it must be shorter than the client's read timeout.
+WAITER_POLL = vlabclient.BLOCK_TIMEOUT
+WAITER_TTL = 30
+
+
+def get_access(db, username):
+	"""
+	Return a tuple of (is a VLAB user, is an overlord, set of allowed boardclasses) for 'username', in one round trip.
+	"""
+	with db.pipeline(transaction=False) as pipe:
+		pipe.sismember("vlab:users", username)
+		pipe.get("vlab:user:{}:overlord".format(username))
+		pipe.smembers("vlab:user:{}:allowedboards".format(username))
+		is_user, overlord, allowed = pipe.execute()
+	return bool(is_user), overlord is not None, set(allowed)
+
+
+class AccessCache:
+	"""
+	Caches the result of get_access() for each user for 'ttl' seconds. Users who are not found are not cached, so
+	that they can be added while the cache is in use. The cache is shared by the allocator's request threads, so
+	the entries are only touched with the lock held, which is not held while reading from redis.
+	"""
+
+	def __init__(self, ttl=ACL_CACHE_TIME):
+		self.ttl = ttl
+		self.entries = {}
+		self.lock = threading.Lock()
+
+	def get(self, db, username):
+		now = time.monotonic()
+		with self.lock:
+			entry = self.entries.get(username)
+		if entry is not None and now - entry[0] < self.ttl:
+			return entry[1]
+		access = get_access(db, username)
+		with self.lock:
+			# Another thread may have stored a later result while we were reading ours
+			entry = self.entries.get(username)
+			if access[0] and (entry is None or entry[0] < now):
+				self.entries[username] = (now, access)
+			elif not access[0] and entry is not None and entry[0] < now:
+				del self.entries[username]
+		return access
+
+
+def _error(message, nofreeboards=False, messages=()):
+	return {"error": message, "nofreeboards": nofreeboards, "messages": list(messages)}
+
+
+def allocate(db, username, boardclass, requested_serial=None, access=None):
+	"""
+	Check that 'username' may use 'boardclass' (and 'requested_serial', if given), then reuse a board they already
+	hold, or take the requested board, or allocate the least-recently-used board of the class, and start a session
+	on it.
+
+	'access' is the result of get_access() for the user, which is fetched if not given.
+	Returns a dict holding a list of "messages" to show the user and, on failure, "error" set to a message for the
+	user ("nofreeboards" is set if every board was locked). On success the dict also holds "board", "boardclass",
+	"start_time", "user", "server", "port" and "unlocked_count".
+	"""
+	if not db.sismember("vlab:boardclasses", boardclass):
+		return _error("Board class '{}' does not exist.".format(boardclass))
+
+	if access is None:
+		access = get_access(db, username)
+	is_user, overlord, allowed = access
+	if not is_user:
+		return _error("User '{}' is not a VLAB user.".format(username))
+
+	if requested_serial is not None:
+		if not overlord:
+			return _error("Only overlord users can request specific boards.")
+		if not db.sismember("vlab:boardclass:{}:boards".format(boardclass), requested_serial):
+			return _error("Board {} does not exist.".format(requested_serial))
+
+	# Either they are an overlord user, or vlab:user:<username>:allowedboards includes the boardclass in question
+	if not overlord and boardclass not in allowed:
+		return _error("User '{}' cannot access board class '{}'.".format(username, boardclass))
+
+	# Mark in the database that we are attempting to lock a board of this boardclass
+	db.set("vlab:boardclass:{}:locking".format(boardclass), 1, ex=2)
+
+	board = None
+	messages = []
+
+	# If a specific board serial is requested, try to take that board (only Overlord can request specific boards)
+	if requested_serial is not None:
+		if username in db.hmget("vlab:board:{}".format(requested_serial), ["session:username", "lock:username"]):
+			# We already have an active session or lock for the board
+			board = requested_serial
+		elif db.zrem("vlab:boardclass:{}:unlockedboards".format(boardclass), requested_serial) > 0:
+			# The board was removed from the unlocked list, therefore it was unlocked
+			board = requested_serial
+		else:
+			# The board is currently locked by someone else
+			lock_username = db.hget("vlab:board:{}".format(requested_serial), "lock:username")
+			db.delete("vlab:boardclass:{}:locking".format(boardclass))
+			return _error("Requested board is currently locked by {}.".format(lock_username))
+
+	# For each board in the board class that we hold, check if one is already in use or locked by us
+	if board is None:
+		for b in get_boards_held_by(db, username, boardclass):
+			if username in db.hmget("vlab:board:{}".format(b), ["session:username", "lock:username"]):
+				board = b
+				messages.append("User already has an active session on board '{}', so reusing...".format(board))
+				break
+
+	start_time = int(time.time())
+
+	if board is None:
+		# Try to get an available board for the boardclass, or failing that an unlocked but in-use board.
+		# The board is popped, locked and has its session started in a single atomic step.
+		messages.append("Requesting least-recently-used board of class '{}'...".format(boardclass))
+		board, pool = allocate_board_and_start_session(db, boardclass, username, start_time)
+		if pool == "unlocked":
+			messages.append(
+				"No available boards of class '{}'. Using an in-use board with an expired lock...".format(boardclass))
+	else:
+		start_session(db, board, boardclass, username, start_time)
+
+	if board is None:
+		# If we still don't have a board at this point, all potential boards must be locked
+		db.delete("vlab:boardclass:{}:locking".format(boardclass))
+		return _error("All boards of type '{}' are currently locked by other VLAB users.\n"
+		              "Try again in a few minutes (locks expire after {} minutes)."
+		              .format(boardclass, int(MAX_LOCK_TIME / 60)), nofreeboards=True, messages=messages)
+
+	return _allocated(db, board, boardclass, start_time, messages)
+
+
+def _allocated(db, board, boardclass, start_time, messages):
+	with db.pipeline(transaction=False) as pipe:
+		pipe.zcard("vlab:boardclass:{}:unlockedboards".format(boardclass))
+		pipe.hmget("vlab:board:{}".format(board), ["user", "server", "port"])
+		unlocked_count, (user, server, port) = pipe.execute()
+	if None in (user, server, port):
+		return _error("Board {} is missing its connection details.".format(board), messages=messages)
+
+	return {
+		"board": board,
+		"boardclass": boardclass,
+		"start_time": start_time,
+		"user": user,
+		"server": server,
+		"port": port,
+		"unlocked_count": unlocked_count,
+		"messages": messages,
+	}
+
+
+def request_allocation(boardclass, requested_serial=None, path=ALLOCATOR_SOCKET, timeout=ALLOCATOR_TIMEOUT):
+	"""
+	Ask the allocator daemon listening on the unix socket 'path' to allocate a board for the calling user, and return
+	its result as allocate() would. The daemon identifies the user from the socket's peer credentials.
+	Raises OSError if the daemon cannot be reached or does not reply in time.
+	"""
+	request = json.dumps({"boardclass": boardclass, "serial": requested_serial}) + "\n"
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+		s.settimeout(timeout)
+		s.connect(path)
+		s.sendall(request.encode())
+		with s.makefile("r") as f:
+			reply = f.readline()
+	if not reply:
+		raise ConnectionError("The allocator closed the connection without replying")
+	return json.loads(reply)
+
+
+def queue_enabled(db, boardclass):
+	"""
+	Return True if users who find every board of 'boardclass' locked should wait in its queue.
+	"""
+	return db.get("vlab:boardclass:{}:queue".format(boardclass)) == "true"
+
+
+def estimate_wait(db, boardclass, position):
+	"""
+	Return the number of seconds until the user at 'position' (from 1) in the queue for 'boardclass' is due a board
+	at the latest, going by when the current locks expire, or None if there are too few locked boards to tell.
+	"""
+	expiring = db.zrange("vlab:boardclass:{}:locktimes".format(boardclass), position - 1, position - 1, withscores=True)
+	if not expiring:
+		return None
+	return max(0, int(expiring[0][1]) + MAX_LOCK_TIME - int(time.time()))
+
+
+def _leave_queue(db, boardclass, ticket):
+	with db.pipeline() as pipe:
+		pipe.zrem("vlab:boardclass:{}:waiting".format(boardclass), ticket)
+		pipe.delete("vlab:waiter:{}:alive".format(ticket))
+		pipe.execute()
+	# If a board was handed over before we left, give it straight back
+	board = db.lpop("vlab:waiter:{}:board".format(ticket))
+	if board is not None:
+		username = ticket.rsplit(":", 1)[0]
+		start_time = db.hget("vlab:board:{}".format(board), "session:starttime")
+		if start_time is not None:
+			unlock_board_if_user_time(db, board, boardclass, username, start_time)
+			end_session_if_user_time(db, board, boardclass, username, start_time)
+
+
+def wait_for_board(db, username, boardclass, notify=None):
+	"""
+	Join the FIFO wait queue for 'boardclass' and block until a board is handed over to 'username', with its session
+	already started. 'notify' is called every WAITER_POLL seconds with the user's position in the queue (from 1) and
+	the estimated wait in seconds (see estimate_wait()). If waiting is interrupted, for example by KeyboardInterrupt
+	or SystemExit, the user leaves the queue.
+	Returns a dict as allocate() does.
+	"""
+	ticket = "{}:{}".format(username, uuid.uuid4().hex)
+	waiting = "vlab:boardclass:{}:waiting".format(boardclass)
+	alive = "vlab:waiter:{}:alive".format(ticket)
+	with db.pipeline() as pipe:
+		pipe.set(alive, 1, ex=WAITER_TTL)
+		pipe.zadd(waiting, {ticket: time.time()})
+		pipe.execute()
+
+	board = None
+	try:
+		while board is None:
+			# Catch any boards that became allocatable without being handed over, including since we last tried
+			serve_waiters(db, boardclass)
+			rv = db.blpop("vlab:waiter:{}:board".format(ticket), timeout=WAITER_POLL)
+			if rv is not None:
+				board = rv[1]
+				break
+			db.expire(alive, WAITER_TTL)
+			position = db.zrank(waiting, ticket)
+			if position is None:
+				# Either a board has just been handed over, or we were skipped as stale and must rejoin at the back
+				board = db.lpop("vlab:waiter:{}:board".format(ticket))
+				if board is not None:
+					break
+				db.set(alive, 1, ex=WAITER_TTL)
+				db.zadd(waiting, {ticket: time.time()})
+				position = db.zrank(waiting, ticket)
+			if notify is not None:
+				notify(position + 1, estimate_wait(db, boardclass, position + 1))
+	finally:
+		if board is None:
+			_leave_queue(db, boardclass, ticket)
+	db.delete(alive)
+
+	start_time = int(db.hget("vlab:board:{}".format(board), "session:starttime"))
+	return _allocated(db, board, boardclass, start_time, ["Board '{}' has been handed over to you.".format(board)])
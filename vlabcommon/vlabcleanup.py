@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+"""
+Cleaning up boards after their sessions end.
+
+When a user disconnects, the relay's login shell (shell.py) queues the board on the "vlab:cleanup" list and exits
+straight away, leaving the board locked and in its session. The cleanup worker (cleaner.py) takes boards from the
+queue, resets them if they have been used (see reset_command()), retrying failed resets, and only then releases the
+lock and ends the session, so that a board rejoins the available pool as soon as it is clean and not before.
+
+Boards being cleaned up are kept on the "vlab:cleanup:processing" list until they are released, so that the worker
+can pick them up again if it is restarted. While it is running, the worker keeps the "vlab:cleanup:worker" key alive;
+when it is not, shell.py cleans up its own board with cleanup_board().
+"""
+
+import json
+import time
+import redis
+import vlabjobs
+from vlabredis import *
+
+CLEANUP_QUEUE = "vlab:cleanup"
+CLEANUP_PROCESSING = "vlab:cleanup:processing"
+CLEANUP_WORKER_KEY = "vlab:cleanup:worker"
+CLEANUP_WORKER_TTL = 15
+RESET_ATTEMPTS = 3
+RESET_RETRY_DELAY = 5
+RESET_TIMEOUT = 60
+# How the boards of a class are reset, set by "reset" in the class's settings in vlab.conf. "if_used" boards are only
+# reset if they have been used since they were last reset, and "always" boards whenever they are released.
+RESET_POLICIES = ["if_used", "always"]
+DEFAULT_RESET_POLICY = "if_used"
+
+
+def worker_alive(db):
+	return db.exists(CLEANUP_WORKER_KEY) > 0
+
+
+def queue_cleanup(db, board, boardclass, username, start_time):
+	"""
+	Queue 'board' to be reset and released from the session that 'username' started at 'start_time'.
+	"""
+	task = {"board": board, "boardclass": boardclass, "user": username, "start_time": int(start_time),
+	        "queued": time.time()}
+	# Tasks are pushed on the left and taken from the right, as RPOPLPUSH does (LMOVE needs redis 6.2)
+	db.lpush(CLEANUP_QUEUE, json.dumps(task))
+
+
+def take_cleanup(db, timeout):
+	"""
+	Wait up to 'timeout' seconds for a board to clean up, moving it to the processing list. Returns the raw task, to be
+	passed to finish_cleanup(), or None. 'timeout' must be shorter than the client's read timeout.
+	"""
+	return db.brpoplpush(CLEANUP_QUEUE, CLEANUP_PROCESSING, timeout)
+
+
+def finish_cleanup(db, raw_task):
+	db.lrem(CLEANUP_PROCESSING, 1, raw_task)
+
+
+def requeue_unfinished(db):
+	"""
+	Put the boards which were being cleaned up when the worker stopped back at the front of the queue, oldest first.
+	Returns the number requeued.
+	"""
+	with db.pipeline() as pipe:
+		while True:
+			try:
+				pipe.watch(CLEANUP_PROCESSING)
+				unfinished = pipe.lrange(CLEANUP_PROCESSING, 0, -1)
+				pipe.multi()
+				if unfinished:
+					pipe.rpush(CLEANUP_QUEUE, *unfinished)
+				pipe.delete(CLEANUP_PROCESSING)
+				pipe.execute()
+				return len(unfinished)
+			except redis.exceptions.WatchError:
+				continue
+
+
+def reset_command(db, board, always=False):
+	"""
+	Return the command which resets 'board' on its board server, or None if its board type is never reset. Unless
+	'always' is set or the board's class has the "always" reset policy, the board server skips the reset if the board
+	has not been used since it was last reset (see vlabactivity).
+	"""
+	with db.pipeline(transaction=False) as pipe:
+		pipe.get("vlab:knownboard:{}:reset".format(board))
+		pipe.hget("vlab:board:{}".format(board), "boardclass")
+		reset, boardclass = pipe.execute()
+	if reset != "true":
+		return None
+	if always or db.get("vlab:boardclass:{}:reset".format(boardclass)) == "always":
+		return "python3 /vlab/activity.py reset always"
+	return "python3 /vlab/activity.py reset"
+
+
+def reset_board(db, board, server, port, attempts=RESET_ATTEMPTS, delay=RESET_RETRY_DELAY, always=False):
+	"""
+	Reset 'board' if it needs it (see reset_command()), trying up to 'attempts' times. Returns True if the board was
+	reset or did not need to be.
+	"""
+	cmd = reset_command(db, board, always)
+	if cmd is None:
+		return True
+	for attempt in range(attempts):
+		if attempt > 0:
+			time.sleep(delay)
+		rc, stdout, stderr = vlabjobs.run_on_board(server, port, cmd, RESET_TIMEOUT)
+		if rc == 0:
+			return True
+	return False
+
+
+def cleanup_board(db, task, **reset_options):
+	"""
+	Reset the board of the cleanup 'task' (as queued by queue_cleanup()) and release it. The board is released even if
+	it could not be reset, as it was before cleanups were queued. Returns a tuple of (reset succeeded, lock released,
+	session ended), where the reset is None if the session had already ended.
+	"""
+	board, boardclass, username, start_time = task["board"], task["boardclass"], task["user"], task["start_time"]
+	# Pinging the session keeps it from being reaped as stale while the board is reset, and checks it is still ours
+	if not ping_session_if_user_time(db, board, username, start_time):
+		return None, False, False
+	server, port = db.hmget("vlab:board:{}".format(board), ["server", "port"])
+	reset = server is not None and port is not None and reset_board(db, board, server, port, **reset_options)
+	released = unlock_board_if_user_time(db, board, boardclass, username, start_time)
+	ended = end_session_if_user_time(db, board, boardclass, username, start_time)
+	return reset, released, ended
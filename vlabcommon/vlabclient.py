@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+Shared factory for clients of the VLAB redis instance.
+
+Clients created for the same server share one connection pool per process, have bounded connect and read
+timeouts so that a slow or unreachable server cannot hang the caller indefinitely, and retry failed
+connections with a bounded exponential backoff.
+
+Only connection errors are retried. A command which times out may still have been run by the server, and many of
+the VLAB's commands are not safe to run twice: the Lua scripts of board state transitions (such as allocating a
+board and starting a session), lease_port(), and the INCRs which create job and reservation IDs. Reads, PING and
+refreshing heartbeat keys are safe to repeat, and callers may retry them after a TimeoutError themselves.
+
+The defaults can be overridden with the following environment variables:
+VLAB_REDIS_HOST, VLAB_REDIS_PORT, VLAB_REDIS_SOCKET (path to a unix socket, used in preference to host/port),
+VLAB_REDIS_CONNECT_TIMEOUT, VLAB_REDIS_TIMEOUT (seconds) and VLAB_REDIS_RETRIES.
+If VLAB_METRICS is set, clients are instrumented (see vlabmetrics).
+
+Errors are raised as redis.exceptions.ConnectionError or redis.exceptions.TimeoutError.
+"""
+
+import os
+import time
+import redis
+import vlabmetrics
+
+try:
+	from redis.backoff import ExponentialBackoff
+	from redis.retry import Retry
+except ImportError:
+	# redis-py older than 4.1 (as packaged in Ubuntu 22.04) has no per-command retry support
+	Retry = None
+
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 6379
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 10
+# Blocking commands such as BLPOP must return before READ_TIMEOUT, so callers block for at most this many seconds at a
+# time, and loop if they need to wait longer
+BLOCK_TIMEOUT = 5
+RETRIES = 3
+BACKOFF_BASE = 0.25
+BACKOFF_CAP = 4
+
+_pools = {}
+
+
+def _setting(name, value, default, convert=str):
+	if value is not None:
+		return value
+	env = os.environ.get(name)
+	if env is not None and env != "":
+		return convert(env)
+	return default
+
+
+def backoff_delays(retries, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+	"""
+	Return the list of delays in seconds to wait between each of 'retries' retries.
+	"""
+	return [min(cap, base * (2 ** attempt)) for attempt in range(retries)]
+
+
+def _settings(host, port, unix_socket, connect_timeout, timeout, retries):
+	return (
+		_setting("VLAB_REDIS_SOCKET", unix_socket, None),
+		_setting("VLAB_REDIS_HOST", host, DEFAULT_HOST),
+		int(_setting("VLAB_REDIS_PORT", port, DEFAULT_PORT, int)),
+		_setting("VLAB_REDIS_CONNECT_TIMEOUT", connect_timeout, CONNECT_TIMEOUT, float),
+		_setting("VLAB_REDIS_TIMEOUT", timeout, READ_TIMEOUT, float),
+		_setting("VLAB_REDIS_RETRIES", retries, RETRIES, int),
+	)
+
+
+def get_pool(host=None, port=None, unix_socket=None, connect_timeout=None, timeout=None, retries=None):
+	"""
+	Return the connection pool for the given server, creating it on first use.
+	"""
+	pool_key = _settings(host, port, unix_socket, connect_timeout, timeout, retries)
+	if pool_key in _pools:
+		return _pools[pool_key]
+	unix_socket, host, port, connect_timeout, timeout, retries = pool_key
+
+	kwargs = {"db": 0, "decode_responses": True, "socket_timeout": timeout}
+	if Retry is not None:
+		# Not TimeoutError, as commands which timed out may have been run (see above)
+		kwargs["retry"] = Retry(ExponentialBackoff(cap=BACKOFF_CAP, base=BACKOFF_BASE), retries,
+		                        supported_errors=(redis.exceptions.ConnectionError,))
+		kwargs["retry_on_error"] = [redis.exceptions.ConnectionError]
+
+	if unix_socket is not None:
+		pool = redis.ConnectionPool(connection_class=redis.UnixDomainSocketConnection, path=unix_socket, **kwargs)
+	else:
+		pool = redis.ConnectionPool(host=host, port=port, socket_connect_timeout=connect_timeout, **kwargs)
+	_pools[pool_key] = pool
+	return pool
+
+
+def get_client(host=None, port=None, unix_socket=None, connect_timeout=None, timeout=None, retries=None,
+               ping=True):
+	"""
+	Return a redis client using the shared pool for the given server. If 'ping' is set, check that the server is
+	reachable first, retrying with exponential backoff.
+	"""
+	pool = get_pool(host, port, unix_socket, connect_timeout, timeout, retries)
+	client_class = vlabmetrics.InstrumentedRedis if vlabmetrics.enabled() else redis.Redis
+	db = client_class(connection_pool=pool)
+	if ping:
+		# The pool's retry policy already backs off between failed connection attempts, but PING is also safe to
+		# repeat after a timeout
+		if Retry is not None:
+			retryable = (redis.exceptions.TimeoutError,)
+		else:
+			retryable = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+		delays = backoff_delays(_setting("VLAB_REDIS_RETRIES", retries, RETRIES, int))
+		for delay in delays + [None]:
+			try:
+				db.ping()
+				break
+			except retryable:
+				if delay is None:
+					raise
+				time.sleep(delay)
+	return db
+
+
+def reset_pools():
+	"""
+	Disconnect and forget every shared pool, for example after forking.
+	"""
+	for pool in _pools.values():
+		pool.disconnect()
+	_pools.clear()
@@ -36,6 +36,7 @@ def open_log(log, logfile):
 
 	allowed_user_properties = ["overlord", "allowedboards"]
 	required_board_properties = ["class", "type"]
+	allowed_boardclass_properties = ["queue", "policy", "reset"]
 
 	for user in users:
 		for k in users[user].keys():
@@ -49,4 +50,21 @@ def open_log(log, logfile):
 				log.critical("Board {} does not have property {}.".format(board, p))
 				return None
 
+	# The optional 'cohorts' section names groups of users, for making reservations
+	for cohort, members in config.get('cohorts', {}).items():
+		if not isinstance(members, list):
+			log.critical("Cohort {} is not a list of users.".format(cohort))
+			return None
+		for user in members:
+			if user not in users:
+				log.critical("Cohort {} has unknown user {}.".format(cohort, user))
+				return None
+
+	# The optional 'boardclasses' section holds per-class settings
+	for bc in config.get('boardclasses', {}):
+		for k in config['boardclasses'][bc].keys():
+			if k not in allowed_boardclass_properties:
+				log.critical("Board class {} has unknown property {}.".format(bc, k))
+				return None
+
 	return config
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"""
+Programming boards and capturing their serial output without an interactive session, for the relay's hardware tests
+(testboards.py) and headless batch jobs.
+
+A batch job is a tar archive holding a bitstream and, optionally, an ELF and a ps7_init.tcl (see JOB_FILES), which is
+programmed onto the next idle board of a class by the job runner (jobrunner.py). The board's serial output is captured
+for the job's timeout and kept as the job's output. Each job is stored in the "vlab:job:<id>" hash and queued on the
+"vlab:boardclass:<class>:jobs" list, and the IDs of each user's jobs are kept in the "vlab:user:<username>:jobs" sorted
+set, scored by submission time. The archives are kept in JOBS_DIR until the job has run.
+"""
+
+import io
+import os
+import subprocess
+import tarfile
+import time
+import uuid
+import vlabclient
+import vlabssh
+
+JOBS_DIR = "/vlab/jobs"
+# Archive members, and the xsdb argument each is passed as ("-" if it is missing). Missing ps7_init.tcl files are
+# replaced with the one used for hardware tests.
+JOB_FILES = ["design.bit", "app.elf", "ps7_init.tcl"]
+MAX_JOB_SIZE = 64 * 1024 * 1024
+MAX_JOB_TIMEOUT = 300
+MAX_JOB_OUTPUT = 64 * 1024
+# Finished jobs are kept for this many seconds
+JOB_TTL = 7 * 24 * 3600
+# Boards running a job are in a session held by this prefix followed by the job's user
+BATCH_USER_PREFIX = "batch:"
+
+SERIAL_CAPTURE = "/tmp/vlab_serial_capture"
+JOB_WORKDIR = "/tmp/vlab_job"
+
+
+def run_on_board(server, port, cmd, timeout=30, input=None):
+	"""
+	Run 'cmd' on the board server container at 'server':'port', sending the bytes 'input' to its standard input.
+	Returns (returncode, stdout, stderr), with a return code of -1 if the command could not be run or timed out.
+	"""
+	ssh_cmd = vlabssh.ssh_args("root@{}".format(server), cmd, port)
+	try:
+		result = subprocess.run(ssh_cmd, capture_output=True, timeout=timeout, input=input)
+		return result.returncode, result.stdout.decode(errors="replace"), result.stderr.decode(errors="replace")
+	except subprocess.TimeoutExpired:
+		return -1, "", "SSH command timed out after {}s".format(timeout)
+	except Exception as e:
+		return -1, "", str(e)
+
+
+def program_and_read_serial(server, port, args=(), setup="", input=None, timeout=90, owner=None):
+	"""
+	Program a board with /vlab/test.tcl and capture its serial output in one SSH session. With no 'args', the script
+	programs the hardware test design. Otherwise 'args' are the bitstream, ELF, ps7_init.tcl and time to wait for
+	output in milliseconds (see boardserver/test.tcl). 'setup' is a shell command run first, which is given 'input'.
+
+	Starts watching the board's serial console in the background before launching xsdb, so that any output from the
+	ELF is captured even if it arrives early. If 'owner' is given, the console is attached to as 'owner', so that its
+	output is kept for them rather than for the board's last user (see vlabserial).
+	Returns (success, serial_output, error_message).
+	"""
+	console = "attach {} < /dev/null".format(owner) if owner is not None else "view"
+	cmd = (
+		"{}"
+		"killall -q screen; "
+		"python3 /vlab/console.py {console} > {capture} & CAT_PID=$!; "
+		"/opt/xsct/bin/xsdb /vlab/test.tcl {args} >&2; XSDB_RC=$?; "
+		"sleep 1; "
+		"kill $CAT_PID 2>/dev/null; "
+		"cat {capture}; "
+		"exit $XSDB_RC"
+	).format(setup, console=console, capture=SERIAL_CAPTURE, args=" ".join(str(a) for a in args))
+	rc, stdout, stderr = run_on_board(server, port, cmd, timeout=timeout, input=input)
+	if rc != 0:
+		return False, "", "xsdb failed (rc={}): {} {}".format(rc, stdout.strip(), stderr.strip())
+	return True, stdout, ""
+
+
+def check_job_archive(data):
+	"""
+	Return an error message if the bytes 'data' are not a valid job archive, or None if they are.
+	"""
+	if len(data) > MAX_JOB_SIZE:
+		return "Jobs may be at most {} MB.".format(MAX_JOB_SIZE // (1024 * 1024))
+	try:
+		with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+			members = tar.getmembers()
+	except tarfile.TarError as e:
+		return "The job is not a valid tar archive: {}".format(e)
+	names = [m.name for m in members]
+	for m in members:
+		if m.name not in JOB_FILES or not m.isfile():
+			return "Unexpected file '{}' in the job. Jobs may only contain {}.".format(m.name, ", ".join(JOB_FILES))
+	if len(set(names)) != len(names):
+		return "The job contains duplicate files."
+	if JOB_FILES[0] not in names:
+		return "The job does not contain a bitstream ({}).".format(JOB_FILES[0])
+	return None
+
+
+def submit_job(db, username, boardclass, timeout, archive):
+	"""
+	Queue the job archive 'archive' (bytes, checked with check_job_archive()) to run for 'timeout' seconds on a board
+	of 'boardclass'. Returns the job's ID.
+	"""
+	# Anybody may write to JOBS_DIR and job IDs are predictable, so archives are created exclusively under a random
+	# name, which nobody else can have planted a file under
+	archive_name = "{}.tar".format(uuid.uuid4().hex)
+	fd = os.open(os.path.join(JOBS_DIR, archive_name), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+	with os.fdopen(fd, "wb") as f:
+		f.write(archive)
+	job_id = db.incr("vlab:jobs:next")
+	now = int(time.time())
+	with db.pipeline() as pipe:
+		pipe.hset("vlab:job:{}".format(job_id), mapping={
+			"user": username, "boardclass": boardclass, "timeout": timeout, "status": "queued", "submitted": now,
+			"archive": archive_name})
+		pipe.zadd("vlab:user:{}:jobs".format(username), {job_id: now})
+		pipe.rpush("vlab:boardclass:{}:jobs".format(boardclass), job_id)
+		pipe.execute()
+	return job_id
+
+
+def job_archive(job):
+	"""
+	Return the path of the archive of 'job', as returned by get_job().
+	"""
+	return os.path.join(JOBS_DIR, os.path.basename(job.get("archive", "")))
+
+
+def get_job(db, job_id):
+	"""
+	Return the hash of the job 'job_id' as a dict, including its "id", or None if it does not exist.
+	"""
+	job = db.hgetall("vlab:job:{}".format(job_id))
+	if not job:
+		return None
+	job["id"] = str(job_id)
+	return job
+
+
+def get_jobs_of(db, username):
+	"""
+	Return the jobs of 'username' that have not expired, oldest first.
+	"""
+	jobs = []
+	for job_id in db.zrange("vlab:user:{}:jobs".format(username), 0, -1):
+		job = get_job(db, job_id)
+		if job is None:
+			db.zrem("vlab:user:{}:jobs".format(username), job_id)
+		else:
+			jobs.append(job)
+	return jobs
+
+
+def queue_position(db, job_id):
+	"""
+	Return the position (from 1) of a queued job in its class's queue, or None if it is not queued.
+	"""
+	boardclass = db.hget("vlab:job:{}".format(job_id), "boardclass")
+	if boardclass is None:
+		return None
+	queue = db.lrange("vlab:boardclass:{}:jobs".format(boardclass), 0, -1)
+	if str(job_id) not in queue:
+		return None
+	return queue.index(str(job_id)) + 1
+
+
+def wait_for_job(db, job_id, timeout):
+	"""
+	Block for up to 'timeout' seconds until the job 'job_id' has finished. Returns the job as get_job() does.
+	"""
+	deadline = time.time() + timeout
+	while True:
+		remaining = int(deadline - time.time())
+		if remaining <= 0:
+			break
+		if db.blpop("vlab:job:{}:finished".format(job_id), timeout=min(remaining, vlabclient.BLOCK_TIMEOUT)) is not None:
+			break
+	return get_job(db, job_id)
+
+
+def take_job(db, boardclass):
+	"""
+	Take the next job from the queue of 'boardclass' and mark it as running. Returns the job, or None if there are none.
+	"""
+	job_id = db.lpop("vlab:boardclass:{}:jobs".format(boardclass))
+	if job_id is None:
+		return None
+	db.hset("vlab:job:{}".format(job_id), mapping={"status": "running", "started": int(time.time())})
+	return get_job(db, job_id)
+
+
+def finish_job(db, job_id, status, output, message=""):
+	"""
+	Record the result of the job 'job_id', remove its archive, and wake anybody waiting for it.
+	"""
+	if len(output) > MAX_JOB_OUTPUT:
+		output = output[:MAX_JOB_OUTPUT] + "\n[Output truncated after {} bytes]\n".format(MAX_JOB_OUTPUT)
+	archive_name = db.hget("vlab:job:{}".format(job_id), "archive")
+	with db.pipeline() as pipe:
+		pipe.hset("vlab:job:{}".format(job_id), mapping={
+			"status": status, "finished": int(time.time()), "output": output, "message": message})
+		pipe.expire("vlab:job:{}".format(job_id), JOB_TTL)
+		pipe.rpush("vlab:job:{}:finished".format(job_id), 1)
+		pipe.expire("vlab:job:{}:finished".format(job_id), 60)
+		pipe.execute()
+	if archive_name:
+		try:
+			os.remove(job_archive({"archive": archive_name}))
+		except OSError:
+			pass
+
+
+def print_job(job):
+	"""
+	Print the status of a job, and its output if it has finished. Returns an exit status for the shell: 0 if the job
+	ran, 1 if it failed and 2 if it has not finished.
+	"""
+	if job["status"] in ("queued", "running"):
+		print("Job {} is {}. Fetch its output later with the job ID.".format(job["id"], job["status"]))
+		return 2
+	if job.get("board"):
+		print("Job {} ran on board {}.".format(job["id"], job["board"]))
+	if job.get("message"):
+		print(job["message"])
+	print(job.get("output", ""), end="")
+	return 0 if job["status"] == "done" else 1
+
+
+def run_job(job, server, port):
+	"""
+	Program the board server container at 'server':'port' with the job 'job' and capture its serial output for the
+	job's timeout. Returns (success, serial_output, error_message).
+	"""
+	if not job.get("archive"):
+		return False, "", "The job has no archive."
+	try:
+		with open(job_archive(job), "rb") as f:
+			archive = f.read()
+	except OSError as e:
+		return False, "", "Could not read the job: {}".format(e)
+	# The archive is checked again, as its owner could have changed it since it was submitted
+	problem = check_job_archive(archive)
+	if problem is not None:
+		return False, "", problem
+	with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+		names = tar.getnames()
+
+	args = []
+	for name in JOB_FILES:
+		if name in names:
+			args.append("{}/{}".format(JOB_WORKDIR, name))
+		elif name == "ps7_init.tcl":
+			args.append("/vlab/test/ps7_init.tcl")
+		else:
+			args.append("-")
+	args.append(int(job["timeout"]) * 1000)
+	setup = "rm -rf {0} && mkdir -p {0} && tar -x -C {0} && ".format(JOB_WORKDIR)
+	return program_and_read_serial(server, port, args, setup, archive, timeout=int(job["timeout"]) + 90,
+	                               owner=BATCH_USER_PREFIX + job["user"])
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""
+Opt-in instrumentation of the VLAB's use of redis.
+
+When the VLAB_METRICS environment variable is set, clients from vlabclient.get_client() record the number of round
+trips and commands they send, and a latency histogram for each command, and every public vlabredis function records
+how many times it was called and which round trips it made. Set VLAB_METRICS to a file path to have a JSON summary
+appended to that file when the process exits, or to "1" to only collect them (for example for the web dashboard's
+/api/metrics endpoint). Use snapshot() or dump() to read the figures at any time.
+"""
+
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import redis
+
+# Upper bounds, in milliseconds, of the latency histogram buckets. Slower commands fall in a final overflow bucket.
+LATENCY_BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+_lock = threading.Lock()
+_local = threading.local()
+_functions = {}
+_commands = {}
+_totals = {"round_trips": 0, "commands": 0, "time_ms": 0.0}
+
+
+def enabled():
+	return os.environ.get("VLAB_METRICS", "") not in ("", "0")
+
+
+def reset():
+	"""
+	Forget every figure recorded so far.
+	"""
+	with _lock:
+		_functions.clear()
+		_commands.clear()
+		_totals.update(round_trips=0, commands=0, time_ms=0.0)
+
+
+def _function_stats(name):
+	if name not in _functions:
+		_functions[name] = {"calls": 0, "round_trips": 0, "commands": 0, "time_ms": 0.0}
+	return _functions[name]
+
+
+def record_round_trip(commands, elapsed):
+	"""
+	Record a single round trip to the server which sent the list of command names 'commands' and took 'elapsed'
+	seconds. It is attributed to the innermost instrumented function running in this thread, if any.
+	"""
+	elapsed_ms = elapsed * 1000
+	bucket = len(LATENCY_BUCKETS_MS)
+	for i, bound in enumerate(LATENCY_BUCKETS_MS):
+		if elapsed_ms <= bound:
+			bucket = i
+			break
+	name = " ".join(commands) if len(commands) == 1 else "PIPELINE"
+	stack = getattr(_local, "functions", [])
+
+	with _lock:
+		_totals["round_trips"] += 1
+		_totals["commands"] += len(commands)
+		_totals["time_ms"] += elapsed_ms
+		if name not in _commands:
+			_commands[name] = {"count": 0, "time_ms": 0.0, "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+		_commands[name]["count"] += 1
+		_commands[name]["time_ms"] += elapsed_ms
+		_commands[name]["histogram"][bucket] += 1
+		if stack:
+			stats = _function_stats(stack[-1])
+			stats["round_trips"] += 1
+			stats["commands"] += len(commands)
+			stats["time_ms"] += elapsed_ms
+
+
+def instrument(name, fn):
+	"""
+	Return a wrapper of the function 'fn' which counts its calls under 'name' and attributes the round trips it
+	makes to it.
+	"""
+	@functools.wraps(fn)
+	def wrapper(*args, **kwargs):
+		with _lock:
+			_function_stats(name)["calls"] += 1
+		if not hasattr(_local, "functions"):
+			_local.functions = []
+		_local.functions.append(name)
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			_local.functions.pop()
+	return wrapper
+
+
+def instrument_module(module):
+	"""
+	Replace every public function defined in 'module' with an instrumented wrapper.
+	"""
+	for name, value in list(vars(module).items()):
+		if callable(value) and not name.startswith("_") and getattr(value, "__module__", None) == module.__name__ \
+				and not isinstance(value, type):
+			setattr(module, name, instrument("{}.{}".format(module.__name__, name), value))
+
+
+def _command_name(args):
+	return str(args[0]).upper() if args else "?"
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+	def execute(self, raise_on_error=True):
+		commands = [_command_name(args) for args, options in self.command_stack]
+		start = time.perf_counter()
+		try:
+			return super().execute(raise_on_error)
+		finally:
+			if commands:
+				record_round_trip(commands, time.perf_counter() - start)
+
+	def immediate_execute_command(self, *args, **options):
+		# Commands sent straight away while a pipeline is WATCHing keys
+		start = time.perf_counter()
+		try:
+			return super().immediate_execute_command(*args, **options)
+		finally:
+			record_round_trip([_command_name(args)], time.perf_counter() - start)
+
+
+class InstrumentedRedis(redis.Redis):
+	def execute_command(self, *args, **options):
+		start = time.perf_counter()
+		try:
+			return super().execute_command(*args, **options)
+		finally:
+			record_round_trip([_command_name(args)], time.perf_counter() - start)
+
+	def pipeline(self, transaction=True, shard_hint=None):
+		return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def snapshot():
+	"""
+	Return a dict of every figure recorded so far.
+	"""
+	with _lock:
+		return {
+			"program": os.path.basename(sys.argv[0]) if sys.argv else "",
+			"pid": os.getpid(),
+			"time": int(time.time()),
+			"totals": dict(_totals),
+			"functions": {name: dict(stats) for name, stats in _functions.items()},
+			"commands": {name: dict(stats, histogram=list(stats["histogram"])) for name, stats in _commands.items()},
+			"buckets_ms": LATENCY_BUCKETS_MS,
+		}
+
+
+def dump(path=None):
+	"""
+	Return the current figures as a line of JSON, also appending it to the file 'path' if given.
+	"""
+	line = json.dumps(snapshot(), sort_keys=True)
+	if path is not None:
+		with open(path, "a") as f:
+			f.write(line + "\n")
+	return line
+
+
+def _dump_at_exit(path):
+	try:
+		dump(path)
+	except OSError as e:
+		print("Could not write VLAB metrics to {}: {}".format(path, e), file=sys.stderr)
+
+
+if enabled() and os.environ["VLAB_METRICS"] != "1":
+	atexit.register(_dump_at_exit, os.environ["VLAB_METRICS"])
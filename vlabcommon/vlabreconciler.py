@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Coordination of the relay's reconciler (checkboards.py), which runs as a long-lived daemon under supervisord.
+
+Only one reconciler may run at a time. Each instance claims the "vlab:reconciler" key with a token of its own and
+renews the claim every cycle, and an instance which finds the key held by another waits for it to expire. A claim
+expires RECONCILER_TTL seconds after it was last renewed, so a reconciler which dies is replaced promptly.
+
+The reconciler runs each of its checks on its own interval. How long each check's last cycle took is recorded in the
+"vlab:reconciler:metrics" hash (see record_cycle()), where the web dashboard and redis-cli can read it.
+"""
+
+import time
+
+RECONCILER_KEY = "vlab:reconciler"
+RECONCILER_METRICS = "vlab:reconciler:metrics"
+RECONCILER_TTL = 30
+# How often, in seconds, the reconciler recovers sessions and locks, and checks that the board servers are reachable
+LOCK_CHECK_INTERVAL = 60
+SSH_CHECK_INTERVAL = 300
+
+_CLAIM_LUA = """
+local holder = redis.call('GET', KEYS[1])
+if holder and holder ~= ARGV[1] then
+	return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+	return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_RECORD_CYCLE_LUA = """
+local max = tonumber(redis.call('HGET', KEYS[1], ARGV[1] .. ':max'))
+if not max or tonumber(ARGV[2]) > max then
+	redis.call('HSET', KEYS[1], ARGV[1] .. ':max', ARGV[2])
+end
+redis.call('HSET', KEYS[1], ARGV[1] .. ':duration', ARGV[2], ARGV[1] .. ':last', ARGV[3])
+redis.call('HINCRBY', KEYS[1], ARGV[1] .. ':cycles', 1)
+"""
+
+
+def claim(db, token, ttl=RECONCILER_TTL):
+	"""
+	Claim or renew the reconciler's claim for the instance 'token' for 'ttl' seconds. Returns False if another
+	instance holds it.
+	"""
+	return db.register_script(_CLAIM_LUA)(keys=[RECONCILER_KEY], args=[token, ttl]) == 1
+
+
+def release(db, token):
+	"""
+	Give up the claim of the instance 'token', if it still holds it.
+	"""
+	return db.register_script(_RELEASE_LUA)(keys=[RECONCILER_KEY], args=[token]) == 1
+
+
+def holder(db):
+	return db.get(RECONCILER_KEY)
+
+
+def record_cycle(db, check, duration, finish_time=None):
+	"""
+	Record that a cycle of the reconciler's 'check' took 'duration' seconds. The hash RECONCILER_METRICS holds, for
+	each check, the duration of its last cycle (<check>:duration), the longest (<check>:max), the number of cycles
+	run (<check>:cycles) and when the last one finished (<check>:last).
+	"""
+	if finish_time is None:
+		finish_time = int(time.time())
+	db.register_script(_RECORD_CYCLE_LUA)(keys=[RECONCILER_METRICS], args=[check, round(duration, 3), finish_time])
+
+
+def get_metrics(db):
+	"""
+	Return the figures recorded by record_cycle() as a dict of check to a dict of figure to value.
+	"""
+	metrics = {}
+	for field, value in db.hgetall(RECONCILER_METRICS).items():
+		check, figure = field.rsplit(":", 1)
+		metrics.setdefault(check, {})[figure] = int(value) if figure in ("cycles", "last") else float(value)
+	return metrics
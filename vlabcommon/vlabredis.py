@@ -9,18 +9,59 @@ Ian Gray, 2016
 import sys
 import time
 import redis
+import vlabclient
+import vlabmetrics
 
 MAX_LOCK_TIME = 3600
+# Sessions send a heartbeat ping every HEARTBEAT_INTERVAL seconds, and are ended if none arrives for PING_TIMEOUT
+HEARTBEAT_INTERVAL = 30
+PING_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+# Relay ports for users' tunnels are leased from this range (inclusive). Leases that are not renewed for
+# PORT_LEASE_TIMEOUT seconds are reclaimed.
+PORT_RANGE = (30000, 35000)
+PORT_LEASE_TIMEOUT = 300
+# By default, boards held back for a reservation are released if unclaimed this many seconds after it starts
+RESERVATION_CLAIM_TIME = 15 * 60
 
+# Each registered board is stored as a single hash at "vlab:board:<serial>" holding these fields.
+# "boardclass" is a back link to the "vlab:boardclass:<class>:boards" set the board is a member of, and must
+# always be written in the same transaction as that set.
+# The transient "vlab:board:<serial>:hwtest:testing" flag stays a separate string key so it can carry a TTL.
+# "vlab:user:<username>:boards" indexes the boards on which a user holds a lock or a session.
+# When a session is ended or taken over, "<username>:<starttime>" of that session is published on the board's
+# "vlab:board:<serial>:revoked" channel (see watch_for_revocation()).
+# Every lock, release, session start and end and board removal is also appended to the capped "vlab:events"
+# stream (see read_events()). Session pings are not journalled.
+# "vlab:boardclass:<class>:locktimes" and "vlab:boardclass:<class>:pingtimes" index the boards of a class that are
+# locked or in a session, scored by their lock time and last session ping time, so that expired entries can be
+# found with a single ZRANGEBYSCORE.
+# "vlab:host:<server>:sessions" indexes the boards on each board host that are in a session, and the
+# "vlab:boardclass:<class>:lastboards" hash records the board each user last had a session on. Both are used by the
+# allocation policies (see ALLOCATION_POLICIES), and "session:policy" records which policy picked a board.
+# Reservation <id> is stored in the "vlab:reservation:<id>" hash, with its users in "vlab:reservation:<id>:users"
+# and the users who have claimed a board from it in "vlab:reservation:<id>:claims". Reservations are indexed by
+# start time in "vlab:reservations" and in the "vlab:boardclass:<class>:reservations" set of their class. From its
+# start until its claim deadline, each reservation holds back one available board for each of its unclaimed places.
+# Unleased relay ports are kept in the "vlab:ports:free" set. Leased ports are scored by the time their lease was
+# last renewed in the "vlab:ports:leases" sorted set, and their owners are kept in the "vlab:ports:owners" hash.
+BOARD_FIELDS = [
+	"boardclass", "user", "server", "port",
+	"lock:username", "lock:time",
+	"session:username", "session:starttime", "session:pingtime", "session:policy",
+	"hwtest:status", "hwtest:time", "hwtest:message",
+]
 
-def connect_to_redis(host):
+EVENTS_STREAM = "vlab:events"
+EVENTS_MAXLEN = 10000
+
+
+def connect_to_redis(host=None, port=None):
 	"""
-	Connect to the redis server
+	Connect to the redis server, using the shared client factory in vlabclient
 	"""
 	try:
-		db = redis.Redis(host=host, port=6379, db=0, decode_responses=True)
-		db.ping()
-	except redis.exceptions.ConnectionError as e:
+		db = vlabclient.get_client(host=host, port=port)
+	except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
 		print("Error whilst connecting to host {}\n{}".format(host, e))
 		sys.exit(1)
 	return db
@@ -50,19 +91,237 @@ def get_or_fail(db, value, err_str):
 def get_board_details(db, b, details):
 	"""
 	Return a dict of key values fetched about the board named b. 'details' is a list of
-	key names to fetch.
+	field names to fetch from the board's hash.
 	"""
+	values = db.hmget("vlab:board:{}".format(b), details)
 	rv = {}
-	for detail in details:
-		rv[detail] = get_or_fail(db, "vlab:board:{}:{}".format(b, detail),
-		                         "Board {} is missing a value for {}.".format(b, detail))
+	for detail, value in zip(details, values):
+		if value is None:
+			print("Board {} is missing a value for {}.".format(b, detail))
+			sys.exit(1)
+		rv[detail] = value
+	return rv
+
+
+def get_board_record(db, b, required=()):
+	"""
+	Return every field stored in the hash of the board named b as a dict, in a single round trip.
+	Fail if any of the field names in 'required' are missing.
+	"""
+	rv = db.hgetall("vlab:board:{}".format(b))
+	for detail in required:
+		if detail not in rv:
+			print("Board {} is missing a value for {}.".format(b, detail))
+			sys.exit(1)
 	return rv
 
 
+# Board state transitions are implemented as Lua scripts so that each one is applied atomically in a single round
+# trip, along with the per-user index. The VLAB uses a single, non-clustered Redis server, so scripts build the
+# names of the keys they touch themselves rather than having them all declared up front.
+_LUA_PRELUDE = """
+local function journal(event, board, boardclass, user)
+	local fields = {'event', event}
+	for _, field in ipairs({{'board', board}, {'boardclass', boardclass}, {'user', user}}) do
+		if field[2] then
+			table.insert(fields, field[1])
+			table.insert(fields, field[2])
+		end
+	end
+	redis.call('XADD', '""" + EVENTS_STREAM + """', 'MAXLEN', '~', """ + str(EVENTS_MAXLEN) + """, '*', unpack(fields))
+end
+
+local function board_key(board)
+	return 'vlab:board:' .. board
+end
+
+local function waiting_key(boardclass)
+	return 'vlab:boardclass:' .. boardclass .. ':waiting'
+end
+
+-- Check the reservations of 'boardclass' which are holding back boards at time 'now'. Returns the ID of a reservation
+-- that 'user' holds and has not yet claimed, if any, and the number of boards held back for unclaimed reservations.
+local function reservations(boardclass, user, now)
+	local holder, held = nil, 0
+	for _, id in ipairs(redis.call('ZRANGEBYSCORE', 'vlab:boardclass:' .. boardclass .. ':reservations', '-inf', now)) do
+		local key = 'vlab:reservation:' .. id
+		local reservation = redis.call('HMGET', key, 'count', 'deadline')
+		if reservation[1] and tonumber(now) < tonumber(reservation[2]) then
+			-- Only the reservation's users can claim its boards, so no more are held back than there are users
+			local places = math.min(tonumber(reservation[1]), redis.call('SCARD', key .. ':users'))
+			local unclaimed = places - redis.call('SCARD', key .. ':claims')
+			if unclaimed > 0 then
+				held = held + unclaimed
+				if not holder and redis.call('SISMEMBER', key .. ':users', user) == 1
+						and redis.call('SISMEMBER', key .. ':claims', user) == 0 then
+					holder = id
+				end
+			end
+		end
+	end
+	return holder, held
+end
+
+-- Whether a user who does not hold a reservation may take 'board' of 'boardclass', given 'held' boards held back.
+-- Boards are only held back from the available pool.
+local function allowed_unreserved(board, boardclass, held)
+	local available = 'vlab:boardclass:' .. boardclass .. ':availableboards'
+	return held == 0 or not redis.call('ZSCORE', available, board) or redis.call('ZCARD', available) > held
+end
+
+-- Defined after start_session, which it uses
+local hand_over
+
+local function user_key(user)
+	return 'vlab:user:' .. user .. ':boards'
+end
+
+local function revoke_session(board)
+	local session = redis.call('HMGET', board_key(board), 'session:username', 'session:starttime')
+	if session[1] and session[2] then
+		redis.call('PUBLISH', board_key(board) .. ':revoked', session[1] .. ':' .. session[2])
+	end
+end
+
+local function unindex_user(board, user)
+	if user and redis.call('HGET', board_key(board), 'lock:username') ~= user
+			and redis.call('HGET', board_key(board), 'session:username') ~= user then
+		redis.call('SREM', user_key(user), board)
+	end
+end
+
+local function lock_board(board, boardclass, user, lock_time)
+	local old_user = redis.call('HGET', board_key(board), 'lock:username')
+	redis.call('ZREM', 'vlab:boardclass:' .. boardclass .. ':unlockedboards', board)
+	redis.call('HSET', board_key(board), 'lock:username', user, 'lock:time', lock_time)
+	redis.call('ZADD', 'vlab:boardclass:' .. boardclass .. ':locktimes', lock_time, board)
+	redis.call('SADD', user_key(user), board)
+	unindex_user(board, old_user)
+	journal('LOCK', board, boardclass, user)
+end
+
+local function unlock_board(board, boardclass, unlock_time)
+	local old_user = redis.call('HGET', board_key(board), 'lock:username')
+	redis.call('HDEL', board_key(board), 'lock:username', 'lock:time')
+	redis.call('ZREM', 'vlab:boardclass:' .. boardclass .. ':locktimes', board)
+	redis.call('ZADD', 'vlab:boardclass:' .. boardclass .. ':unlockedboards', unlock_time, board)
+	unindex_user(board, old_user)
+	journal('RELEASE', board, boardclass, old_user)
+	if not redis.call('HGET', board_key(board), 'session:username') then
+		hand_over(board, boardclass, unlock_time)
+	end
+end
+
+local function host_key(board)
+	local server = redis.call('HGET', board_key(board), 'server')
+	if server then
+		return 'vlab:host:' .. server .. ':sessions'
+	end
+end
+
+local function start_session(board, boardclass, user, start_time)
+	local old_user = redis.call('HGET', board_key(board), 'session:username')
+	revoke_session(board)
+	lock_board(board, boardclass, user, start_time)
+	redis.call('ZREM', 'vlab:boardclass:' .. boardclass .. ':availableboards', board)
+	redis.call('HSET', board_key(board),
+		'session:username', user, 'session:starttime', start_time, 'session:pingtime', start_time)
+	-- Callers which picked the board by an allocation policy record it afterwards
+	redis.call('HDEL', board_key(board), 'session:policy')
+	redis.call('ZADD', 'vlab:boardclass:' .. boardclass .. ':pingtimes', start_time, board)
+	redis.call('HSET', 'vlab:boardclass:' .. boardclass .. ':lastboards', user, board)
+	if host_key(board) then
+		redis.call('SADD', host_key(board), board)
+	end
+	unindex_user(board, old_user)
+	journal('START', board, boardclass, user)
+end
+
+-- Start a session on 'board' for the first live ticket in the boardclass's wait queue, if any, and push the board
+-- onto that waiter's hand over list. Tickets are "<username>:<nonce>", and are live while their "alive" key exists.
+-- Stale tickets are dropped. If the board is held back for a reservation, only waiters holding one are considered.
+hand_over = function(board, boardclass, now)
+	for _, ticket in ipairs(redis.call('ZRANGE', waiting_key(boardclass), 0, -1)) do
+		if redis.call('EXISTS', 'vlab:waiter:' .. ticket .. ':alive') == 0 then
+			redis.call('ZREM', waiting_key(boardclass), ticket)
+		else
+			local user = string.match(ticket, '^(.*):[^:]*$')
+			local holder, held = reservations(boardclass, user, now)
+			if holder or allowed_unreserved(board, boardclass, held) then
+				redis.call('ZREM', waiting_key(boardclass), ticket)
+				start_session(board, boardclass, user, now)
+				redis.call('HSET', board_key(board), 'session:policy', 'queue')
+				if holder then
+					redis.call('SADD', 'vlab:reservation:' .. holder .. ':claims', user)
+				end
+				redis.call('RPUSH', 'vlab:waiter:' .. ticket .. ':board', board)
+				redis.call('EXPIRE', 'vlab:waiter:' .. ticket .. ':board', 60)
+				return true
+			end
+		end
+	end
+	return false
+end
+
+local function end_session(board, boardclass, end_time)
+	local old_user = redis.call('HGET', board_key(board), 'session:username')
+	revoke_session(board)
+	redis.call('HDEL', board_key(board), 'session:username', 'session:starttime', 'session:pingtime', 'session:policy')
+	redis.call('ZREM', 'vlab:boardclass:' .. boardclass .. ':pingtimes', board)
+	if host_key(board) then
+		redis.call('SREM', host_key(board), board)
+	end
+	redis.call('ZADD', 'vlab:boardclass:' .. boardclass .. ':availableboards', end_time, board)
+	unindex_user(board, old_user)
+	journal('END', board, boardclass, old_user)
+	if not redis.call('HGET', board_key(board), 'lock:username') then
+		hand_over(board, boardclass, end_time)
+	end
+end
+
+local function ping_session(board, ping_time)
+	local boardclass = redis.call('HGET', board_key(board), 'boardclass')
+	redis.call('HSET', board_key(board), 'session:pingtime', ping_time)
+	if boardclass then
+		-- XX only updates boards already indexed by start_session
+		redis.call('ZADD', 'vlab:boardclass:' .. boardclass .. ':pingtimes', 'XX', ping_time, board)
+	end
+end
+
+local function remove_board(board)
+	local details = redis.call('HMGET', board_key(board), 'boardclass', 'lock:username', 'session:username')
+	revoke_session(board)
+	if host_key(board) then
+		redis.call('SREM', host_key(board), board)
+	end
+	redis.call('DEL', board_key(board), board_key(board) .. ':hwtest:testing')
+	unindex_user(board, details[2])
+	unindex_user(board, details[3])
+	if details[1] then
+		redis.call('SREM', 'vlab:boardclass:' .. details[1] .. ':boards', board)
+		redis.call('ZREM', 'vlab:boardclass:' .. details[1] .. ':unlockedboards', board)
+		redis.call('ZREM', 'vlab:boardclass:' .. details[1] .. ':availableboards', board)
+		redis.call('ZREM', 'vlab:boardclass:' .. details[1] .. ':locktimes', board)
+		redis.call('ZREM', 'vlab:boardclass:' .. details[1] .. ':pingtimes', board)
+	end
+	journal('REMOVE', board, details[1], nil)
+end
+"""
+
+
+# Scripts registered by _run_script(), by body, so that each is only hashed once
+_scripts = {}
+
+
+def _run_script(db, body, args):
+	script = _scripts.get(body)
+	if script is None:
+		script = _scripts[body] = db.register_script(_LUA_PRELUDE + body)
+	return script(args=args, client=db)
+
+
 def lock_board(db, board, boardclass, username, lock_time):
-	db.zrem("vlab:boardclass:{}:unlockedboards".format(boardclass), board)
-	db.set("vlab:board:{}:lock:username".format(board), username)
-	db.set("vlab:board:{}:lock:time".format(board), lock_time)
+	_run_script(db, "lock_board(ARGV[1], ARGV[2], ARGV[3], ARGV[4])", [board, boardclass, username, lock_time])
 
 
 def unlock_board(db, board, boardclass):
@@ -70,30 +329,44 @@ def unlock_board(db, board, boardclass):
 	Unlock the board 'board' of a given 'boardclass'.
 	"""
 	unlock_time = int(time.time())
-	db.delete("vlab:board:{}:lock:username".format(board))
-	db.delete("vlab:board:{}:lock:time".format(board))
-	db.zadd("vlab:boardclass:{}:unlockedboards".format(boardclass), {board: unlock_time})
+	_run_script(db, "unlock_board(ARGV[1], ARGV[2], ARGV[3])", [board, boardclass, unlock_time])
 	return True
 
 
+_UNLOCK_BOARD_IF_USER_LUA = """
+if redis.call('HGET', board_key(ARGV[1]), 'lock:username') ~= ARGV[3] then
+	return 0
+end
+unlock_board(ARGV[1], ARGV[2], ARGV[4])
+return 1
+"""
+
+
 def unlock_board_if_user(db, board, boardclass, user):
 	"""
 	Unlock the board 'board' of a given 'boardclass', if locked by 'user'.
 	"""
-	if db.get("vlab:board:{}:lock:username".format(board)) == user:
-		return unlock_board(db, board, boardclass)
-	else:
-		return False
+	unlock_time = int(time.time())
+	return _run_script(db, _UNLOCK_BOARD_IF_USER_LUA, [board, boardclass, user, unlock_time]) == 1
+
+
+_UNLOCK_BOARD_IF_USER_TIME_LUA = """
+local lock = redis.call('HMGET', board_key(ARGV[1]), 'lock:username', 'lock:time')
+if lock[1] ~= ARGV[3] or lock[2] ~= ARGV[4] then
+	return 0
+end
+unlock_board(ARGV[1], ARGV[2], ARGV[5])
+return 1
+"""
 
 
 def unlock_board_if_user_time(db, board, boardclass, user, lock_time):
 	"""
 	Unlock the board 'board' of a given 'boardclass', if locked by 'user' at 'time'.
+	The check and the unlock are a single atomic operation.
 	"""
-	if db.get("vlab:board:{}:lock:time".format(board)) == str(lock_time):
-		return unlock_board_if_user(db, board, boardclass, user)
-	else:
-		return False
+	unlock_time = int(time.time())
+	return _run_script(db, _UNLOCK_BOARD_IF_USER_TIME_LUA, [board, boardclass, user, lock_time, unlock_time]) == 1
 
 
 def unlock_board_no_boardclass(db, board):
@@ -106,89 +379,487 @@ def unlock_board_no_boardclass(db, board):
 
 def get_boardclass_of_board(db, board):
 	"""
-	Search all the board classes to determine which class a board is in.
-	This prevents the need for back links, but is a more costly operation.
+	Determine which class a board is in, using the back link stored in the board's hash.
+	"""
+	return db.hget("vlab:board:{}".format(board), "boardclass")
+
+
+def register_board(db, board, boardclass, details):
+	"""
+	Add the board 'board' to 'boardclass' and store the dict 'details' in its hash, along with the back link
+	to its boardclass. The board is not marked as available or unlocked.
+	"""
+	with db.pipeline() as pipe:
+		pipe.sadd("vlab:boardclasses", boardclass)
+		pipe.sadd("vlab:boardclass:{}:boards".format(boardclass), board)
+		pipe.hset("vlab:board:{}".format(board), mapping=dict(details, boardclass=boardclass))
+		pipe.execute()
+
+
+_ATTACH_BOARD_LUA = """
+local board, boardclass = ARGV[1], ARGV[2]
+local details = redis.call('HMGET', board_key(board), 'lock:username', 'session:username')
+-- The board's host is indexed by its previous server, which may differ from its new one
+if host_key(board) then
+	redis.call('SREM', host_key(board), board)
+end
+redis.call('HDEL', board_key(board), 'lock:username', 'lock:time',
+	'session:username', 'session:starttime', 'session:pingtime', 'session:policy')
+for i = 3, #ARGV, 2 do
+	redis.call('HSET', board_key(board), ARGV[i], ARGV[i + 1])
+end
+redis.call('HSET', board_key(board), 'boardclass', boardclass)
+unindex_user(board, details[1])
+unindex_user(board, details[2])
+redis.call('SADD', 'vlab:boardclasses', boardclass)
+redis.call('SADD', 'vlab:boardclass:' .. boardclass .. ':boards', board)
+redis.call('ZADD', 'vlab:boardclass:' .. boardclass .. ':availableboards', 0, board)
+redis.call('ZADD', 'vlab:boardclass:' .. boardclass .. ':unlockedboards', 0, board)
+redis.call('ZREM', 'vlab:boardclass:' .. boardclass .. ':locktimes', board)
+redis.call('ZREM', 'vlab:boardclass:' .. boardclass .. ':pingtimes', board)
+"""
+
+
+def attach_board(db, board, boardclass, details):
+	"""
+	Register the freshly attached board 'board' in 'boardclass' with the dict 'details' in its hash, removing any lock
+	and session it had, along with its entries in the user and host indexes, and mark it available and unlocked.
 	"""
+	args = [board, boardclass]
+	for field, value in details.items():
+		args += [field, value]
+	_run_script(db, _ATTACH_BOARD_LUA, args)
+
+
+def rebuild_boardclass_index(db):
+	"""
+	Rewrite the boardclass back link of every board from the boardclass membership sets, and drop back links
+	from board hashes that are not in any boardclass. Returns the number of board hashes that were corrected.
+	"""
+	membership = {}
 	for bc in db.smembers("vlab:boardclasses"):
 		for b in db.smembers("vlab:boardclass:{}:boards".format(bc)):
-			if b == board:
-				return bc
-	return None
+			membership[b] = bc
+
+	corrected = 0
+	for b, bc in membership.items():
+		if db.hget("vlab:board:{}".format(b), "boardclass") != bc:
+			db.hset("vlab:board:{}".format(b), "boardclass", bc)
+			corrected = corrected + 1
+
+	for key in db.scan_iter(match="vlab:board:*", count=1000, _type="hash"):
+		b = key[len("vlab:board:"):]
+		if b not in membership and db.hdel(key, "boardclass"):
+			corrected = corrected + 1
+
+	return corrected
+
+
+def get_boards_held_by(db, user, boardclass=None):
+	"""
+	Return the set of boards on which 'user' holds a lock or a session, optionally only those in 'boardclass'.
+	"""
+	if boardclass is None:
+		return db.smembers("vlab:user:{}:boards".format(user))
+	return db.sinter("vlab:user:{}:boards".format(user), "vlab:boardclass:{}:boards".format(boardclass))
+
+
+def rebuild_user_index(db):
+	"""
+	Rebuild every "vlab:user:<username>:boards" index from the locks and sessions recorded in the board hashes.
+	Returns the number of index entries that were added or removed.
+	"""
+	held = {}
+	for bc in db.smembers("vlab:boardclasses"):
+		for b in db.smembers("vlab:boardclass:{}:boards".format(bc)):
+			for user in db.hmget("vlab:board:{}".format(b), ["lock:username", "session:username"]):
+				if user is not None:
+					held.setdefault(user, set()).add(b)
+
+	corrected = 0
+	for key in db.scan_iter(match="vlab:user:*:boards", count=1000):
+		user = key[len("vlab:user:"):-len(":boards")]
+		indexed = db.smembers(key)
+		stale = indexed - held.get(user, set())
+		if stale:
+			corrected = corrected + db.srem(key, *stale)
+	for user, boards in held.items():
+		corrected = corrected + db.sadd("vlab:user:{}:boards".format(user), *boards)
+	return corrected
+
+
+def get_expired_locks(db, boardclass, now=None):
+	"""
+	Return the boards of 'boardclass' that have been locked for longer than MAX_LOCK_TIME.
+	"""
+	if now is None:
+		now = int(time.time())
+	return db.zrangebyscore("vlab:boardclass:{}:locktimes".format(boardclass), "-inf", "({}".format(now - MAX_LOCK_TIME))
+
+
+def get_stale_sessions(db, boardclass, timeout, now=None):
+	"""
+	Return the boards of 'boardclass' whose session has not been pinged for more than 'timeout' seconds.
+	"""
+	if now is None:
+		now = int(time.time())
+	return db.zrangebyscore("vlab:boardclass:{}:pingtimes".format(boardclass), "-inf", "({}".format(now - timeout))
+
+
+def rebuild_time_index(db):
+	"""
+	Rebuild the "locktimes" and "pingtimes" sets of every boardclass from the locks and sessions recorded in the
+	board hashes. Returns the number of boards indexed.
+	"""
+	indexed = 0
+	for bc in db.smembers("vlab:boardclasses"):
+		locks = {}
+		pings = {}
+		for b in db.smembers("vlab:boardclass:{}:boards".format(bc)):
+			lock_user, lock_time, session_user, ping_time = db.hmget(
+				"vlab:board:{}".format(b), ["lock:username", "lock:time", "session:username", "session:pingtime"])
+			if lock_user is not None and lock_time is not None:
+				locks[b] = int(lock_time)
+			if session_user is not None and ping_time is not None:
+				pings[b] = int(ping_time)
+		with db.pipeline() as pipe:
+			pipe.delete("vlab:boardclass:{}:locktimes".format(bc), "vlab:boardclass:{}:pingtimes".format(bc))
+			if locks:
+				pipe.zadd("vlab:boardclass:{}:locktimes".format(bc), locks)
+			if pings:
+				pipe.zadd("vlab:boardclass:{}:pingtimes".format(bc), pings)
+			pipe.execute()
+		indexed = indexed + len(locks) + len(pings)
+	return indexed
+
+
+def rebuild_host_index(db):
+	"""
+	Rebuild the "vlab:host:<server>:sessions" index of every board host from the sessions recorded in the board
+	hashes. Returns the number of boards indexed.
+	"""
+	sessions = {}
+	for bc in db.smembers("vlab:boardclasses"):
+		for b in db.smembers("vlab:boardclass:{}:boards".format(bc)):
+			server, session_user = db.hmget("vlab:board:{}".format(b), ["server", "session:username"])
+			if server is not None and session_user is not None:
+				sessions.setdefault(server, set()).add(b)
+
+	with db.pipeline() as pipe:
+		for key in db.scan_iter(match="vlab:host:*:sessions", count=1000):
+			pipe.delete(key)
+		for server, boards in sessions.items():
+			pipe.sadd("vlab:host:{}:sessions".format(server), *boards)
+		pipe.execute()
+	return sum(len(boards) for boards in sessions.values())
 
 
 def unlock_boards_held_by(db, user):
 	"""
 	Unlock all boards held by a given user
 	"""
-	for bc in db.smembers("vlab:boardclasses"):
-		for board in db.smembers("vlab:boardclass:{}:boards".format(bc)):
-			if db.get("vlab:board:{}:lock:username".format(board)) == user:
-				unlock_board_no_boardclass(db, board)
+	for board in get_boards_held_by(db, user):
+		unlock_board_if_user(db, board, get_boardclass_of_board(db, board), user)
 
 
 def remove_board(db, b):
-	bc = get_boardclass_of_board(db, b)
-	db.srem("vlab:boardclass:{}:boards".format(bc), b)
-	db.zrem("vlab:boardclass:{}:unlockedboards".format(bc), b)
-	db.zrem("vlab:boardclass:{}:availableboards".format(bc), b)
-	db.delete("vlab:board:{}:user".format(b))
-	db.delete("vlab:board:{}:server".format(b))
-	db.delete("vlab:board:{}:port".format(b))
-	db.delete("vlab:board:{}:lock:username".format(b))
-	db.delete("vlab:board:{}:lock:time".format(b))
-	db.delete("vlab:board:{}:session:username".format(b))
-	db.delete("vlab:board:{}:session:starttime".format(b))
-	db.delete("vlab:board:{}:session:pingtime".format(b))
-	db.delete("vlab:board:{}:hwtest:status".format(b))
-	db.delete("vlab:board:{}:hwtest:time".format(b))
-	db.delete("vlab:board:{}:hwtest:message".format(b))
-	db.delete("vlab:board:{}:hwtest:testing".format(b))
-
-
-def _zpopmin(db, zset):
-	# Based on https://redis.io/topics/transactions and https://github.com/andymccurdy/redis-py#pipelines
-	# Ideally we'd use ZPOPMIN here, but it's only available in Redis 5.0+
+	_run_script(db, "remove_board(ARGV[1])", [b])
+
+
+ALLOCATION_POOLS = ["available", "unlocked"]
+
+# Allocation policies choose which board of a pool to allocate. Each is the body of a Lua function(pool, boardclass,
+# user), where 'pool' is the key of the sorted set of boards to choose from, ordered from least-recently-used, that
+# returns the chosen board or nil if the pool is empty. A board class uses the policy named in its
+# "vlab:boardclass:<class>:policy" key, or DEFAULT_ALLOCATION_POLICY. Policies run inside the allocation script, so
+# they must only read keys.
+ALLOCATION_POLICIES = {
+	# The least-recently-used board
+	"lru": """
+		return redis.call('ZRANGE', pool, 0, 0)[1]
+	""",
+	# The board the user last had a session on, if it is in the pool, otherwise the least-recently-used board
+	"affinity": """
+		local last = redis.call('HGET', 'vlab:boardclass:' .. boardclass .. ':lastboards', user)
+		if last and redis.call('ZSCORE', pool, last) then
+			return last
+		end
+		return redis.call('ZRANGE', pool, 0, 0)[1]
+	""",
+	# The least-recently-used board on the board host with the fewest boards in a session
+	"leastloaded": """
+		local best, best_load
+		for _, board in ipairs(redis.call('ZRANGE', pool, 0, -1)) do
+			local server = redis.call('HGET', board_key(board), 'server')
+			local load = server and redis.call('SCARD', 'vlab:host:' .. server .. ':sessions') or 0
+			if best_load == nil or load < best_load then
+				best, best_load = board, load
+			end
+		end
+		return best
+	""",
+}
+DEFAULT_ALLOCATION_POLICY = "lru"
+
+# Pick a board of class ARGV[1] from the first non-empty pool in ALLOCATION_POOLS using the class's allocation policy,
+# then lock it and start a session on it for ARGV[2] at time ARGV[3]. Returns {board, index of the pool it came from,
+# policy}. If ARGV[4] is "1" only idle boards, from the first pool, are allocated. Nothing is allocated while users
+# are waiting in the class's queue, unless the user holds a reservation.
+_ALLOCATE_AND_START_SESSION_LUA = """
+local holder, held = reservations(ARGV[1], ARGV[2], ARGV[3])
+if not holder and redis.call('ZCARD', waiting_key(ARGV[1])) > 0 then
+	-- Boards of this class are being handed to queued users in turn, so don't jump the queue
+	journal('NOFREEBOARDS', nil, ARGV[1], ARGV[2])
+	return false
+end
+local policy = redis.call('GET', 'vlab:boardclass:' .. ARGV[1] .. ':policy')
+if not policy or not policies[policy] then
+	policy = '""" + DEFAULT_ALLOCATION_POLICY + """'
+end
+local available = 'vlab:boardclass:' .. ARGV[1] .. ':availableboards'
+local pools = {'availableboards', 'unlockedboards'}
+if ARGV[4] == '1' then
+	pools = {'availableboards'}
+end
+for i, pool in ipairs(pools) do
+	local key = 'vlab:boardclass:' .. ARGV[1] .. ':' .. pool
+	local board
+	if holder or held == 0 or (pool == 'availableboards' and redis.call('ZCARD', key) > held) then
+		board = policies[policy](key, ARGV[1], ARGV[2])
+	elseif pool == 'unlockedboards' then
+		-- The available boards are held back for reservations, so users without one may only take over boards
+		-- whose lock has expired
+		for _, unlocked in ipairs(redis.call('ZRANGE', key, 0, -1)) do
+			if not redis.call('ZSCORE', available, unlocked) then
+				board = unlocked
+				break
+			end
+		end
+	end
+	if board then
+		start_session(board, ARGV[1], ARGV[2], ARGV[3])
+		redis.call('HSET', board_key(board), 'session:policy', policy)
+		if holder then
+			redis.call('SADD', 'vlab:reservation:' .. holder .. ':claims', ARGV[2])
+		end
+		return {board, i, policy}
+	end
+end
+journal('NOFREEBOARDS', nil, ARGV[1], ARGV[2])
+return false
+"""
+
+
+# The script last built by _allocate_and_start_session_lua(), and the policies it was built from
+_allocation_lua = (None, None)
+
+
+def _allocate_and_start_session_lua():
+	# Define the policies table used by _ALLOCATE_AND_START_SESSION_LUA from ALLOCATION_POLICIES, so that policies
+	# added to it at run time are available. The script is only rebuilt when they change.
+	global _allocation_lua
+	policies = tuple(sorted(ALLOCATION_POLICIES.items()))
+	if _allocation_lua[0] != policies:
+		functions = ["[\"{}\"] = function(pool, boardclass, user)\n{}\nend".format(name, body) for name, body in policies]
+		lua = "local policies = {\n" + ",\n".join(functions) + "\n}\n" + _ALLOCATE_AND_START_SESSION_LUA
+		_allocation_lua = (policies, lua)
+	return _allocation_lua[1]
+
+
+def _allocate_and_start_session_watch(db, boardclass, username, start_time, idle_only=False):
+	# Fallback for Redis servers without scripting support, using an optimistic transaction instead. Allocation
+	# policies need scripting, so this always allocates the least-recently-used board.
+	zsets = ["vlab:boardclass:{}:{}boards".format(boardclass, pool) for pool in ALLOCATION_POOLS]
+	candidates = zsets[:1] if idle_only else zsets
+	waiting = "vlab:boardclass:{}:waiting".format(boardclass)
 	with db.pipeline() as pipe:
 		while True:
 			try:
-				pipe.watch(zset)
-				elements = pipe.zrange(zset, 0, 0)
-				if len(elements) > 0:
-					element = elements[0]
-				else:
-					element = None
+				pipe.watch(waiting, *zsets)
+				board = None
+				# Nothing is allocated while users are waiting in the class's queue
+				if pipe.zcard(waiting) == 0:
+					for i, zset in enumerate(candidates):
+						elements = pipe.zrange(zset, 0, 0)
+						if len(elements) > 0:
+							board = elements[0]
+							break
+				if board is None:
+					pipe.unwatch()
+					db.xadd(EVENTS_STREAM, {"event": "NOFREEBOARDS", "boardclass": boardclass, "user": username},
+					        maxlen=EVENTS_MAXLEN, approximate=True)
+					return None
+				pipe.watch("vlab:board:{}".format(board))
+				lock_user, session_user, session_start, server = pipe.hmget(
+					"vlab:board:{}".format(board), ["lock:username", "session:username", "session:starttime", "server"])
+				old_users = {lock_user, session_user}
 				pipe.multi()
-				pipe.zrem(zset, element)
+				if session_user is not None and session_start is not None:
+					pipe.publish("vlab:board:{}:revoked".format(board), "{}:{}".format(session_user, session_start))
+				pipe.zrem(zsets[0], board)
+				pipe.zrem(zsets[1], board)
+				pipe.hset("vlab:board:{}".format(board), mapping={
+					"lock:username": username,
+					"lock:time": start_time,
+					"session:username": username,
+					"session:starttime": start_time,
+					"session:pingtime": start_time,
+					"session:policy": "lru",
+				})
+				pipe.zadd("vlab:boardclass:{}:locktimes".format(boardclass), {board: start_time})
+				pipe.zadd("vlab:boardclass:{}:pingtimes".format(boardclass), {board: start_time})
+				pipe.hset("vlab:boardclass:{}:lastboards".format(boardclass), username, board)
+				if server is not None:
+					pipe.sadd("vlab:host:{}:sessions".format(server), board)
+				pipe.sadd("vlab:user:{}:boards".format(username), board)
+				for user in old_users - {None, username}:
+					pipe.srem("vlab:user:{}:boards".format(user), board)
+				for event in ["LOCK", "START"]:
+					pipe.xadd(EVENTS_STREAM, {"event": event, "board": board, "boardclass": boardclass, "user": username},
+					          maxlen=EVENTS_MAXLEN, approximate=True)
 				pipe.execute()
-				break
+				return [board, i + 1, "lru"]
 			except redis.WatchError:
 				continue
-	return element
 
 
-def allocate_unlocked_board_of_class(db, boardclass):
+def allocate_board_and_start_session(db, boardclass, username, start_time, idle_only=False):
+	"""
+	Atomically allocate a board of a given boardclass and start a session on it for 'username', in one round trip.
+	Boards from the availableboards set are preferred, followed by those from the unlockedboards set, and the board
+	is chosen from the set by the boardclass's allocation policy (see ALLOCATION_POLICIES). Returns a tuple of
+	(board, pool), where pool is one of ALLOCATION_POOLS, or (None, None) if every board is locked.
+	If 'idle_only' is set, only boards from the availableboards set, which nobody is using, are allocated.
+	"""
+	try:
+		rv = _run_script(db, _allocate_and_start_session_lua(), [boardclass, username, start_time, int(idle_only)])
+	except redis.exceptions.ResponseError as e:
+		if "unknown command" not in str(e).lower():
+			raise
+		rv = _allocate_and_start_session_watch(db, boardclass, username, start_time, idle_only)
+	if not rv:
+		return None, None
+	return rv[0], ALLOCATION_POOLS[int(rv[1]) - 1]
+
+
+# Hand the least-recently-used boards of class ARGV[1] in ALLOCATION_POOLS order to the users waiting in its queue, at
+# time ARGV[2]. Returns the number of boards handed over.
+_SERVE_WAITERS_LUA = """
+local served = 0
+for _, pool in ipairs({'availableboards', 'unlockedboards'}) do
+	while redis.call('ZCARD', waiting_key(ARGV[1])) > 0 do
+		local popped = redis.call('ZRANGE', 'vlab:boardclass:' .. ARGV[1] .. ':' .. pool, 0, 0)
+		if #popped == 0 or not hand_over(popped[1], ARGV[1], ARGV[2]) then
+			break
+		end
+		served = served + 1
+	end
+end
+return served
+"""
+
+
+def serve_waiters(db, boardclass):
 	"""
-	Allocate a board of a given boardclass by popping the least-recently-unlocked board from the unlockedboards set
+	Hand any allocatable boards of 'boardclass' to the users waiting in its queue. Boards are handed over as they are
+	freed anyway, so this is only needed for boards which became allocatable some other way, such as a board being
+	attached or a lock expiring while its session continues. Returns the number of boards handed over.
 	"""
-	return _zpopmin(db, "vlab:boardclass:{}:unlockedboards".format(boardclass))
+	now = int(time.time())
+	return _run_script(db, _SERVE_WAITERS_LUA, [boardclass, now])
+
+
+def create_reservation(db, boardclass, count, start, end, users, deadline=None):
+	"""
+	Reserve 'count' boards of 'boardclass' for the users in 'users' between the times 'start' and 'end'. The boards
+	are held back from other users from 'start' until each user has claimed one by logging in, or until 'deadline'
+	(by default RESERVATION_CLAIM_TIME after 'start', or 'end' if sooner). Returns the reservation's ID.
+	"""
+	if deadline is None:
+		deadline = min(start + RESERVATION_CLAIM_TIME, end)
+	reservation_id = db.incr("vlab:reservations:next")
+	with db.pipeline() as pipe:
+		pipe.hset("vlab:reservation:{}".format(reservation_id), mapping={
+			"boardclass": boardclass, "count": count, "start": start, "end": end, "deadline": deadline})
+		pipe.sadd("vlab:reservation:{}:users".format(reservation_id), *users)
+		pipe.zadd("vlab:boardclass:{}:reservations".format(boardclass), {reservation_id: start})
+		pipe.zadd("vlab:reservations", {reservation_id: start})
+		pipe.execute()
+	return reservation_id
+
+
+def get_reservations(db, boardclass=None):
+	"""
+	Return a list of every reservation, optionally only those for 'boardclass', in order of start time. Each is a dict
+	of its "id", "boardclass", "count", "start", "end", "deadline", and its "users" and "claims" as sorted lists.
+	"""
+	if boardclass is None:
+		ids = db.zrange("vlab:reservations", 0, -1)
+	else:
+		ids = db.zrange("vlab:boardclass:{}:reservations".format(boardclass), 0, -1)
+	with db.pipeline(transaction=False) as pipe:
+		for reservation_id in ids:
+			pipe.hgetall("vlab:reservation:{}".format(reservation_id))
+			pipe.smembers("vlab:reservation:{}:users".format(reservation_id))
+			pipe.smembers("vlab:reservation:{}:claims".format(reservation_id))
+		results = pipe.execute()
+
+	rv = []
+	for i, reservation_id in enumerate(ids):
+		record, users, claims = results[3 * i:3 * i + 3]
+		if not record:
+			continue
+		rv.append({
+			"id": int(reservation_id),
+			"boardclass": record["boardclass"],
+			"count": int(record["count"]),
+			"start": int(record["start"]),
+			"end": int(record["end"]),
+			"deadline": int(record["deadline"]),
+			"users": sorted(users),
+			"claims": sorted(claims),
+		})
+	return rv
+
+
+def cancel_reservation(db, reservation_id):
+	"""
+	Delete the reservation 'reservation_id', releasing any boards it holds back. Returns False if it does not exist.
+	"""
+	boardclass = db.hget("vlab:reservation:{}".format(reservation_id), "boardclass")
+	if boardclass is None:
+		return False
+	with db.pipeline() as pipe:
+		pipe.delete("vlab:reservation:{}".format(reservation_id), "vlab:reservation:{}:users".format(reservation_id),
+		            "vlab:reservation:{}:claims".format(reservation_id))
+		pipe.zrem("vlab:boardclass:{}:reservations".format(boardclass), reservation_id)
+		pipe.zrem("vlab:reservations", reservation_id)
+		pipe.execute()
+	# Boards are no longer held back, so any users waiting in the class's queue can have them
+	serve_waiters(db, boardclass)
+	return True
 
 
-def allocate_available_board_of_class(db, boardclass):
+def expire_reservations(db, now=None):
 	"""
-	Allocate a board of a given boardclass by popping the least-recently-used board from the availableboards set
+	Delete the reservations which have ended. Returns the number deleted.
 	"""
-	return _zpopmin(db, "vlab:boardclass:{}:availableboards".format(boardclass))
+	if now is None:
+		now = int(time.time())
+	expired = 0
+	for reservation in get_reservations(db):
+		if reservation["start"] > now:
+			break
+		if reservation["end"] <= now and cancel_reservation(db, reservation["id"]):
+			expired = expired + 1
+	return expired
 
 
 def start_session(db, board, boardclass, username, start_time):
 	"""
 	Start session for the board 'board', with the given 'username'.
 	"""
-	lock_board(db, board, boardclass, username, start_time)
-	db.zrem("vlab:boardclass:{}:availableboards".format(boardclass), board)
-	db.set("vlab:board:{}:session:username".format(board), username)
-	db.set("vlab:board:{}:session:starttime".format(board), start_time)
-	db.set("vlab:board:{}:session:pingtime".format(board), start_time)
+	_run_script(db, "start_session(ARGV[1], ARGV[2], ARGV[3], ARGV[4])", [board, boardclass, username, start_time])
 
 
 def end_session(db, board, boardclass):
@@ -196,31 +867,44 @@ def end_session(db, board, boardclass):
 	End session for the board 'board' of a given 'boardclass'.
 	"""
 	end_time = int(time.time())
-	db.delete("vlab:board:{}:session:username".format(board))
-	db.delete("vlab:board:{}:session:starttime".format(board))
-	db.delete("vlab:board:{}:session:pingtime".format(board))
-	db.zadd("vlab:boardclass:{}:availableboards".format(boardclass), {board: end_time})
+	_run_script(db, "end_session(ARGV[1], ARGV[2], ARGV[3])", [board, boardclass, end_time])
 	return True
 
 
+_END_SESSION_IF_USER_LUA = """
+if redis.call('HGET', board_key(ARGV[1]), 'session:username') ~= ARGV[3] then
+	return 0
+end
+end_session(ARGV[1], ARGV[2], ARGV[4])
+return 1
+"""
+
+
 def end_session_if_user(db, board, boardclass, user):
 	"""
 	End session for the board 'board' of a given 'boardclass', if locked by 'user'.
 	"""
-	if db.get("vlab:board:{}:session:username".format(board)) == user:
-		return end_session(db, board, boardclass)
-	else:
-		return False
+	end_time = int(time.time())
+	return _run_script(db, _END_SESSION_IF_USER_LUA, [board, boardclass, user, end_time]) == 1
+
+
+_END_SESSION_IF_USER_TIME_LUA = """
+local session = redis.call('HMGET', board_key(ARGV[1]), 'session:username', 'session:starttime')
+if session[1] ~= ARGV[3] or session[2] ~= ARGV[4] then
+	return 0
+end
+end_session(ARGV[1], ARGV[2], ARGV[5])
+return 1
+"""
 
 
 def end_session_if_user_time(db, board, boardclass, user, start_time):
 	"""
 	End session for the board 'board' of a given 'boardclass', if locked by 'user' at 'time'.
+	The check and the session end are a single atomic operation.
 	"""
-	if db.get("vlab:board:{}:session:starttime".format(board)) == str(start_time):
-		return end_session_if_user(db, board, boardclass, user)
-	else:
-		return False
+	end_time = int(time.time())
+	return _run_script(db, _END_SESSION_IF_USER_TIME_LUA, [board, boardclass, user, start_time, end_time]) == 1
 
 
 def ping_session(db, board):
@@ -228,25 +912,205 @@ def ping_session(db, board):
 	Ping session for the board 'board' of a given 'boardclass'.
 	"""
 	ping_time = int(time.time())
-	db.set("vlab:board:{}:session:pingtime".format(board), ping_time)
+	_run_script(db, "ping_session(ARGV[1], ARGV[2])", [board, ping_time])
 	return True
 
 
+_PING_SESSION_IF_USER_LUA = """
+if redis.call('HGET', board_key(ARGV[1]), 'session:username') ~= ARGV[2] then
+	return 0
+end
+ping_session(ARGV[1], ARGV[3])
+return 1
+"""
+
+
 def ping_session_if_user(db, board, user):
 	"""
 	Ping session for the board 'board' of a given 'boardclass', if locked by 'user'.
 	"""
-	if db.get("vlab:board:{}:session:username".format(board)) == user:
-		return ping_session(db, board)
-	else:
-		return False
+	ping_time = int(time.time())
+	return _run_script(db, _PING_SESSION_IF_USER_LUA, [board, user, ping_time]) == 1
+
+
+_PING_SESSION_IF_USER_TIME_LUA = """
+local session = redis.call('HMGET', board_key(ARGV[1]), 'session:username', 'session:starttime')
+if session[1] ~= ARGV[2] or session[2] ~= ARGV[3] then
+	return 0
+end
+ping_session(ARGV[1], ARGV[4])
+return 1
+"""
 
 
 def ping_session_if_user_time(db, board, user, start_time):
 	"""
 	Ping session for the board 'board' of a given 'boardclass', if locked by 'user' at 'time'.
+	The check and the ping are a single atomic operation.
 	"""
-	if db.get("vlab:board:{}:session:starttime".format(board)) == str(start_time):
-		return ping_session_if_user(db, board, user)
-	else:
-		return False
+	ping_time = int(time.time())
+	return _run_script(db, _PING_SESSION_IF_USER_TIME_LUA, [board, user, start_time, ping_time]) == 1
+
+
+_LEASE_PORT_LUA = """
+local port = redis.call('SPOP', 'vlab:ports:free')
+if not port then
+	return false
+end
+redis.call('ZADD', 'vlab:ports:leases', ARGV[2], port)
+redis.call('HSET', 'vlab:ports:owners', port, ARGV[1])
+return port
+"""
+
+
+def lease_port(db, user):
+	"""
+	Lease a free relay port to 'user'. Returns the port, or None if every port in PORT_RANGE is leased.
+	"""
+	now = int(time.time())
+	port = _run_script(db, _LEASE_PORT_LUA, [user, now])
+	if not port:
+		return None
+	return int(port)
+
+
+_RENEW_PORT_LEASE_LUA = """
+if redis.call('HGET', 'vlab:ports:owners', ARGV[1]) ~= ARGV[2] then
+	-- Take the port back if the lease has been reclaimed but nobody else has leased it since
+	if redis.call('SREM', 'vlab:ports:free', ARGV[1]) == 0 then
+		return 0
+	end
+	redis.call('HSET', 'vlab:ports:owners', ARGV[1], ARGV[2])
+end
+redis.call('ZADD', 'vlab:ports:leases', ARGV[3], ARGV[1])
+return 1
+"""
+
+
+def renew_port_lease(db, port, user):
+	"""
+	Renew the lease of 'user' on the relay port 'port'. Returns False if the port is leased to someone else.
+	"""
+	now = int(time.time())
+	return _run_script(db, _RENEW_PORT_LEASE_LUA, [port, user, now]) == 1
+
+
+_RELEASE_PORT_LUA = """
+if redis.call('HGET', 'vlab:ports:owners', ARGV[1]) ~= ARGV[2] then
+	return 0
+end
+redis.call('HDEL', 'vlab:ports:owners', ARGV[1])
+redis.call('ZREM', 'vlab:ports:leases', ARGV[1])
+redis.call('SADD', 'vlab:ports:free', ARGV[1])
+return 1
+"""
+
+
+def release_port(db, port, user):
+	"""
+	Return the relay port 'port' to the free pool, if it is leased to 'user'.
+	"""
+	return _run_script(db, _RELEASE_PORT_LUA, [port, user]) == 1
+
+
+_RECLAIM_STALE_PORTS_LUA = """
+local stale = redis.call('ZRANGEBYSCORE', 'vlab:ports:leases', '-inf', '(' .. ARGV[1])
+for _, port in ipairs(stale) do
+	redis.call('HDEL', 'vlab:ports:owners', port)
+	redis.call('ZREM', 'vlab:ports:leases', port)
+	redis.call('SADD', 'vlab:ports:free', port)
+end
+return #stale
+"""
+
+
+def reclaim_stale_ports(db, now=None):
+	"""
+	Return the relay ports whose lease has not been renewed for more than PORT_LEASE_TIMEOUT seconds to the free pool.
+	Returns the number of ports reclaimed.
+	"""
+	if now is None:
+		now = int(time.time())
+	return _run_script(db, _RECLAIM_STALE_PORTS_LUA, [now - PORT_LEASE_TIMEOUT])
+
+
+def init_port_pool(db):
+	"""
+	Fill the free relay port pool with every port in PORT_RANGE that is not currently leased, and drop any free ports
+	outside of it. Returns the number of free ports.
+	"""
+	ports = set(str(p) for p in range(PORT_RANGE[0], PORT_RANGE[1] + 1))
+	free = ports - set(db.zrange("vlab:ports:leases", 0, -1))
+	with db.pipeline() as pipe:
+		pipe.delete("vlab:ports:free", "vlab:port")
+		if free:
+			pipe.sadd("vlab:ports:free", *free)
+		pipe.execute()
+	return len(free)
+
+
+def watch_for_revocation(db, board, username, start_time, callback):
+	"""
+	Call 'callback' from a background thread as soon as the session of 'username' on 'board' that started at
+	'start_time' is ended or taken over. Returns the thread, which should be stopped with its stop() method once
+	the session is over.
+	"""
+	session = "{}:{}".format(username, start_time)
+
+	def handler(message):
+		if message["data"] == session:
+			callback()
+
+	pubsub = db.pubsub(ignore_subscribe_messages=True)
+	pubsub.subscribe(**{"vlab:board:{}:revoked".format(board): handler})
+	return pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+def read_events(db, last_id="0-0", count=None, block=None):
+	"""
+	Return a list of (id, fields) tuples for the events journalled after the stream ID 'last_id', oldest first.
+	Pass the ID of the last event seen to carry on from it, and 'block' (in milliseconds) to wait for new events.
+	Each ID starts with the time the event was recorded, in milliseconds (see event_time()).
+	"""
+	rv = db.xread({EVENTS_STREAM: last_id}, count=count, block=block)
+	if not rv:
+		return []
+	return rv[0][1]
+
+
+def event_time(event_id):
+	"""
+	Return the time, in seconds, at which the event with the stream ID 'event_id' was recorded.
+	"""
+	return int(event_id.split("-")[0]) // 1000
+
+
+def migrate_legacy_board_keys(db, dry_run=False):
+	"""
+	Convert the old per-field "vlab:board:<serial>:<field>" string keys into the per-board hashes.
+	Values already present in a hash are not overwritten. Returns the number of keys converted.
+	"""
+	converted = 0
+	for key in db.scan_iter(match="vlab:board:*:*", count=1000):
+		for field in BOARD_FIELDS:
+			if key.endswith(":" + field):
+				board = key[len("vlab:board:"):-len(field) - 1]
+				break
+		else:
+			continue
+		if db.type(key) != "string":
+			continue
+		value = db.get(key)
+		if value is None:
+			continue
+		if not dry_run:
+			with db.pipeline() as pipe:
+				pipe.hsetnx("vlab:board:{}".format(board), field, value)
+				pipe.delete(key)
+				pipe.execute()
+		converted = converted + 1
+	return converted
+
+
+if vlabmetrics.enabled():
+	vlabmetrics.instrument_module(sys.modules[__name__])
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""
+The serial console history kept by each board server's serial broker (serialbroker.py).
+
+The broker is the only reader of the board's UART. Everything it reads is added to a SerialLog, which keeps the most
+recent BUFFER_SIZE bytes in memory and appends everything to a spill file on disk, rotated when it reaches SPILL_SIZE,
+so that the last few megabytes of output can be replayed to the session's owner after they disconnect. The log
+belongs to the user of the current session, and is cleared when a different user attaches so that nobody can read
+another user's output.
+
+Clients talk to the broker over the unix socket BROKER_SOCKET by sending a single request line (see
+broker_request()), after which the connection carries the serial output and, for "attach" requests, the user's input.
+"""
+
+import os
+
+BROKER_SOCKET = "/run/vlab/serial.sock"
+SPILL_FILE = "/vlab/serial/serial.log"
+BUFFER_SIZE = 256 * 1024
+SPILL_SIZE = 4 * 1024 * 1024
+# The most that can be fetched after disconnecting, which is what is kept in the spill file and its rotated copy
+MAX_HISTORY = 2 * SPILL_SIZE
+
+# "attach <owner>" connects the owner's console, "view" connects a read-only viewer, and "tail <bytes> <owner>" sends
+# the owner the most recent output and closes the connection.
+REQUESTS = ["attach", "view", "tail"]
+
+
+def broker_request(request, *args):
+	"""
+	Return the line which asks the broker for 'request' (one of REQUESTS) with 'args'.
+	"""
+	if request not in REQUESTS:
+		raise ValueError("Unknown serial broker request '{}'".format(request))
+	return (" ".join([request] + [str(a) for a in args]) + "\n").encode()
+
+
+def parse_request(line):
+	"""
+	Return the request and list of arguments in the request 'line' (bytes), or raise ValueError if it is invalid.
+	"""
+	fields = line.decode(errors="replace").split()
+	if not fields or fields[0] not in REQUESTS:
+		raise ValueError("Invalid serial broker request")
+	request, args = fields[0], fields[1:]
+	if request == "attach" and len(args) != 1:
+		raise ValueError("attach needs an owner")
+	if request == "tail" and (len(args) != 2 or not args[0].isdigit()):
+		raise ValueError("tail needs a number of bytes and an owner")
+	return request, args
+
+
+class SerialLog:
+	"""
+	The most recent output of a serial port, kept in a ring buffer of 'buffer_size' bytes and spilled to the file
+	'spill' (rotated to '<spill>.1' every 'spill_size' bytes). The owner of the log is kept in '<spill>.owner', so that
+	it survives the broker being restarted.
+	"""
+
+	def __init__(self, spill=SPILL_FILE, buffer_size=BUFFER_SIZE, spill_size=SPILL_SIZE):
+		self.spill = spill
+		self.buffer_size = buffer_size
+		self.spill_size = spill_size
+		self.buffer = bytearray()
+		os.makedirs(os.path.dirname(spill), exist_ok=True)
+		try:
+			with open(spill + ".owner") as f:
+				self.owner = f.read().strip() or None
+		except OSError:
+			self.owner = None
+		# Reload the end of the spill, so that output from before a restart is still in the buffer
+		self.buffer += self._read_spill(buffer_size)
+		self.spill_file = open(spill, "ab")
+
+	def append(self, data):
+		"""
+		Add 'data' (bytes) read from the serial port to the log.
+		"""
+		self.buffer += data
+		if len(self.buffer) > self.buffer_size:
+			del self.buffer[:len(self.buffer) - self.buffer_size]
+		self.spill_file.write(data)
+		self.spill_file.flush()
+		if self.spill_file.tell() >= self.spill_size:
+			self.spill_file.close()
+			os.replace(self.spill, self.spill + ".1")
+			self.spill_file = open(self.spill, "ab")
+
+	def tail(self, count):
+		"""
+		Return the most recent 'count' bytes of output.
+		"""
+		if count <= len(self.buffer):
+			return bytes(self.buffer[len(self.buffer) - count:])
+		return self._read_spill(count)
+
+	def set_owner(self, owner):
+		"""
+		Give the log to 'owner', clearing it if it belonged to anybody else.
+		"""
+		if owner == self.owner:
+			return
+		self.clear()
+		self.owner = owner
+		with open(self.spill + ".owner", "w") as f:
+			f.write(owner)
+
+	def clear(self):
+		self.buffer.clear()
+		self.spill_file.seek(0)
+		self.spill_file.truncate()
+		try:
+			os.remove(self.spill + ".1")
+		except OSError:
+			pass
+
+	def close(self):
+		self.spill_file.close()
+
+	def _read_spill(self, count):
+		data = b""
+		for path in [self.spill, self.spill + ".1"]:
+			if len(data) >= count:
+				break
+			try:
+				with open(path, "rb") as f:
+					f.seek(0, os.SEEK_END)
+					f.seek(max(0, f.tell() - (count - len(data))))
+					data = f.read() + data
+			except OSError:
+				pass
+		return data[len(data) - count:] if count < len(data) else data
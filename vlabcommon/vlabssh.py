@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+SSH connections from the relay to board hosts and board server containers.
+
+Commands built here share one persistent OpenSSH master connection per target (user, host and port), so only the
+first command to a target pays for the key exchange and authentication. Masters send keepalives so that they exit
+when their connection dies, for example when the container is restarted, and exit after CONTROL_PERSIST seconds
+without use. OpenSSH only lets the user who started a master use it, so each local user has their own control
+directory.
+
+probe() checks many SSH ports for reachability at once, so that checking the whole fleet takes about as long as its
+slowest probe.
+"""
+
+import os
+import socket
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+KEYFILE = "/vlab/keys/id_rsa"
+CONTROL_PERSIST = 300
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+# Reachability probes give up on a connection after PROBE_TIMEOUT seconds, and try an unreachable port PROBE_ATTEMPTS
+# times in all, PROBE_RETRY_DELAY seconds apart. At most PROBE_THREADS ports are probed at once.
+PROBE_TIMEOUT = 5
+PROBE_ATTEMPTS = 2
+PROBE_RETRY_DELAY = 3
+PROBE_THREADS = 32
+
+
+def control_dir():
+	path = os.path.join(os.path.expanduser("~"), ".vlab-ssh")
+	os.makedirs(path, mode=0o700, exist_ok=True)
+	return path
+
+
+def ssh_options(multiplex=True):
+	"""
+	Return the list of options for ssh to use the relay's key and, if 'multiplex' is set, to share a master connection.
+	"""
+	options = ["-o", "StrictHostKeyChecking=no", "-i", KEYFILE]
+	if multiplex:
+		options += [
+			"-o", "ControlMaster=auto",
+			"-o", "ControlPath={}".format(os.path.join(control_dir(), "%C")),
+			"-o", "ControlPersist={}".format(CONTROL_PERSIST),
+			"-o", "ServerAliveInterval={}".format(KEEPALIVE_INTERVAL),
+			"-o", "ServerAliveCountMax={}".format(KEEPALIVE_COUNT),
+		]
+	return options
+
+
+def ssh_args(target, cmd=None, port=None, options=(), multiplex=True):
+	"""
+	Return the argument list to run 'cmd' on 'target' ("user@host") over SSH, for use with subprocess.
+	"""
+	args = ["ssh", "-q"] + ssh_options(multiplex) + list(options)
+	if port is not None:
+		args += ["-p", str(port)]
+	args.append(target)
+	if cmd is not None:
+		args.append(cmd)
+	return args
+
+
+def ssh_command(target, cmd, port=None, options=(), multiplex=True):
+	"""
+	Return a shell command line to run 'cmd' on 'target' over SSH, for use with os.system or subprocess with shell=True.
+	"""
+	args = ssh_args(target, None, port, options, multiplex)
+	return " ".join(args) + " \"{}\"".format(cmd)
+
+
+def close_master(target, port=None):
+	"""
+	Ask the master connection to 'target', if any, to exit. Returns True if there was one.
+	"""
+	args = ssh_args(target, port=port, options=["-O", "exit"])
+	return subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+def reachable(host, port, timeout=PROBE_TIMEOUT):
+	"""
+	Return True if a TCP connection can be made to 'port' on 'host' within 'timeout' seconds.
+	"""
+	try:
+		socket.create_connection((host, int(port)), timeout=timeout).close()
+		return True
+	except (OSError, ValueError):
+		return False
+
+
+def _probe_one(host, port, timeout, attempts, retry_delay):
+	for attempt in range(attempts):
+		if attempt > 0:
+			time.sleep(retry_delay)
+		if reachable(host, port, timeout):
+			return True
+	return False
+
+
+def probe(targets, timeout=PROBE_TIMEOUT, attempts=PROBE_ATTEMPTS, retry_delay=PROBE_RETRY_DELAY,
+          threads=PROBE_THREADS):
+	"""
+	Check concurrently whether each of 'targets', an iterable of (host, port), accepts connections, trying those which
+	do not up to 'attempts' times. Returns a dict of each target to True if it is reachable.
+	"""
+	targets = list(dict.fromkeys(targets))
+	if not targets:
+		return {}
+	with ThreadPoolExecutor(max_workers=min(threads, len(targets))) as executor:
+		results = executor.map(lambda t: _probe_one(t[0], t[1], timeout, attempts, retry_delay), targets)
+		return dict(zip(targets, results))
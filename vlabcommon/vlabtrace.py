@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+Per-login latency traces for the VLAB relay.
+
+The relay's login shell (shell.py) times each phase of a login, such as the access checks, the allocation, the
+container restart, the board reset and the final SSH hop to the board server, in a LoginTrace. Each trace is saved
+to the capped "vlab:traces" stream under its own session ID, along with the user, board and session start time so
+that it can be matched with the session's events. summarise() reports the median and 95th percentile of each phase
+over a set of traces.
+"""
+
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+TRACES_STREAM = "vlab:traces"
+TRACES_MAXLEN = 10000
+
+
+def process_start_time(pid="self"):
+	"""
+	Return the time at which the process 'pid' was started, in seconds since the epoch, or None if it is unknown.
+	"""
+	try:
+		with open("/proc/{}/stat".format(pid)) as f:
+			# The command name may contain spaces, so count fields from the closing bracket after it
+			start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+		with open("/proc/stat") as f:
+			boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime "))
+	except (OSError, ValueError, IndexError, StopIteration):
+		return None
+	return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+class LoginTrace:
+	"""
+	The timings of the phases of a single login by 'username', in milliseconds and in the order they were recorded.
+	"""
+
+	def __init__(self, username, session_id=None):
+		self.session_id = session_id if session_id is not None else uuid.uuid4().hex
+		self.username = username
+		self.start = time.time()
+		self.fields = {}
+		self.phases = {}
+		self.saved = False
+
+	def add(self, name, seconds):
+		"""
+		Record that the phase 'name' took 'seconds'. Phases recorded more than once are added together.
+		"""
+		self.phases[name] = self.phases.get(name, 0.0) + seconds * 1000
+
+	@contextmanager
+	def phase(self, name):
+		"""
+		Time the body of a with statement as the phase 'name'.
+		"""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name, time.perf_counter() - start)
+
+	def set(self, **fields):
+		"""
+		Record details of the login, such as its "boardclass", "board", "start_time" or "outcome".
+		"""
+		self.fields.update(fields)
+
+	def to_dict(self):
+		return dict(self.fields, session=self.session_id, user=self.username, time=int(self.start),
+		            total_ms=sum(self.phases.values()), phases=dict(self.phases))
+
+	def save(self, db, outcome=None):
+		"""
+		Append the trace to the traces stream, unless it has already been saved. Returns the trace's stream ID.
+		"""
+		if self.saved:
+			return None
+		if outcome is not None:
+			self.set(outcome=outcome)
+		self.saved = True
+		return db.xadd(TRACES_STREAM, {"session": self.session_id, "trace": json.dumps(self.to_dict())},
+		               maxlen=TRACES_MAXLEN, approximate=True)
+
+
+def read_traces(db, count=None, user=None):
+	"""
+	Return the most recent 'count' traces (or all of them) as dicts, oldest first. If 'user' is given, only that
+	user's traces are returned, and 'count' applies to those.
+	"""
+	if user is None:
+		entries = db.xrevrange(TRACES_STREAM, count=count)
+		return [json.loads(fields["trace"]) for _, fields in reversed(entries)]
+	traces = [json.loads(fields["trace"]) for _, fields in db.xrange(TRACES_STREAM)]
+	traces = [t for t in traces if t["user"] == user]
+	if count is not None:
+		traces = traces[max(0, len(traces) - count):]
+	return traces
+
+
+def percentile(values, pct):
+	"""
+	Return the 'pct'th percentile of the list 'values' by the nearest-rank method, or None if it is empty.
+	"""
+	if not values:
+		return None
+	ordered = sorted(values)
+	rank = max(1, -(-len(ordered) * pct // 100))
+	return ordered[int(rank) - 1]
+
+
+def summarise(traces):
+	"""
+	Return a dict mapping each phase found in 'traces' (plus "total") to a dict of its "count", "p50" and "p95" in
+	milliseconds, with phases in the order they first appear.
+	"""
+	timings = {}
+	for trace in traces:
+		for name, ms in trace["phases"].items():
+			timings.setdefault(name, []).append(ms)
+	timings["total"] = [trace["total_ms"] for trace in traces]
+	return {name: {"count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95)}
+	        for name, values in timings.items() if values}
@@ -10,6 +10,7 @@ from flask import Flask, jsonify, render_template, request
 
 import logparser
 import redis_queries
+import vlabmetrics
 
 app = Flask(__name__)
 
@@ -57,6 +58,35 @@ def api_hwtest_trigger():
     return jsonify({'ok': True})
 
 
+@app.route('/api/events')
+def api_events():
+    db = redis_queries.connect()
+    after = request.args.get('after')
+    if after and not redis_queries.valid_stream_id(after):
+        return jsonify({'ok': False, 'error': 'Invalid event ID'}), 400
+    count = request.args.get('count', 100, type=int)
+    return jsonify({
+        'events': redis_queries.get_events(db, after=after, count=count),
+        'redis_ok': db is not None,
+    })
+
+
+@app.route('/api/metrics')
+def api_metrics():
+    if not vlabmetrics.enabled():
+        return jsonify({'ok': False, 'error': 'Metrics are not enabled (set VLAB_METRICS)'}), 404
+    return jsonify(vlabmetrics.snapshot())
+
+
+@app.route('/api/reconciler')
+def api_reconciler():
+    db = redis_queries.connect()
+    return jsonify({
+        'checks': redis_queries.get_reconciler_metrics(db),
+        'redis_ok': db is not None,
+    })
+
+
 @app.route('/api/stats/summary')
 def api_stats_summary():
     stats = logparser.parse_log()
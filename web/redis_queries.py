@@ -8,20 +8,24 @@ instead of printing/calling sys.exit().
 """
 
 import os
+import re
 import time
 
 import redis
 
+import vlabclient
+
 MAX_LOCK_TIME = 3600
+EVENTS_STREAM = 'vlab:events'
+RECONCILER_METRICS = 'vlab:reconciler:metrics'
+STREAM_ID = re.compile(r'\d+(-\d+)?', re.ASCII)
 
 
 def connect():
     """Connect to Redis, returning a client or None on failure."""
     host = os.environ.get('REDIS_HOST', 'relay')
     try:
-        db = redis.Redis(host=host, port=6379, db=0, decode_responses=True)
-        db.ping()
-        return db
+        return vlabclient.get_client(host=host)
     except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
         return None
 
@@ -31,7 +35,8 @@ def get_board_status(db):
 
     Each board dict:
         serial, boardclass, server, port, status, user, start_time,
-        lock_time, duration_s
+        lock_time, duration_s, policy (the allocation policy that picked
+        the board for its session, if any)
     """
     if db is None:
         return []
@@ -41,19 +46,21 @@ def get_board_status(db):
 
     for bc in db.smembers('vlab:boardclasses'):
         for serial in db.smembers('vlab:boardclass:{}:boards'.format(bc)):
+            record = db.hgetall('vlab:board:{}'.format(serial))
             board = {
                 'serial': serial,
                 'boardclass': bc,
-                'server': db.get('vlab:board:{}:server'.format(serial)) or '',
-                'port': db.get('vlab:board:{}:port'.format(serial)) or '',
+                'server': record.get('server', ''),
+                'port': record.get('port', ''),
                 'status': 'unknown',
                 'user': '',
                 'start_time': '',
                 'lock_time': '',
                 'duration_s': 0,
-                'hwtest_status': db.get('vlab:board:{}:hwtest:status'.format(serial)) or '',
-                'hwtest_time': db.get('vlab:board:{}:hwtest:time'.format(serial)) or '',
-                'hwtest_message': db.get('vlab:board:{}:hwtest:message'.format(serial)) or '',
+                'policy': '',
+                'hwtest_status': record.get('hwtest:status', ''),
+                'hwtest_time': record.get('hwtest:time', ''),
+                'hwtest_message': record.get('hwtest:message', ''),
             }
 
             available_since = db.zscore(
@@ -65,20 +72,21 @@ def get_board_status(db):
                 continue
 
             # Not available — check for active session
-            session_user = db.get('vlab:board:{}:session:username'.format(serial))
-            session_start = db.get('vlab:board:{}:session:starttime'.format(serial))
+            session_user = record.get('session:username')
+            session_start = record.get('session:starttime')
 
             if session_user and session_start:
                 board['user'] = session_user
                 board['start_time'] = session_start
+                board['policy'] = record.get('session:policy', '')
                 try:
                     board['duration_s'] = now - int(session_start)
                 except (ValueError, TypeError):
                     board['duration_s'] = 0
 
                 # Check lock status
-                lock_user = db.get('vlab:board:{}:lock:username'.format(serial))
-                lock_time = db.get('vlab:board:{}:lock:time'.format(serial))
+                lock_user = record.get('lock:username')
+                lock_time = record.get('lock:time')
 
                 unlocked_since = db.zscore(
                     'vlab:boardclass:{}:unlockedboards'.format(bc), serial)
@@ -123,12 +131,13 @@ def get_summary(db):
         # Count boards that failed hardware test
         hwtest_failed = 0
         for serial in db.smembers('vlab:boardclass:{}:boards'.format(bc)):
-            if db.get('vlab:board:{}:hwtest:status'.format(serial)) == 'fail':
+            if db.hget('vlab:board:{}'.format(serial), 'hwtest:status') == 'fail':
                 # Only count if not in available pool (truly withdrawn)
                 if db.zscore('vlab:boardclass:{}:availableboards'.format(bc), serial) is None:
                     hwtest_failed += 1
 
         summary[bc] = {
+            'waiting': db.zcard('vlab:boardclass:{}:waiting'.format(bc)),
             'total': total,
             'available': available,
             'in_use': in_use,
@@ -138,3 +147,45 @@ def get_summary(db):
         }
 
     return summary
+
+
+def valid_stream_id(value):
+    """Return True if 'value' is a stream ID, as accepted by get_events()."""
+    return STREAM_ID.fullmatch(value) is not None
+
+
+def get_events(db, after=None, count=100):
+    """Return up to 'count' session lifecycle events from the relay's journal, oldest first.
+
+    If 'after' is a stream ID, only events recorded after it are returned, so a
+    client can poll from the ID of the last event it saw. Otherwise the most
+    recent events are returned.
+    """
+    if db is None:
+        return []
+
+    if after:
+        rv = db.xread({EVENTS_STREAM: after}, count=count)
+        entries = rv[0][1] if rv else []
+    else:
+        entries = list(reversed(db.xrevrange(EVENTS_STREAM, count=count)))
+
+    return [dict(fields, id=event_id, time=int(event_id.split('-')[0]) // 1000)
+            for event_id, fields in entries]
+
+
+def get_reconciler_metrics(db):
+    """Return the relay reconciler's cycle figures for each of its checks.
+
+    Mirrors vlabreconciler.get_metrics(): each check maps to the duration of
+    its last cycle and its longest, in seconds, the number of cycles run and
+    when the last one finished.
+    """
+    if db is None:
+        return {}
+
+    metrics = {}
+    for field, value in db.hgetall(RECONCILER_METRICS).items():
+        check, figure = field.rsplit(':', 1)
+        metrics.setdefault(check, {})[figure] = int(value) if figure in ('cycles', 'last') else float(value)
+    return metrics
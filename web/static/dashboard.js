@@ -143,7 +143,7 @@
     function updateBoardTable(boards) {
         var tbody = document.getElementById('board-table-body');
         if (!boards || boards.length === 0) {
-            tbody.innerHTML = '<tr><td colspan="7" class="px-5 py-8 text-center text-gray-400">No boards registered</td></tr>';
+            tbody.innerHTML = '<tr><td colspan="8" class="px-5 py-8 text-center text-gray-400">No boards registered</td></tr>';
             return;
         }
         var html = '';
@@ -162,6 +162,7 @@
             html += '<td class="px-5 py-3">' + statusBadge(b.status) + '</td>';
             html += '<td class="px-5 py-3">' + hwtestBadge(b) + '</td>';
             html += '<td class="px-5 py-3 text-gray-700">' + (b.user ? escapeHtml(b.user) : '-') + '</td>';
+            html += '<td class="px-5 py-3 text-gray-600">' + (b.policy ? escapeHtml(b.policy) : '-') + '</td>';
             html += '<td class="px-5 py-3 text-gray-600">' + (b.status !== 'available' && b.status !== 'hwtest_failed' && b.duration_s ? formatDuration(b.duration_s) : '-') + '</td>';
             html += '</tr>';
         }